@@ -1,21 +1,302 @@
 import os
+import sys
+import gzip
+import hashlib
+import math
+import mmap
+import struct
 import time
+import threading
+import zlib
+import heapq
+import multiprocessing
+import tempfile
+import click
 import requests
 import json # Importa a biblioteca para manipulação de JSON
-from datetime import datetime, timedelta # Importa bibliotecas para lidar com o tempo
-from flask import Flask, render_template, jsonify
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone # Importa bibliotecas para lidar com o tempo
+from requests.adapters import HTTPAdapter
+from functools import lru_cache
+from itertools import chain, islice
+from flask import Flask, Response, abort, g, render_template, jsonify, request, send_file, send_from_directory, stream_with_context
+from flask.cli import AppGroup
+
+try:
+    import brotli # Opcional: habilita respostas comprimidas com brotli
+except ImportError:
+    brotli = None
+
+CODIFICACOES = ('identity', 'gzip', 'br') if brotli is not None else ('identity', 'gzip')
+
+try:
+    import numpy as np # Opcional: classificação vetorizada dos períodos
+except ImportError:
+    np = None
+
+try:
+    import fcntl # Trava entre processos (Linux/macOS)
+except ImportError:
+    fcntl = None
+    import msvcrt # Windows
 
 # --- Configurações ---
 GITHUB_REPO_OWNER = 'LuksNMDS'
 GITHUB_REPO_NAME = 'mapa-tcc-imagens'
 GITHUB_BRANCH = 'main'
+GITHUB_API_URL = 'https://api.github.com'
 PATH_TO_IMAGES = 'static/imagens'
-CACHE_FILENAME = 'paleo_cache.json'
+GITHUB_CACHE_FILENAME = 'paleo_github_cache.json' # SHA da árvore, ETag e lista de táxons do repositório de imagens
+GITHUB_REVALIDACAO_MINUTOS = 60 # Dentro deste intervalo a lista em cache é usada sem consultar o GitHub
+# Modo offline: caminho de um checkout local do repositório de imagens ou de um
+# manifesto (.json com uma lista de nomes, ou texto com um nome por linha).
+# Quando definido, o GitHub não é consultado.
+GITHUB_FONTE_LOCAL = None
+URL_BASE_IMAGENS = f"https://raw.githubusercontent.com/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/{GITHUB_BRANCH}/{PATH_TO_IMAGES}/"
+# Espelho local das imagens: se definido, as imagens são servidas pela própria
+# aplicação em /imagens/ a partir desta pasta, em vez de URL_BASE_IMAGENS.
+IMAGENS_ESPELHO_LOCAL = None
+PAISES_GEOJSON_FILENAME = 'paises.geo.json' # Cópia local do GeoJSON de países usado pelo mapa
+PAISES_GEOJSON_URL = 'https://raw.githubusercontent.com/johan/world.geo.json/master/countries.geo.json'
+PAISES_TAMANHO_DA_CELULA = 1.0 # Tamanho (em graus) das células da grade do índice espacial
+CLUSTER_ZOOM_MAXIMO = 16 # Acima deste zoom os tiles trazem os pontos individuais
+CLUSTER_CELULAS_POR_TILE = 4 # Grade de 4x4 células (64 px) por tile de 256 px
+CLUSTER_TILES_EM_CACHE = 4096 # Quantidade de tiles serializados guardados por versão
+# Junta as ocorrências do mesmo táxon no mesmo local (mesmas coordenadas,
+# período e demais campos) num único registro com 'quantidade' e o intervalo
+# de idades que cobre todas elas
+AGRUPAR_OCORRENCIAS = True
+# Processos usados na limpeza dos registros brutos: 1 limpa no próprio
+# processo; mais de 1 (ou 0, um por núcleo) usa um pool, só quando há mais de
+# um lote. Medir com o benchmark.py antes de ativar: o pool pode ser mais lento.
+LIMPEZA_PROCESSOS = 1
+LIMPEZA_REGISTROS_POR_LOTE = 50000 # Registros brutos enviados de cada vez a um processo de limpeza
+PAGINACAO_LIMITE_PADRAO = 1000 # Ocorrências por página quando só o cursor é informado
+PAGINACAO_LIMITE_MAXIMO = 10000
+NDJSON_LINHAS_POR_BLOCO = 1000 # Ocorrências serializadas (e enviadas) de cada vez no modo ndjson
+HISTOGRAMA_IDADE_MAXIMA = 541 # Faixas de 1 M.A. do histograma de idades, até o início do Cambriano
+CACHE_DIRETORIO = 'paleo_dataset' # Versões do dataset processado, em formato colunar
+CACHE_VERSOES_MANTIDAS = 3 # Versões anteriores guardadas em disco, além da atual
+# Incrementar ao mudar a lógica de limpeza, para que os caches antigos sejam
+# descartados. Mudanças em templates e JS não invalidam o cache.
+VERSAO_DA_LIMPEZA = 1
+# Trava de arquivo que garante uma única reconstrução por máquina quando a
+# aplicação roda em vários processos (ex.: workers do gunicorn)
+CACHE_LOCK_FILENAME = 'paleo_dataset.lock'
+CACHE_VERIFICACAO_SEGUNDOS = 30 # Intervalo entre verificações de versões novas gravadas por outros processos
+# Na primeira requisição recebida (ex.: a página do mapa), a aplicação carrega
+# em segundo plano a última versão gravada (ex.: gerada por 'flask paleomap
+# build' no CI ou no cron), para que a requisição dos dados já a encontre
+# pronta. Nunca dispara uma busca no PBDB por conta própria.
+CACHE_AQUECER_NA_INICIALIZACAO = True
 CACHE_MAX_AGE_HOURS = 24 # O cache será considerado válido por 24 horas
+TAXON_STORE_FILENAME = 'paleo_taxons.jsonl' # Registros brutos do PBDB, uma linha por táxon
+TAXON_MAX_AGE_HOURS = 24 * 7 # Cada táxon é buscado de novo no PBDB após 7 dias
+TAXON_DENYLIST_FILENAME = 'paleo_taxons_bloqueados.json' # Táxons que fazem o PBDB falhar
+TAXON_BLOQUEIO_HORAS = 24 * 7 # Um táxon bloqueado volta a ser tentado após 7 dias
+TAXON_FALHAS_PARA_BLOQUEIO = 2 # Construções seguidas em que o táxon precisa falhar sozinho para ser bloqueado
+PBDB_API_URL = "https://paleobiodb.org/data1.2/occs/list.json"
+PBDB_CHUNK_SIZE = 500 # Quantidade máxima (e inicial) de táxons por requisição ao PBDB
+PBDB_CHUNK_MINIMO = 25 # O tamanho adaptativo do lote nunca fica abaixo disto
+PBDB_LATENCIA_ALVO_SEGUNDOS = 15 # Duração desejada de cada requisição
+PBDB_BYTES_ALVO = 32 * 1024 * 1024 # Tamanho desejado de cada resposta
+PBDB_MAX_TENTATIVAS = 3
+PBDB_MAX_WORKERS = 4 # Máximo de lotes buscados ao mesmo tempo
+PBDB_REQUISICOES_POR_SEGUNDO = 1.0 # Taxa média permitida de requisições ao PBDB
+PBDB_RAJADA_MAXIMA = 2 # Requisições que podem sair de uma vez antes de a taxa ser aplicada
+PBDB_TAMANHO_DO_BLOCO = 64 * 1024 # Bytes lidos por vez da resposta do PBDB
+# Campos dos registros do PBDB usados na limpeza; os demais são descartados na leitura
+CAMPOS_DO_REGISTRO = ('oid', 'lat', 'lng', 'eag', 'lag', 'gnn', 'tna', 'spn', 'idt', 'fml', 'sfn', 'sfm', 'oei', 'oli', 'pnm')
+# Emite uma linha JSON por evento do pipeline (etapas, lotes do PBDB), além das mensagens de sempre
+METRICAS_LOG_ESTRUTURADO = True
+# Limites (em segundos) das faixas dos histogramas de latência em /metrics
+METRICAS_FAIXAS_DE_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
 # --------------------
 
 app = Flask(__name__)
 
+# --- Métricas ---
+
+class RegistroDeMetricas:
+    """
+    Contadores, medidores e histogramas em memória, expostos no formato texto
+    do Prometheus em /metrics. Cada processo tem o seu registro; com vários
+    workers, o Prometheus deve coletar cada um ou somar por instância.
+    """
+
+    def __init__(self, faixas=METRICAS_FAIXAS_DE_LATENCIA):
+        self.faixas = tuple(faixas)
+        self.lock = threading.Lock()
+        self.descricoes = OrderedDict() # nome -> (tipo, ajuda)
+        self.valores = {} # (nome, rótulos) -> valor, ou [contagens, soma, total] nos histogramas
+
+    def descrever(self, nome, tipo, ajuda):
+        self.descricoes[nome] = (tipo, ajuda)
+
+    def incrementar(self, nome, valor=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self.lock:
+            self.valores[chave] = self.valores.get(chave, 0) + valor
+
+    def definir(self, nome, valor, **rotulos):
+        with self.lock:
+            self.valores[(nome, tuple(sorted(rotulos.items())))] = valor
+
+    def observar(self, nome, valor, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self.lock:
+            histograma = self.valores.get(chave)
+            if histograma is None:
+                histograma = self.valores[chave] = [[0] * len(self.faixas), 0.0, 0]
+            for i, limite in enumerate(self.faixas):
+                if valor <= limite:
+                    histograma[0][i] += 1
+            histograma[1] += valor
+            histograma[2] += 1
+
+    def texto_prometheus(self):
+        def escapar(valor):
+            return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def formatar_rotulos(rotulos, extra=()):
+            pares = [f'{chave}="{escapar(valor)}"' for chave, valor in tuple(rotulos) + tuple(extra)]
+            return '{' + ','.join(pares) + '}' if pares else ''
+
+        with self.lock:
+            valores = sorted(self.valores.items(), key=lambda item: item[0])
+        linhas = []
+        for nome, (tipo, ajuda) in self.descricoes.items():
+            linhas.append(f"# HELP {nome} {ajuda}")
+            linhas.append(f"# TYPE {nome} {tipo}")
+            for (nome_do_valor, rotulos), valor in valores:
+                if nome_do_valor != nome:
+                    continue
+                if tipo != 'histogram':
+                    linhas.append(f"{nome}{formatar_rotulos(rotulos)} {valor}")
+                    continue
+                contagens, soma, total = valor
+                for limite, contagem in zip(self.faixas, contagens):
+                    linhas.append(f"{nome}_bucket{formatar_rotulos(rotulos, [('le', limite)])} {contagem}")
+                linhas.append(f"{nome}_bucket{formatar_rotulos(rotulos, [('le', '+Inf')])} {total}")
+                linhas.append(f"{nome}_sum{formatar_rotulos(rotulos)} {round(soma, 6)}")
+                linhas.append(f"{nome}_count{formatar_rotulos(rotulos)} {total}")
+        return '\n'.join(linhas) + '\n'
+
+
+metricas = RegistroDeMetricas()
+metricas.descrever('paleomap_etapa_segundos', 'histogram', 'Duração de cada etapa da construção do dataset.')
+metricas.descrever('paleomap_pbdb_requisicoes_total', 'counter', 'Requisições ao PBDB, por resultado.')
+metricas.descrever('paleomap_pbdb_requisicao_segundos', 'histogram', 'Duração das requisições ao PBDB.')
+metricas.descrever('paleomap_pbdb_bytes_total', 'counter', 'Bytes recebidos do PBDB.')
+metricas.descrever('paleomap_pbdb_tentativas_repetidas_total', 'counter', 'Novas tentativas de lotes do PBDB que falharam.')
+metricas.descrever('paleomap_pbdb_taxons_com_falha_total', 'counter', 'Táxons isolados por fazerem o PBDB falhar.')
+metricas.descrever('paleomap_cache_total', 'counter', 'Acessos ao dataset em memória: hit, stale (expirado) ou miss.')
+metricas.descrever('paleomap_requisicao_segundos', 'histogram', 'Latência das requisições HTTP, por rota.')
+metricas.descrever('paleomap_dataset_ocorrencias', 'gauge', 'Ocorrências na versão publicada do dataset.')
+metricas.descrever('paleomap_dataset_construido_em_segundos', 'gauge', 'Momento (Unix) em que a versão publicada foi construída.')
+metricas.descrever('paleomap_ultima_construcao_segundos', 'gauge', 'Duração da última construção do dataset.')
+
+
+def registrar_evento(evento, **campos):
+    """Log estruturado: uma linha JSON por evento, fácil de filtrar e agregar."""
+    if METRICAS_LOG_ESTRUTURADO:
+        linha = {'ts': datetime.now(timezone.utc).isoformat(timespec='milliseconds'), 'evento': evento, **campos}
+        print(json.dumps(linha, ensure_ascii=False, default=str), flush=True)
+
+
+@contextmanager
+def cronometrar_etapa(etapa, **campos):
+    """Mede a duração de uma etapa do pipeline, registrando o histograma e o evento."""
+    inicio = time.monotonic()
+    sucesso = False
+    try:
+        yield
+        sucesso = True
+    finally:
+        segundos = time.monotonic() - inicio
+        metricas.observar('paleomap_etapa_segundos', segundos, etapa=etapa)
+        registrar_evento('etapa', etapa=etapa, segundos=round(segundos, 3), sucesso=sucesso, **campos)
+
+
+# --- Escrita de Arquivos ---
+
+# umask do processo. os.umask só a lê trocando o valor, o que não é seguro entre threads: lida uma vez aqui
+MASCARA_DE_PERMISSOES = os.umask(0o022)
+os.umask(MASCARA_DE_PERMISSOES)
+
+
+@contextmanager
+def escrita_atomica(caminho, modo='w', encoding='utf-8'):
+    """
+    Escreve num arquivo temporário e o renomeia por cima de 'caminho' ao final do
+    bloco: quem lê vê o arquivo antigo ou o novo inteiro, nunca uma escrita pela metade.
+    """
+    pasta = os.path.dirname(os.path.abspath(caminho))
+    descritor, caminho_temporario = tempfile.mkstemp(prefix=f".{os.path.basename(caminho)}.", suffix='.tmp', dir=pasta)
+    try:
+        with open(descritor, modo, encoding=None if 'b' in modo else encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp cria o arquivo com modo 0600; o destino fica com as permissões de um open() comum
+        os.chmod(caminho_temporario, 0o666 & ~MASCARA_DE_PERMISSOES)
+        os.replace(caminho_temporario, caminho)
+    except BaseException:
+        try:
+            os.remove(caminho_temporario)
+        except OSError:
+            pass
+        raise
+    # Garante que a renomeação em si também chegue ao disco
+    if hasattr(os, 'O_DIRECTORY'):
+        descritor_da_pasta = os.open(pasta, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(descritor_da_pasta)
+        finally:
+            os.close(descritor_da_pasta)
+
+
+class TravaDeArquivo:
+    """
+    Trava exclusiva entre processos baseada em um arquivo (flock no
+    Linux/macOS, msvcrt no Windows). O sistema operacional a libera sozinho se
+    o processo morrer, então uma reconstrução interrompida não deixa a trava presa.
+    """
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.arquivo = None
+
+    def __enter__(self):
+        self.arquivo = open(self.caminho, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self.arquivo.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    self.arquivo.seek(0)
+                    msvcrt.locking(self.arquivo.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(1)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.arquivo.fileno(), fcntl.LOCK_UN)
+            else:
+                self.arquivo.seek(0)
+                msvcrt.locking(self.arquivo.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.arquivo.close()
+            self.arquivo = None
+
+
 # --- Lógica de Processamento de Dados ---
 
 MAPEAMENTO_DE_ERAS = {
@@ -383,11 +664,155 @@ MAPEAMENTO_DE_ERAS = {
     'hsandagolian	': 'paleogeno'
 };
 
+# Tabela normalizada (minúsculas, sem espaços extras) para a busca por nome.
+# Sem isso, chaves como 'Parkinsoni', 'MN 17' ou 'Ruscinian\t' nunca casavam.
+MAPEAMENTO_DE_ERAS_NORMALIZADO = {' '.join(nome.lower().split()): periodo for nome, periodo in MAPEAMENTO_DE_ERAS.items()}
+MAIOR_NOME_DE_ERA = max(len(nome.split()) for nome in MAPEAMENTO_DE_ERAS_NORMALIZADO)
+
+# Limites dos períodos em M.A., do mais recente ao mais antigo. São os mesmos
+# valores de 'periodosGeologicos' em filters.js, para o mapa e o slider concordarem.
+LIMITES_DOS_PERIODOS = [0, 2.58, 23.03, 66, 145, 201.3, 251.9, 298.9, 358.9, 419.2, 443.8, 485.4, 541]
+PERIODOS_POR_IDADE = ['quaternario', 'neogeno', 'paleogeno', 'cretaceo', 'jurassico', 'triassico',
+                      'permiano', 'carbonifero', 'devoniano', 'siluriano', 'ordoviciano', 'cambriano']
+
+
+@lru_cache(maxsize=None)
 def get_periodo_principal(era):
+    """
+    Classifica pelo nome do intervalo. Testa primeiro as expressões mais longas
+    do fim do nome ('Stephanian A', 'Late Pleistocene') e depois a última palavra.
+    """
     if not era: return 'outro'
-    palavras = era.split('/')[-1].split()
-    termo_principal = palavras[-1].lower()
-    return MAPEAMENTO_DE_ERAS.get(termo_principal, 'outro')
+    palavras = era.split('/')[-1].lower().split()
+    for inicio in range(max(0, len(palavras) - MAIOR_NOME_DE_ERA), len(palavras)):
+        periodo = MAPEAMENTO_DE_ERAS_NORMALIZADO.get(' '.join(palavras[inicio:]))
+        if periodo:
+            return periodo
+    return 'outro'
+
+
+def _indice_do_periodo(idade, lado):
+    # 'left' para a idade inicial (66 M.A. pertence ao Paleógeno) e 'right'
+    # para a final (66 M.A. pertence ao Cretáceo), como no searchsorted.
+    posicao = bisect_left(LIMITES_DOS_PERIODOS, idade) if lado == 'left' else bisect_right(LIMITES_DOS_PERIODOS, idade)
+    return posicao - 1 if 0 < posicao < len(LIMITES_DOS_PERIODOS) else -1
+
+
+def classificar_periodo(inicio, fim, era):
+    """
+    Resolve o período pelas idades numéricas. Se o intervalo atravessa um
+    limite (ou está fora da tabela), usa o nome do intervalo como alternativa.
+    """
+    indice = _indice_do_periodo(float(inicio), 'left')
+    if indice >= 0 and indice == _indice_do_periodo(float(fim), 'right'):
+        return PERIODOS_POR_IDADE[indice]
+    return get_periodo_principal(era)
+
+
+def classificar_periodos(inicios, fins, eras):
+    """
+    Versão vetorizada de classificar_periodo para colunas inteiras: a busca
+    binária nos limites é feita com numpy.searchsorted quando o numpy está
+    instalado, e só os registros ambíguos passam pela busca por nome.
+    """
+    if np is None:
+        return [classificar_periodo(inicio, fim, era) for inicio, fim, era in zip(inicios, fins, eras)]
+
+    limites = np.asarray(LIMITES_DOS_PERIODOS, dtype=np.float64)
+    indice_inicio = np.searchsorted(limites, np.asarray(inicios, dtype=np.float64), side='left') - 1
+    indice_fim = np.searchsorted(limites, np.asarray(fins, dtype=np.float64), side='right') - 1
+    resolvidos = (indice_inicio == indice_fim) & (indice_inicio >= 0) & (indice_inicio < len(PERIODOS_POR_IDADE))
+
+    nomes = np.asarray(PERIODOS_POR_IDADE + ['outro'], dtype=object)
+    periodos = nomes[np.where(resolvidos, indice_inicio, len(PERIODOS_POR_IDADE))].tolist()
+    for i in np.flatnonzero(~resolvidos).tolist():
+        periodos[i] = get_periodo_principal(eras[i])
+    return periodos
+
+def obter_url_base_imagens():
+    return '/imagens/' if IMAGENS_ESPELHO_LOCAL else URL_BASE_IMAGENS
+
+
+class ResolvedorDeImagens:
+    """
+    Resolve a imagem de cada par (gênero, espécie) uma única vez e a identifica
+    por um id na tabela de imagens (-1 = sem imagem).
+    """
+
+    def __init__(self, imagens_disponiveis, url_base=None):
+        self.nomes = list(imagens_disponiveis)
+        self.ids = {}
+        for i, nome in enumerate(self.nomes):
+            self.ids.setdefault(nome, i)
+        self.url_base = url_base or obter_url_base_imagens()
+        self.memoria = {}
+
+    def resolver(self, nome_base_genero, especie):
+        chave = (nome_base_genero, especie)
+        id_da_imagem = self.memoria.get(chave)
+        if id_da_imagem is None:
+            id_da_imagem = self.memoria[chave] = self._resolver(nome_base_genero, especie)
+        return id_da_imagem
+
+    def _resolver(self, nome_base_genero, especie):
+        # --- Lógica de imagem  ---
+        genero = nome_base_genero.split(' ')[0]
+        if genero and especie:
+            nome_especifico = f"{genero}_{especie}"
+            if nome_especifico in self.ids:
+                return self.ids[nome_especifico]
+        if genero and genero in self.ids:
+            return self.ids[genero]
+        return -1
+
+    def url(self, id_da_imagem):
+        return f"{self.url_base}{self.nomes[id_da_imagem]}.jpg" if id_da_imagem >= 0 else ""
+
+
+def identificador_da_ocorrencia(rec):
+    """
+    Id estável da ocorrência: o número do 'oid' do PBDB ('occ:123' -> 123). Sem
+    oid, usa um hash (negativo, para não colidir) dos campos do registro.
+    """
+    oid = str(rec.get('oid') or '').rpartition(':')[2]
+    if oid.isdigit():
+        return int(oid)
+    chave = json.dumps([rec.get(campo) for campo in CAMPOS_DO_REGISTRO], default=str)
+    return -int(hashlib.sha1(chave.encode('utf-8')).hexdigest()[:13], 16) # 52 bits: exato em JavaScript
+
+
+def limpar_registro(rec, resolvedor_de_imagens, classificar=True):
+    """
+    Limpa um registro bruto da API; retorna o ponto (com o id da imagem em 'imagem') ou
+    None. Com classificar=False, 'periodo' fica para classificar_periodos.
+    """
+    if not all(k in rec and rec[k] is not None for k in ('lat', 'lng', 'eag', 'lag')):
+        return None
+
+    imagem = resolvedor_de_imagens.resolver(rec.get('gnn') or rec.get('tna') or '', rec.get('spn'))
+    
+    # ==========================================================
+    # LÓGICA DE FAMÍLIA 
+    # ==========================================================
+    familia = rec.get('fml')
+    if not familia or familia == 'NO_FAMILY_SPECIFIED':
+        familia = 'Não definido'
+    # ==========================================================
+
+    era = rec.get('oei') or rec.get('oli') or rec.get('pnm')
+
+    return {
+        'id': identificador_da_ocorrencia(rec),
+        'genero': rec.get('tna') or rec.get('gnn') or 'Não identificado',
+        'especie': rec.get('idt', '').split(' ')[1] if ' ' in rec.get('idt', '') else rec.get('spn', ''),
+        'familia': familia, #
+        'formacao': rec.get('sfn') or rec.get('sfm') or 'Não definida',
+        'lat': float(rec['lat']), 'lng': float(rec['lng']),
+        'inicio': rec['eag'], 'fim': rec['lag'],
+        'periodo': classificar_periodo(rec['eag'], rec['lag'], era) if classificar else era,
+        'imagem': imagem
+    }
+
 
 def mapear_e_limpar_dados(records, imagens_disponiveis):
     """
@@ -395,224 +820,2352 @@ def mapear_e_limpar_dados(records, imagens_disponiveis):
     usando uma lógica simplificada e correta para o campo 'familia'.
     """
     dados_limpos = []
-    imagens_set = set(imagens_disponiveis)
+    resolvedor_de_imagens = ResolvedorDeImagens(imagens_disponiveis)
 
     for rec in records:
-        if not all(k in rec and rec[k] is not None for k in ('lat', 'lng', 'eag', 'lag')):
+        ponto_formatado = limpar_registro(rec, resolvedor_de_imagens)
+        if ponto_formatado is None:
             continue
-
-        # --- Lógica de imagem  ---
-        nome_base_genero = rec.get('gnn') or rec.get('tna') or ''
-        genero = nome_base_genero.split(' ')[0]
-        especie = rec.get('spn')
-        nome_final_para_imagem = ''
-        if genero and especie:
-            nome_especifico = f"{genero}_{especie}"
-            if nome_especifico in imagens_set:
-                nome_final_para_imagem = nome_especifico
-        if not nome_final_para_imagem and genero:
-            if genero in imagens_set:
-                nome_final_para_imagem = genero
-        
-        # ==========================================================
-        # LÓGICA DE FAMÍLIA 
-        # ==========================================================
-        familia = rec.get('fml')
-        if not familia or familia == 'NO_FAMILY_SPECIFIED':
-            familia = 'Não definido'
-        # ==========================================================
-
-        ponto_formatado = {
-            'genero': rec.get('tna') or rec.get('gnn') or 'Não identificado',
-            'especie': rec.get('idt', '').split(' ')[1] if ' ' in rec.get('idt', '') else rec.get('spn', ''),
-            'familia': familia, #
-            'formacao': rec.get('sfn') or rec.get('sfm') or 'Não definida',
-            'lat': float(rec['lat']), 'lng': float(rec['lng']),
-            'inicio': rec['eag'], 'fim': rec['lag'],
-            'periodo': get_periodo_principal(rec.get('oei') or rec.get('oli') or rec.get('pnm')),
-            'imagem': f"https://raw.githubusercontent.com/LuksNMDS/mapa-tcc-imagens/main/static/imagens/{nome_final_para_imagem}.jpg" if nome_final_para_imagem else ""
-        }
+        ponto_formatado['imagem'] = resolvedor_de_imagens.url(ponto_formatado['imagem'])
         dados_limpos.append(ponto_formatado)
         
     return dados_limpos
 
 
+def numero_para_json(valor):
+    """Idades inteiras voltam a ser int, como vinham do PBDB (66 e não 66.0)."""
+    return int(valor) if valor.is_integer() else valor
+
+
+class DatasetColunar:
+    """
+    Ocorrências processadas em colunas: arrays numéricos e colunas categóricas
+    codificadas por dicionário. O arquivo (MAGIC, cabeçalho JSON e os arrays
+    alinhados a 8 bytes) é lido via mmap.
+    """
+
+    MAGIC = b'PALEOCOL'
+    VERSAO_DO_FORMATO = 4
+    COLUNAS_NUMERICAS = ('lat', 'lng', 'inicio', 'fim')
+    COLUNAS_CATEGORICAS = ('genero', 'especie', 'familia', 'formacao', 'periodo', 'pais')
+    TIPOS = dict([('id', 'q')] + [(c, 'd') for c in COLUNAS_NUMERICAS] + [(c, 'I') for c in COLUNAS_CATEGORICAS] + [('imagem', 'i'), ('quantidade', 'I')])
+
+    def __init__(self, colunas, dicionarios, imagens, url_base_imagens, mapa=None, estatisticas=None,
+                 histograma_de_idades=None, intervalos_agrupados=None):
+        self.colunas = colunas
+        self.dicionarios = dicionarios
+        self.imagens = imagens
+        self.url_base_imagens = url_base_imagens
+        self.estatisticas = estatisticas or {} # Contagens da construção (duplicadas, agrupadas, ...)
+        # Ocorrências por faixa de 1 M.A., contadas na construção, antes do agrupamento
+        self.histograma_de_idades = histograma_de_idades
+        # Intervalo de cada ocorrência das linhas agrupadas que juntam idades diferentes (ver agrupar_ocorrencias)
+        self.intervalos_agrupados = intervalos_agrupados or {'linhas': [], 'inicios': [], 'fins': [], 'quantidades': []}
+        self.caminho = None # Arquivo de origem, quando carregado do disco
+        self._mapa = mapa # Mantém o mmap aberto enquanto o dataset estiver em uso
+
+    def __len__(self):
+        return len(self.colunas['lat'])
+
+    @classmethod
+    def a_partir_de_registros(cls, records, imagens_disponiveis, url_base_imagens=None,
+                              localizador_de_paises=None, agrupar=False, processos=None):
+        """
+        Limpa os registros brutos direto em colunas, em lotes (num pool de 'processos' quando
+        há mais de um), sem ids repetidos e, com agrupar=True, agrupados.
+        """
+        resolvedor_de_imagens = ResolvedorDeImagens(imagens_disponiveis, url_base_imagens)
+        processos = LIMPEZA_PROCESSOS if processos is None else processos
+        processos = processos or os.cpu_count() or 1
+        registros = iter(records)
+        primeiro_lote = list(islice(registros, LIMPEZA_REGISTROS_POR_LOTE))
+        lotes_brutos = chain([primeiro_lote], iter(lambda: list(islice(registros, LIMPEZA_REGISTROS_POR_LOTE)), []))
+        if processos > 1 and len(primeiro_lote) == LIMPEZA_REGISTROS_POR_LOTE:
+            lotes = limpar_lotes_em_paralelo(lotes_brutos, resolvedor_de_imagens, localizador_de_paises, processos)
+        else:
+            # No próprio processo, as duplicadas já são descartadas dentro de cada lote
+            ids_limpos = set()
+            lotes = (cls.limpar_lote(lote, resolvedor_de_imagens, localizador_de_paises, ids_limpos)
+                     for lote in lotes_brutos)
+
+        colunas = {nome: array(tipo) for nome, tipo in cls.TIPOS.items()}
+        dicionarios = {nome: [] for nome in cls.COLUNAS_CATEGORICAS}
+        codigos = {nome: {} for nome in cls.COLUNAS_CATEGORICAS}
+        ids_vistos = set()
+        duplicadas = 0
+        for colunas_do_lote, dicionarios_do_lote, duplicadas_do_lote in lotes:
+            duplicadas += duplicadas_do_lote
+            manter = []
+            for j, identificador in enumerate(colunas_do_lote['id']):
+                if identificador in ids_vistos:
+                    duplicadas += 1
+                    continue
+                ids_vistos.add(identificador)
+                manter.append(j)
+            for nome in cls.TIPOS:
+                valores = colunas_do_lote[nome]
+                if len(manter) < len(valores):
+                    valores = [valores[j] for j in manter]
+                if nome in codigos:
+                    valores = cls._recodificar(valores, dicionarios_do_lote[nome], dicionarios[nome], codigos[nome])
+                colunas[nome].extend(valores)
+
+        estatisticas = {'ocorrencias': len(colunas['id']), 'duplicadas': duplicadas, 'agrupadas': 0}
+        # Antes do agrupamento: o envelope de idades de um grupo contaria todas as ocorrências em todas as faixas
+        histograma = contar_ocorrencias_por_idade(colunas['inicio'], colunas['fim'], colunas['quantidade'])
+        intervalos_agrupados = None
+        if agrupar:
+            colunas, intervalos_agrupados = cls.agrupar_ocorrencias(colunas)
+            estatisticas['agrupadas'] = estatisticas['ocorrencias'] - len(colunas['id'])
+        return cls(colunas, dicionarios, resolvedor_de_imagens.nomes, resolvedor_de_imagens.url_base,
+                   estatisticas=estatisticas, histograma_de_idades=histograma,
+                   intervalos_agrupados=intervalos_agrupados)
+
+    @classmethod
+    def limpar_lote(cls, records, resolvedor_de_imagens, localizador_de_paises=None, ids_vistos=None):
+        """
+        Limpa um lote em colunas com dicionários próprios, descartando os ids já em
+        'ids_vistos'. Retorna (colunas, dicionarios, duplicadas).
+        """
+        colunas = {nome: array(tipo) for nome, tipo in cls.TIPOS.items()}
+        dicionarios = {nome: [] for nome in cls.COLUNAS_CATEGORICAS}
+        codigos = {nome: {} for nome in cls.COLUNAS_CATEGORICAS}
+        eras = []
+        ids_vistos = set() if ids_vistos is None else ids_vistos
+        duplicadas = 0
+
+        def codificar(nome, valor):
+            codigo = codigos[nome].get(valor)
+            if codigo is None:
+                codigo = codigos[nome][valor] = len(dicionarios[nome])
+                dicionarios[nome].append(valor)
+            colunas[nome].append(codigo)
+
+        for rec in records:
+            ponto = limpar_registro(rec, resolvedor_de_imagens, classificar=False)
+            if ponto is None:
+                continue
+            if ponto['id'] in ids_vistos:
+                duplicadas += 1
+                continue
+            ids_vistos.add(ponto['id'])
+            ponto['pais'] = localizador_de_paises.pais_do_ponto(ponto['lng'], ponto['lat']) if localizador_de_paises else None
+            for nome in cls.COLUNAS_NUMERICAS:
+                colunas[nome].append(float(ponto[nome]))
+            for nome in cls.COLUNAS_CATEGORICAS:
+                if nome != 'periodo':
+                    codificar(nome, ponto[nome])
+            eras.append(ponto['periodo'])
+            colunas['imagem'].append(ponto['imagem'])
+            colunas['id'].append(ponto['id'])
+            colunas['quantidade'].append(1)
+
+        for periodo in classificar_periodos(colunas['inicio'], colunas['fim'], eras):
+            codificar('periodo', periodo)
+        return colunas, dicionarios, duplicadas
+
+    @staticmethod
+    def _recodificar(codigos_do_lote, dicionario_do_lote, dicionario, codigos):
+        """
+        Traduz os códigos de um lote para os do dataset. Os valores novos entram
+        no dicionário na ordem em que aparecem nas linhas, como se o dataset
+        inteiro tivesse sido limpo de uma vez.
+        """
+        traducao = [None] * len(dicionario_do_lote)
+        for c in codigos_do_lote:
+            if traducao[c] is None:
+                valor = dicionario_do_lote[c]
+                codigo = codigos.get(valor)
+                if codigo is None:
+                    codigo = codigos[valor] = len(dicionario)
+                    dicionario.append(valor)
+                traducao[c] = codigo
+        return map(traducao.__getitem__, codigos_do_lote)
+
+    @classmethod
+    def agrupar_ocorrencias(cls, colunas):
+        """
+        Une as linhas do mesmo táxon no mesmo local e período, somando as quantidades. Retorna
+        (colunas, intervalos_agrupados): o intervalo de cada ocorrência das linhas que juntam idades.
+        """
+        chaves = ('lat', 'lng') + cls.COLUNAS_CATEGORICAS + ('imagem',)
+        novas = {nome: array(tipo) for nome, tipo in cls.TIPOS.items()}
+        posicao_do_grupo = {}
+        intervalos_por_grupo = {} # posição do grupo -> {(inicio, fim): quantidade}, só nos grupos com mais de uma linha
+        for i, chave in enumerate(zip(*(colunas[nome] for nome in chaves))):
+            k = posicao_do_grupo.get(chave)
+            if k is None:
+                posicao_do_grupo[chave] = len(novas['id'])
+                for nome in cls.TIPOS:
+                    novas[nome].append(colunas[nome][i])
+                continue
+            intervalos = intervalos_por_grupo.get(k)
+            if intervalos is None:
+                intervalos = intervalos_por_grupo[k] = {(novas['inicio'][k], novas['fim'][k]): novas['quantidade'][k]}
+            intervalo = (colunas['inicio'][i], colunas['fim'][i])
+            intervalos[intervalo] = intervalos.get(intervalo, 0) + colunas['quantidade'][i]
+            novas['quantidade'][k] += colunas['quantidade'][i]
+            novas['inicio'][k] = max(novas['inicio'][k], colunas['inicio'][i])
+            novas['fim'][k] = min(novas['fim'][k], colunas['fim'][i])
+            novas['id'][k] = min(novas['id'][k], colunas['id'][i])
+
+        intervalos_agrupados = {'linhas': [], 'inicios': [], 'fins': [], 'quantidades': []}
+        for k, intervalos in sorted(intervalos_por_grupo.items()):
+            if len(intervalos) == 1:
+                continue # Todas com a mesma idade: o envelope já é exato
+            for (inicio, fim), quantidade in intervalos.items():
+                intervalos_agrupados['linhas'].append(k)
+                intervalos_agrupados['inicios'].append(inicio)
+                intervalos_agrupados['fins'].append(fim)
+                intervalos_agrupados['quantidades'].append(quantidade)
+        return novas, intervalos_agrupados
+
+    def intervalos_das_ocorrencias(self):
+        """
+        (inicios, fins, quantidades) com o intervalo de idades das ocorrências:
+        o de cada linha ou, nas linhas agrupadas que juntam idades diferentes,
+        os intervalos originais do grupo no lugar do envelope.
+        """
+        agrupados = self.intervalos_agrupados
+        colunas = self.colunas
+        if not agrupados['linhas']:
+            return colunas['inicio'], colunas['fim'], colunas['quantidade']
+        substituidas = set(agrupados['linhas'])
+        manter = [i for i in range(len(self)) if i not in substituidas]
+        inicios = array('d', (colunas['inicio'][i] for i in manter))
+        fins = array('d', (colunas['fim'][i] for i in manter))
+        quantidades = array('I', (colunas['quantidade'][i] for i in manter))
+        inicios.extend(agrupados['inicios'])
+        fins.extend(agrupados['fins'])
+        quantidades.extend(agrupados['quantidades'])
+        return inicios, fins, quantidades
+
+    def linha(self, i, imagem_como_id=False):
+        """
+        Retorna a ocorrência i no formato original da API (um dicionário). Com
+        imagem_como_id=True, 'imagem' traz o índice na tabela de imagens (-1 =
+        sem imagem) em vez da URL completa.
+        """
+        c = self.colunas
+        imagem = c['imagem'][i]
+        ponto = {'id': c['id'][i]}
+        ponto.update((nome, self.dicionarios[nome][c[nome][i]]) for nome in ('genero', 'especie', 'familia', 'formacao'))
+        ponto['lat'] = c['lat'][i]
+        ponto['lng'] = c['lng'][i]
+        ponto['inicio'] = numero_para_json(c['inicio'][i])
+        ponto['fim'] = numero_para_json(c['fim'][i])
+        ponto['periodo'] = self.dicionarios['periodo'][c['periodo'][i]]
+        if imagem_como_id:
+            ponto['imagem'] = imagem
+        else:
+            ponto['imagem'] = f"{self.url_base_imagens}{self.imagens[imagem]}.jpg" if imagem >= 0 else ""
+        ponto['pais'] = self.dicionarios['pais'][c['pais'][i]]
+        ponto['quantidade'] = c['quantidade'][i]
+        return ponto
+
+    def iterar_linhas(self, imagem_como_id=False):
+        for i in range(len(self)):
+            yield self.linha(i, imagem_como_id)
+
+    def tabela_de_urls_das_imagens(self):
+        return [f"{self.url_base_imagens}{nome}.jpg" for nome in self.imagens]
+
+    def para_json_colunar(self):
+        """Payload JSON compacto: arrays por coluna mais as tabelas de valores."""
+        return {
+            'total': len(self),
+            'colunas': {nome: list(coluna) for nome, coluna in self.colunas.items()},
+            'dicionarios': self.dicionarios,
+            'imagens': {'url_base': self.url_base_imagens, 'sufixo': '.jpg', 'nomes': self.imagens}
+        }
+
+    def serializar(self):
+        """Gera os bytes do formato binário (o mesmo conteúdo do arquivo)."""
+        deslocamentos = {}
+        posicao = 0
+        for nome in self.TIPOS:
+            deslocamentos[nome] = posicao
+            posicao += len(self.colunas[nome]) * array(self.TIPOS[nome]).itemsize
+            posicao += -posicao % 8
+        cabecalho = json.dumps({
+            'versao': self.VERSAO_DO_FORMATO,
+            'total': len(self),
+            'deslocamentos': deslocamentos,
+            'tipos': self.TIPOS,
+            'dicionarios': self.dicionarios,
+            'imagens': self.imagens,
+            'url_base_imagens': self.url_base_imagens,
+            'estatisticas': self.estatisticas,
+            'histograma_de_idades': self.histograma_de_idades,
+            'intervalos_agrupados': self.intervalos_agrupados
+        }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        cabecalho += b' ' * (-(len(self.MAGIC) + 4 + len(cabecalho)) % 8)
+
+        partes = [self.MAGIC, struct.pack('<I', len(cabecalho)), cabecalho]
+        for nome, tipo in self.TIPOS.items():
+            coluna = array(tipo, self.colunas[nome])
+            if sys.byteorder != 'little':
+                coluna.byteswap()
+            dados = coluna.tobytes()
+            partes.append(dados + b'\0' * (-len(dados) % 8))
+        return b''.join(partes)
+
+    def salvar(self, caminho):
+        with escrita_atomica(caminho, 'wb') as f:
+            f.write(self.serializar())
+
+    @classmethod
+    def carregar(cls, caminho):
+        """Abre o arquivo via mmap; as colunas são memoryviews sobre o arquivo."""
+        with open(caminho, 'rb') as f:
+            mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapa[:len(cls.MAGIC)] != cls.MAGIC:
+            raise ValueError(f"'{caminho}' não é um arquivo de dataset colunar.")
+        inicio = len(cls.MAGIC) + 4
+        tamanho_do_cabecalho, = struct.unpack_from('<I', mapa, len(cls.MAGIC))
+        cabecalho = json.loads(bytes(mapa[inicio:inicio + tamanho_do_cabecalho]))
+        if cabecalho['versao'] != cls.VERSAO_DO_FORMATO:
+            raise ValueError(f"Versão de formato não suportada: {cabecalho['versao']}")
+
+        inicio_dos_dados = inicio + tamanho_do_cabecalho
+        total = cabecalho['total']
+        buffer = memoryview(mapa)
+        colunas = {}
+        for nome, tipo in cabecalho['tipos'].items():
+            deslocamento = inicio_dos_dados + cabecalho['deslocamentos'][nome]
+            tamanho = total * array(tipo).itemsize
+            coluna = buffer[deslocamento:deslocamento + tamanho].cast(tipo)
+            if sys.byteorder != 'little':
+                coluna = array(tipo, coluna)
+                coluna.byteswap()
+            colunas[nome] = coluna
+        dataset = cls(colunas, cabecalho['dicionarios'], cabecalho['imagens'], cabecalho['url_base_imagens'], mapa,
+                      cabecalho.get('estatisticas'), cabecalho.get('histograma_de_idades'),
+                      cabecalho.get('intervalos_agrupados'))
+        dataset.caminho = caminho
+        return dataset
+
+
+_contexto_da_limpeza = None # (resolvedor de imagens, localizador de países) de cada processo de limpeza
+
+
+def _iniciar_processo_de_limpeza(imagens_disponiveis, url_base_imagens, localizador_de_paises):
+    global _contexto_da_limpeza
+    _contexto_da_limpeza = (ResolvedorDeImagens(imagens_disponiveis, url_base_imagens), localizador_de_paises)
+
+
+def _limpar_lote_no_processo(registros):
+    resolvedor_de_imagens, localizador_de_paises = _contexto_da_limpeza
+    return DatasetColunar.limpar_lote(registros, resolvedor_de_imagens, localizador_de_paises)
+
+
+def limpar_lotes_em_paralelo(lotes, resolvedor_de_imagens, localizador_de_paises, processos):
+    """
+    Limpa os lotes num pool de processos e gera os resultados de
+    DatasetColunar.limpar_lote na ordem dos lotes, com no máximo 2 * processos em andamento.
+    """
+    # 'spawn' em todas as plataformas: um fork com as threads do servidor rodando pode travar o filho
+    with ProcessPoolExecutor(max_workers=processos, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_iniciar_processo_de_limpeza,
+                             initargs=(resolvedor_de_imagens.nomes, resolvedor_de_imagens.url_base,
+                                       localizador_de_paises)) as executor:
+        em_andamento = deque()
+        for lote in lotes:
+            em_andamento.append(executor.submit(_limpar_lote_no_processo, lote))
+            if len(em_andamento) >= 2 * processos:
+                yield em_andamento.popleft().result()
+        while em_andamento:
+            yield em_andamento.popleft().result()
+
+
+class LocalizadorDePaises:
+    """
+    Atribui a cada coordenada o código (o 'id' do GeoJSON) do país que a contém,
+    testando só os polígonos registrados na célula da grade do ponto.
+    """
+
+    def __init__(self, geojson, tamanho_da_celula=PAISES_TAMANHO_DA_CELULA):
+        self.tamanho_da_celula = tamanho_da_celula
+        self.nomes = {}
+        self.poligonos = [] # (código, (oeste, sul, leste, norte), anéis)
+        self.grade = {}
+
+        for feature in geojson.get('features', []):
+            codigo = feature.get('id')
+            geometria = feature.get('geometry') or {}
+            if not codigo or geometria.get('type') not in ('Polygon', 'MultiPolygon'):
+                continue
+            self.nomes[codigo] = (feature.get('properties') or {}).get('name', codigo)
+            poligonos = [geometria['coordinates']] if geometria['type'] == 'Polygon' else geometria['coordinates']
+            for aneis in poligonos:
+                xs = [x for x, y in aneis[0]]
+                ys = [y for x, y in aneis[0]]
+                caixa = (min(xs), min(ys), max(xs), max(ys))
+                indice = len(self.poligonos)
+                self.poligonos.append((codigo, caixa, aneis))
+                for cx in range(self._celula(caixa[0]), self._celula(caixa[2]) + 1):
+                    for cy in range(self._celula(caixa[1]), self._celula(caixa[3]) + 1):
+                        self.grade.setdefault((cx, cy), []).append(indice)
+
+    def _celula(self, valor):
+        return int(valor // self.tamanho_da_celula)
+
+    @staticmethod
+    def _dentro_do_anel(x, y, anel):
+        dentro = False
+        j = len(anel) - 1
+        for i in range(len(anel)):
+            xi, yi = anel[i][0], anel[i][1]
+            xj, yj = anel[j][0], anel[j][1]
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                dentro = not dentro
+            j = i
+        return dentro
+
+    def pais_do_ponto(self, lng, lat):
+        """Retorna o código do país que contém o ponto, ou None (ex.: oceano)."""
+        for indice in self.grade.get((self._celula(lng), self._celula(lat)), ()):
+            codigo, (oeste, sul, leste, norte), aneis = self.poligonos[indice]
+            if not (oeste <= lng <= leste and sul <= lat <= norte):
+                continue
+            if self._dentro_do_anel(lng, lat, aneis[0]) and not any(self._dentro_do_anel(lng, lat, buraco) for buraco in aneis[1:]):
+                return codigo
+        return None
+
+
+def carregar_localizador_de_paises():
+    """
+    Carrega o GeoJSON de países da cópia local, baixando-o se faltar ou estiver
+    corrompido. Retorna None se ele não estiver disponível.
+    """
+    try:
+        try:
+            with open(PAISES_GEOJSON_FILENAME, 'r', encoding='utf-8') as f:
+                return LocalizadorDePaises(json.load(f))
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            print(f"AVISO: Cópia local do GeoJSON de países corrompida; baixando de novo. Erro: {e}", flush=True)
+        print(f"Baixando o GeoJSON de países para '{PAISES_GEOJSON_FILENAME}'...", flush=True)
+        response = requests.get(PAISES_GEOJSON_URL, timeout=30)
+        response.raise_for_status()
+        geojson = response.json() # Só grava a cópia local se o download estiver completo
+        with escrita_atomica(PAISES_GEOJSON_FILENAME, 'wb') as f:
+            f.write(response.content)
+        return LocalizadorDePaises(geojson)
+    except (requests.exceptions.RequestException, OSError, ValueError) as e:
+        print(f"AVISO: GeoJSON de países indisponível; as ocorrências ficarão sem país. Erro: {e}", flush=True)
+        return None
+
+
+def extrair_taxon_do_caminho(caminho):
+    """Retorna o nome do táxon de um caminho de imagem, ou None se não for uma imagem .jpg."""
+    if caminho.replace(os.sep, '/').startswith(PATH_TO_IMAGES + '/') and caminho.lower().endswith('.jpg'):
+        return os.path.splitext(os.path.basename(caminho))[0]
+    return None
+
+
+def ler_lista_de_taxons_local(fonte):
+    """
+    Lê a lista de táxons de um checkout local do repositório de imagens ou de
+    um arquivo de manifesto.
+    """
+    if os.path.isdir(fonte):
+        lista_de_taxons = []
+        for pasta, _, arquivos in os.walk(os.path.join(fonte, PATH_TO_IMAGES)):
+            for arquivo in arquivos:
+                taxon_name = extrair_taxon_do_caminho(os.path.relpath(os.path.join(pasta, arquivo), fonte))
+                if taxon_name:
+                    lista_de_taxons.append(taxon_name)
+        return sorted(lista_de_taxons)
+    with open(fonte, 'r', encoding='utf-8') as f:
+        if fonte.lower().endswith('.json'):
+            return list(json.load(f))
+        return [linha.strip() for linha in f if linha.strip()]
+
+
+def carregar_cache_do_github():
+    try:
+        if os.path.exists(GITHUB_CACHE_FILENAME):
+            with open(GITHUB_CACHE_FILENAME, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"AVISO: Não foi possível ler o cache do GitHub. Erro: {e}", flush=True)
+    return {}
+
+
+def salvar_cache_do_github(cache):
+    try:
+        with escrita_atomica(GITHUB_CACHE_FILENAME) as f:
+            json.dump(cache, f, ensure_ascii=False, indent=4)
+    except OSError as e:
+        print(f"AVISO: Falha ao salvar o cache do GitHub. Erro: {e}", flush=True)
+
+
 def obter_lista_de_taxons_do_github():
+    """
+    Retorna os nomes das imagens do repositório, reutilizando a lista salva e revalidando
+    a branch por ETag; a árvore só é baixada de novo se o SHA mudar.
+    """
+    if GITHUB_FONTE_LOCAL:
+        lista_de_taxons = ler_lista_de_taxons_local(GITHUB_FONTE_LOCAL)
+        print(f"SUCESSO: {len(lista_de_taxons)} táxons lidos de '{GITHUB_FONTE_LOCAL}' (modo offline).", flush=True)
+        return lista_de_taxons
+
+    cache = carregar_cache_do_github()
+    if cache and time.time() - cache.get('verificado_em', 0) < GITHUB_REVALIDACAO_MINUTOS * 60:
+        print(f"GITHUB CACHE HIT: {len(cache['taxons'])} táxons (verificados há pouco).", flush=True)
+        return cache['taxons']
+
     try:
-        branch_url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/branches/{GITHUB_BRANCH}"
-        response = requests.get(branch_url, timeout=10)
+        branch_url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/branches/{GITHUB_BRANCH}"
+        headers = {'If-None-Match': cache['etag']} if cache.get('etag') else {}
+        response = requests.get(branch_url, headers=headers, timeout=10)
+        if response.status_code == 304:
+            print(f"GITHUB CACHE HIT: Branch inalterada, {len(cache['taxons'])} táxons reutilizados.", flush=True)
+            cache['verificado_em'] = time.time()
+            salvar_cache_do_github(cache)
+            return cache['taxons']
         response.raise_for_status()
         tree_sha = response.json()['commit']['commit']['tree']['sha']
-        tree_url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/git/trees/{tree_sha}?recursive=1"
-        response = requests.get(tree_url, timeout=10)
-        response.raise_for_status()
-        tree_data = response.json()
-        lista_de_taxons = []
-        for file_info in tree_data['tree']:
-            if file_info['path'].startswith(PATH_TO_IMAGES + '/') and file_info['path'].lower().endswith('.jpg'):
-                filename = os.path.basename(file_info['path'])
-                taxon_name = os.path.splitext(filename)[0]
-                lista_de_taxons.append(taxon_name)
-        print(f"SUCESSO: {len(lista_de_taxons)} táxons lidos do GitHub.", flush=True)
+        etag = response.headers.get('ETag')
+
+        if cache.get('tree_sha') == tree_sha:
+            print(f"GITHUB CACHE HIT: Árvore {tree_sha[:7]} inalterada, {len(cache['taxons'])} táxons reutilizados.", flush=True)
+            lista_de_taxons = cache['taxons']
+        else:
+            tree_url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/git/trees/{tree_sha}?recursive=1"
+            response = requests.get(tree_url, timeout=10)
+            response.raise_for_status()
+            tree_data = response.json()
+            lista_de_taxons = []
+            for file_info in tree_data['tree']:
+                taxon_name = extrair_taxon_do_caminho(file_info['path'])
+                if taxon_name:
+                    lista_de_taxons.append(taxon_name)
+            print(f"SUCESSO: {len(lista_de_taxons)} táxons lidos do GitHub.", flush=True)
+
+        salvar_cache_do_github({'etag': etag, 'tree_sha': tree_sha, 'taxons': lista_de_taxons, 'verificado_em': time.time()})
         return lista_de_taxons
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
         print(f"ERRO DE API GITHUB: {e}", flush=True)
+        if cache.get('taxons'):
+            print(f"AVISO: Usando a última lista conhecida ({len(cache['taxons'])} táxons).", flush=True)
+            return cache['taxons']
         return []
 
-def process_lote_com_erro(problematic_chunk, base_api_url, dados_brutos):
+class LimitadorDeTaxa:
     """
-    Tenta carregar cada táxon individualmente de um lote que falhou criticamente
-    para isolar o nome problemático e salvar os táxons válidos.
+    Token bucket compartilhado entre as threads de busca. Substitui as pausas
+    fixas entre lotes: cada requisição consome uma ficha, e as fichas são
+    repostas a uma taxa constante de 'taxa_por_segundo'.
     """
-    
-    print("\n--- INICIANDO ISOLAMENTO DE ERRO (Taxon por Taxon) ---", flush=True)
-    
-    base_payload = {
+
+    def __init__(self, taxa_por_segundo, capacidade):
+        self.taxa_por_segundo = taxa_por_segundo
+        self.capacidade = capacidade
+        self.fichas = capacidade
+        self.ultima_reposicao = time.monotonic()
+        self.lock = threading.Lock()
+
+    def aguardar(self):
+        """Bloqueia a thread atual até que exista uma ficha disponível."""
+        while True:
+            with self.lock:
+                agora = time.monotonic()
+                decorrido = agora - self.ultima_reposicao
+                self.fichas = min(self.capacidade, self.fichas + decorrido * self.taxa_por_segundo)
+                self.ultima_reposicao = agora
+                if self.fichas >= 1:
+                    self.fichas -= 1
+                    return
+                espera = (1 - self.fichas) / self.taxa_por_segundo
+            time.sleep(espera)
+
+
+def criar_sessao_http(tamanho_do_pool=PBDB_MAX_WORKERS):
+    """
+    Cria uma sessão HTTP com conexões keep-alive reaproveitadas entre as threads.
+    """
+    sessao = requests.Session()
+    adaptador = HTTPAdapter(pool_connections=tamanho_do_pool, pool_maxsize=tamanho_do_pool)
+    sessao.mount('https://', adaptador)
+    sessao.mount('http://', adaptador)
+    return sessao
+
+
+def montar_payload_pbdb(taxons):
+    return {
+        'base_name': ','.join(taxons),
         'show': 'coords,phylo,ident,ages,strat',
         'limit': 'all'
     }
-    
-    for taxon_name in problematic_chunk:
-        # Tenta carregar cada táxon individualmente (chunk_size = 1)
-        base_payload['base_name'] = taxon_name
-        
+
+
+def iterar_registros_json(partes_de_texto):
+    """
+    Lê de forma incremental um documento do PBDB ({"records": [...]}) e gera
+    um registro por vez, sem decodificar o documento inteiro na memória.
+    'partes_de_texto' é um iterável de pedaços de texto do corpo da resposta.
+    """
+    decodificador = json.JSONDecoder()
+    partes = iter(partes_de_texto)
+    buffer = ''
+    posicao = 0
+    fim_do_texto = False
+
+    def ler_mais():
+        nonlocal buffer, posicao, fim_do_texto
+        parte = next(partes, None)
+        if parte is None:
+            fim_do_texto = True
+            return False
+        buffer = buffer[posicao:] + parte
+        posicao = 0
+        return True
+
+    # Procura o início do array de registros
+    while True:
+        inicio = buffer.find('"records"', posicao)
+        if inicio >= 0:
+            colchete = buffer.find('[', inicio)
+            if colchete >= 0:
+                posicao = colchete + 1
+                break
+        if not ler_mais():
+            return
+
+    while True:
+        while posicao < len(buffer) and buffer[posicao] in ' \t\r\n,':
+            posicao += 1
+        if posicao >= len(buffer):
+            if not ler_mais():
+                raise ValueError('Resposta do PBDB terminou no meio da lista de registros.')
+            continue
+        if buffer[posicao] == ']':
+            return
         try:
-            print(f"DEBUG: Tentando carregar táxon individual: {taxon_name}", flush=True)
-            response = requests.get(base_api_url, params=base_payload, timeout=30)
-            response.raise_for_status()
-            
-            # Se deu sucesso, adiciona o dado e continua
-            dados_do_lote = response.json()
-            dados_brutos.extend(dados_do_lote.get('records', []))
-            
-        except requests.exceptions.RequestException as e:
-            # Se falhou, este é o GÊNERO CULPADO
-            print(f"!!! GÊNERO CULPADO IDENTIFICADO: '{taxon_name}' falhou com Erro: {e}. Será IGNORADO.", flush=True)
+            registro, fim = decodificador.raw_decode(buffer, posicao)
+        except json.JSONDecodeError:
+            # Registro incompleto: lê mais um pedaço e tenta de novo
+            if fim_do_texto or not ler_mais():
+                raise
+            continue
+        posicao = fim
+        yield registro
 
-        # Pequena pausa para requisições individuais
-        time.sleep(0.5) 
 
-    print("--- FIM DO ISOLAMENTO DE ERRO ---", flush=True)        
+def reduzir_registro(rec):
+    return {campo: rec[campo] for campo in CAMPOS_DO_REGISTRO if campo in rec}
 
 
-# --- Rotas da Aplicação ---
+def baixar_registros_pbdb(taxons, sessao):
+    """
+    Faz uma requisição ao PBDB e lê a resposta em streaming, mantendo só os
+    campos usados de cada registro. Retorna (registros, tamanho_da_resposta).
+    """
+    inicio = time.monotonic()
+    tamanho = 0
+    try:
+        with sessao.get(PBDB_API_URL, params=montar_payload_pbdb(taxons), timeout=30, stream=True) as response:
+            response.raise_for_status()
+            response.encoding = response.encoding or 'utf-8'
+            def partes():
+                nonlocal tamanho
+                for parte in response.iter_content(chunk_size=PBDB_TAMANHO_DO_BLOCO, decode_unicode=True):
+                    tamanho += len(parte)
+                    yield parte
+            registros = [reduzir_registro(rec) for rec in iterar_registros_json(partes())]
+    except Exception:
+        metricas.incrementar('paleomap_pbdb_requisicoes_total', resultado='erro')
+        raise
+    finally:
+        metricas.observar('paleomap_pbdb_requisicao_segundos', time.monotonic() - inicio)
+        metricas.incrementar('paleomap_pbdb_bytes_total', tamanho)
+    metricas.incrementar('paleomap_pbdb_requisicoes_total', resultado='ok')
+    return registros, tamanho
 
-@app.route('/')
-def home():
+
+def falha_deterministica(erro):
     """
-    Exibe a página da landing page.
+    Um erro 4xx do PBDB (ex.: um nome que ele não aceita) se repete a cada
+    tentativa; timeouts, erros de conexão, respostas 5xx ou truncadas, não.
     """
-    return render_template('landing_page.html')
+    response = getattr(erro, 'response', None)
+    return (isinstance(erro, requests.exceptions.HTTPError) and response is not None
+            and 400 <= response.status_code < 500 and response.status_code not in (408, 429))
 
-@app.route('/mapa/')
-def mapa_fosseis():
-    return render_template('index.html')
+
+def baixar_com_tentativas(taxons, sessao, limitador, tentativas=PBDB_MAX_TENTATIVAS, descricao=None):
+    """
+    Tenta baixar os registros dos táxons até 'tentativas' vezes, parando no
+    primeiro erro determinístico. Retorna (registros, tamanho, segundos,
+    tentativas_feitas, erro); 'erro' é None quando alguma tentativa deu certo.
+    """
+    descricao = descricao or f"{len(taxons)} táxon(s) a partir de '{taxons[0]}'"
+    erro = None
+    for tentativa in range(tentativas):
+        limitador.aguardar()
+        try:
+            print(f"Buscando {descricao}, tentativa {tentativa + 1}...", flush=True)
+            inicio = time.monotonic()
+            registros, tamanho = baixar_registros_pbdb(taxons, sessao)
+            return registros, tamanho, time.monotonic() - inicio, tentativa + 1, None
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"AVISO: Falha na tentativa {tentativa + 1} ({descricao}). Erro: {e}", flush=True)
+            erro = e
+            if falha_deterministica(e):
+                break
+            if tentativa < tentativas - 1:
+                metricas.incrementar('paleomap_pbdb_tentativas_repetidas_total')
+                time.sleep(1)
+    return [], None, None, tentativa + 1, erro
 
 
-@app.route('/api/dados_fosseis/')
-def api_dados_fosseis():
+def process_lote_com_erro(problematic_chunk, sessao, limitador):
     """
-    Endpoint de API que agora inclui uma lógica de cache.
+    Isola por bissecção os táxons que fazem um lote falhar com erro determinístico; metades
+    com erro transitório ficam para a próxima construção.
+    Retorna (registros, taxons_com_falha, taxons_nao_buscados).
     """
-    print("API interna chamada: /api/dados_fosseis/", flush=True)
     
-    # ==========================================================
-    # INÍCIO DA LÓGICA DE CACHE
-    # ==========================================================
-    try:
-        if os.path.exists(CACHE_FILENAME):
-            # Pega a data de modificação tanto do arquivo de cache quanto do script app.py
-            cache_mod_time = datetime.fromtimestamp(os.path.getmtime(CACHE_FILENAME))
-            script_mod_time = datetime.fromtimestamp(os.path.getmtime(__file__))
-
-            # O cache é válido SE:
-            # 1. For mais novo que o tempo máximo definido (ex: 24 horas)
-            # 2. E for mais recente que a última alteração no script app.py
-            is_age_valid = datetime.now() - cache_mod_time < timedelta(hours=CACHE_MAX_AGE_HOURS)
-            is_script_unchanged = cache_mod_time > script_mod_time
-
-            if is_age_valid and is_script_unchanged:
-                print("CACHE HIT: Retornando dados de um cache válido e atualizado.", flush=True)
-                with open(CACHE_FILENAME, 'r', encoding='utf-8') as f:
-                    cached_data = json.load(f)
-                return jsonify(cached_data)
+    print("\n--- INICIANDO ISOLAMENTO DE ERRO (Bissecção) ---", flush=True)
+    
+    registros = []
+    taxons_com_falha = {}  # táxon -> erro
+    taxons_nao_buscados = []
+    pendentes = [problematic_chunk] # Partes que sabidamente falham
+    while pendentes:
+        parte = pendentes.pop()
+        if len(parte) == 1:
+            registros_do_taxon, _, _, _, erro = baixar_com_tentativas(parte, sessao, limitador)
+            if erro is None:
+                registros.extend(registros_do_taxon)
+            elif falha_deterministica(erro):
+                # Se falhou sozinho, este é o GÊNERO CULPADO
+                print(f"!!! GÊNERO CULPADO IDENTIFICADO: '{parte[0]}'. Será IGNORADO.", flush=True)
+                taxons_com_falha[parte[0]] = str(erro)
+            else:
+                taxons_nao_buscados.append(parte[0])
+            continue
+        meio = len(parte) // 2
+        transitorias = []
+        for metade in (parte[:meio], parte[meio:]):
+            registros_da_metade, _, _, _, erro = baixar_com_tentativas(metade, sessao, limitador, tentativas=1)
+            if erro is None:
+                registros.extend(registros_da_metade)
+            elif falha_deterministica(erro):
+                pendentes.append(metade)
             else:
-                # Informa por que o cache está sendo invalidado
-                if not is_age_valid:
-                    print("CACHE INFO: Invalidando cache por antiguidade.", flush=True)
-                if not is_script_unchanged:
-                    print("CACHE INFO: Invalidando cache pois o script 'app.py' foi modificado.", flush=True)
+                transitorias.append(metade)
+        taxons_nao_buscados.extend(taxon for metade in transitorias for taxon in metade)
+        if len(transitorias) == 2:
+            print("AVISO: As duas metades falharam por erros transitórios. Bissecção interrompida.", flush=True)
+            taxons_nao_buscados.extend(taxon for restante in pendentes for taxon in restante)
+            break
 
-    except Exception as e:
-        print(f"AVISO: Não foi possível ler o arquivo de cache. Erro: {e}", flush=True)
-
-    print("CACHE MISS: Buscando novos dados das APIs...", flush=True)
-
-    # Lista Manual, para taxons não listados nas imagens. 
-    lista_de_imagens = obter_lista_de_taxons_do_github()
-    lista_manual = [
-        'Coelodonta', 'Eoraptor', 'Macrauchenia', 'Titanis', 'Kelenken', 
-        'Devincenzia', 'Phorusrhacos', 'Dunkleosteus', 'Indohyus', 'Pakicetus',
-        'Ambulocetus', 'Maiacetus', 'Dorudon'
-    ]
-    lista_final_para_api = sorted(list(set(lista_de_imagens + lista_manual)))
-    print(f"Total de {len(lista_final_para_api)} táxons únicos para buscar.", flush=True)
+    print("--- FIM DO ISOLAMENTO DE ERRO ---", flush=True)
+    return registros, taxons_com_falha, taxons_nao_buscados
 
-    chunk_size = 500
-    dados_brutos = []
-    max_tentativas = 3
-    base_api_url = "https://paleobiodb.org/data1.2/occs/list.json" 
-
-    for i in range(0, len(lista_final_para_api), chunk_size):
-        chunk = lista_final_para_api[i:i+chunk_size]
-        lista_de_taxons_string = ','.join(chunk)
- 
-        payload = {
-            'base_name': lista_de_taxons_string,
-            'show': 'coords,phylo,ident,ages,strat',
-            'limit': 'all'
-        }
 
-        lote_foi_processado_com_sucesso = False
-        
-        for tentativa in range(max_tentativas):
-            try:
-                print(f"Buscando lote {i//chunk_size + 1}, tentativa {tentativa + 1}...", flush=True)
-                response = requests.get(base_api_url, params=payload, timeout=30)
-                response.raise_for_status()
-                
-                dados_do_lote = response.json()
-                dados_brutos.extend(dados_do_lote.get('records', []))
-                lote_foi_processado_com_sucesso = True
-                break
-            except requests.exceptions.RequestException as e:
-                print(f"AVISO: Falha na tentativa {tentativa + 1}. Erro: {e}", flush=True)
-                if tentativa < max_tentativas - 1:
-                    time.sleep(1)
-        
-        if not lote_foi_processado_com_sucesso:
+def buscar_lote_pbdb(numero_do_lote, chunk, sessao, limitador):
+    """
+    Busca um lote de táxons no PBDB, com novas tentativas e isolamento de erro. Retorna
+    (registros, taxons_com_falha, taxons_nao_buscados, tamanho_da_resposta, segundos).
+    """
+    registros, tamanho, segundos, tentativas, erro = baixar_com_tentativas(
+        chunk, sessao, limitador, descricao=f"lote {numero_do_lote} ({len(chunk)} táxons)")
+    if erro is None:
+        registrar_evento('lote_pbdb', lote=numero_do_lote, taxons=len(chunk), registros=len(registros),
+                         bytes=tamanho, segundos=round(segundos, 3), tentativas=tentativas)
+        return registros, {}, [], tamanho, segundos
+
+    if not falha_deterministica(erro):
+        # Com o PBDB fora do ar, dividir o lote só multiplicaria as requisições
+        print(f"ERRO: O lote {numero_do_lote} falhou por erros transitórios; os táxons ficam para a próxima construção.", flush=True)
+        registrar_evento('lote_pbdb_falhou', lote=numero_do_lote, taxons=len(chunk), tentativas=tentativas, erro=str(erro))
+        return [], {}, list(chunk), None, None
+
+    print(f"ERRO CRÍTICO: O Lote {numero_do_lote} falhou. Iniciando isolamento de táxons...", flush=True)
+    registros, falhas, nao_buscados = process_lote_com_erro(chunk, sessao, limitador)
+    metricas.incrementar('paleomap_pbdb_taxons_com_falha_total', len(falhas))
+    registrar_evento('lote_pbdb_isolado', lote=numero_do_lote, taxons=len(chunk), registros=len(registros),
+                     taxons_com_falha=sorted(falhas), taxons_nao_buscados=len(nao_buscados), tentativas=tentativas)
+    return registros, falhas, nao_buscados, None, None
+
 
-            print(f"ERRO CRÍTICO: O Lote {i//chunk_size + 1} falhou. Iniciando isolamento de táxons...", flush=True)
-            process_lote_com_erro(chunk, base_api_url, dados_brutos)
-            # ======================================================================
+class TamanhoAdaptativoDoLote:
+    """
+    Ajusta a quantidade de táxons por requisição a partir do tamanho e da
+    duração das respostas já recebidas, mirando PBDB_LATENCIA_ALVO_SEGUNDOS e
+    PBDB_BYTES_ALVO. Um lote que falha faz o tamanho cair pela metade.
+    """
+
+    def __init__(self, inicial=PBDB_CHUNK_SIZE, minimo=PBDB_CHUNK_MINIMO, maximo=PBDB_CHUNK_SIZE):
+        self.minimo = min(minimo, maximo)
+        self.maximo = maximo
+        self.tamanho = max(self.minimo, min(inicial, maximo))
+
+    def registrar(self, taxons, tamanho_da_resposta, segundos):
+        if tamanho_da_resposta is None:
+            novo = self.tamanho // 2
+        else:
+            fator = min(
+                PBDB_LATENCIA_ALVO_SEGUNDOS / max(segundos, 0.001),
+                PBDB_BYTES_ALVO / max(tamanho_da_resposta, 1)
+            )
+            # Média entre o tamanho atual e o ideal, para não oscilar demais
+            novo = (self.tamanho + int(taxons * fator)) // 2
+        self.tamanho = max(self.minimo, min(novo, self.maximo))
+
+
+def iterar_lotes_pbdb(lista_de_taxons, max_workers=PBDB_MAX_WORKERS):
+    """
+    Busca os táxons no PBDB com um pool de threads, em lotes de tamanho adaptativo, e gera
+    os resultados na ordem dos táxons. No máximo 'max_workers' lotes ficam em andamento
+    ou aguardando consumo, o que limita a memória ao tamanho de alguns lotes.
+    """
+    limitador = LimitadorDeTaxa(PBDB_REQUISICOES_POR_SEGUNDO, PBDB_RAJADA_MAXIMA)
+    tamanho_do_lote = TamanhoAdaptativoDoLote()
 
-        time.sleep(2) # Pausa para evitar sobrecarga no servidor
- 
-    print(f"Carregamento bruto concluído! {len(dados_brutos)} ocorrências recebidas.", flush=True)
+    with criar_sessao_http(max_workers) as sessao, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        em_andamento = deque()
+        posicao = 0
+        numero_do_lote = 0
+        while posicao < len(lista_de_taxons) or em_andamento:
+            while posicao < len(lista_de_taxons) and len(em_andamento) < max_workers:
+                chunk = lista_de_taxons[posicao:posicao + tamanho_do_lote.tamanho]
+                posicao += len(chunk)
+                numero_do_lote += 1
+                futuro = executor.submit(buscar_lote_pbdb, numero_do_lote, chunk, sessao, limitador)
+                em_andamento.append((chunk, futuro))
+            chunk, futuro = em_andamento.popleft()
+            registros, falhas, nao_buscados, tamanho_da_resposta, segundos = futuro.result()
+            tamanho_do_lote.registrar(len(chunk), tamanho_da_resposta, segundos)
+            yield chunk, registros, falhas, nao_buscados
 
 
-    dados_processados = mapear_e_limpar_dados(dados_brutos, lista_de_imagens)
-    print(f"Processamento concluído! {len(dados_processados)} ocorrências válidas.", flush=True)
+def carregar_denylist():
+    """
+    Táxons que já fizeram o PBDB falhar sozinhos com erro determinístico:
+    {taxon: {'falhou_em': ..., 'erro': ..., 'falhas': ...}}, onde 'falhas' conta
+    as construções seguidas em que isso aconteceu.
+    """
+    try:
+        if os.path.exists(TAXON_DENYLIST_FILENAME):
+            with open(TAXON_DENYLIST_FILENAME, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"AVISO: Não foi possível ler a lista de táxons bloqueados. Erro: {e}", flush=True)
+    return {}
+
 
-    response_data = { 'dados_processados': dados_processados }
+def salvar_denylist(denylist):
     try:
-        with open(CACHE_FILENAME, 'w', encoding='utf-8') as f:
-            json.dump(response_data, f, ensure_ascii=False, indent=4)
-        print(f"CACHE WRITE: Novos dados salvos em '{CACHE_FILENAME}'.", flush=True)
-    except Exception as e:
-        print(f"AVISO: Falha ao salvar os dados no arquivo de cache. Erro: {e}", flush=True)
-    
-    return jsonify(response_data)
+        with escrita_atomica(TAXON_DENYLIST_FILENAME) as f:
+            json.dump(denylist, f, ensure_ascii=False, indent=4)
+    except OSError as e:
+        print(f"AVISO: Falha ao salvar a lista de táxons bloqueados. Erro: {e}", flush=True)
+
+
+def normalizar_nome_de_taxon(nome):
+    return ' '.join(nome.replace('_', ' ').lower().split())
+
+
+def distribuir_registros_por_taxon(chunk, registros):
+    """
+    Atribui cada registro do lote ao táxon que o originou. Os que não casam com nenhum
+    nome (sinônimos, recombinações) ficam com todos os táxons do lote.
+    """
+    por_nome = {}
+    por_genero = {}
+    for taxon in chunk:
+        nome = normalizar_nome_de_taxon(taxon)
+        por_nome.setdefault(nome, taxon)
+        por_genero.setdefault(nome.split(' ')[0], taxon)
+
+    distribuidos = {taxon: [] for taxon in chunk}
+    for rec in registros:
+        nome_aceito = normalizar_nome_de_taxon(rec.get('tna') or '')
+        genero = normalizar_nome_de_taxon(rec.get('gnn') or '') or nome_aceito.split(' ')[0]
+        especie = f"{genero} {rec['spn'].lower()}" if genero and rec.get('spn') else ''
+        taxon = (por_nome.get(especie) or por_nome.get(nome_aceito) or por_nome.get(genero)
+                 or por_genero.get(genero))
+        if taxon is not None:
+            distribuidos[taxon].append(rec)
+        else:
+            for registros_do_taxon in distribuidos.values():
+                registros_do_taxon.append(rec)
+    return distribuidos
+
+
+def iterar_repositorio_de_taxons(caminho=TAXON_STORE_FILENAME):
+    """
+    Lê o repositório por táxon uma linha (um táxon) por vez. Cada linha é
+    {"taxon": ..., "buscado_em": ..., "registros": [...]}, em ordem de táxon.
+    """
+    if not os.path.exists(caminho):
+        return
+    with open(caminho, 'r', encoding='utf-8') as f:
+        for numero, linha in enumerate(f, start=1):
+            try:
+                yield json.loads(linha)
+            except ValueError as e:
+                print(f"AVISO: Linha {numero} do repositório de táxons ignorada. Erro: {e}", flush=True)
+
+
+def atualizar_repositorio_de_taxons(lista_de_taxons):
+    """
+    Busca no PBDB só os táxons novos ou expirados e intercala as entradas novas com as
+    antigas (ambas em ordem de táxon) num novo repositório.
+    """
+    agora = time.time()
+    idade_maxima = TAXON_MAX_AGE_HOURS * 3600
+    datas = {entrada['taxon']: entrada['buscado_em'] for entrada in iterar_repositorio_de_taxons()}
+
+    def expirado(taxon):
+        return taxon not in datas or agora - datas[taxon] > idade_maxima
+
+    # Táxons que falharam em TAXON_FALHAS_PARA_BLOQUEIO construções seguidas são
+    # pulados até o bloqueio expirar; os que falharam menos vezes são tentados de novo
+    denylist = {
+        taxon: info for taxon, info in carregar_denylist().items()
+        if agora - info['falhou_em'] < TAXON_BLOQUEIO_HORAS * 3600
+    }
+    bloqueados = {taxon for taxon, info in denylist.items() if info.get('falhas', 1) >= TAXON_FALHAS_PARA_BLOQUEIO}
+    bloqueados = [taxon for taxon in lista_de_taxons if taxon in bloqueados]
+    if bloqueados:
+        print(f"{len(bloqueados)} táxons bloqueados por falhas anteriores serão pulados.", flush=True)
+
+    pendentes = [taxon for taxon in lista_de_taxons if expirado(taxon) and taxon not in bloqueados]
+    print(f"{len(pendentes)} de {len(lista_de_taxons)} táxons precisam ser buscados no PBDB.", flush=True)
+    if not pendentes:
+        salvar_denylist(denylist)
+        return
+
+    def entradas_novas():
+        for chunk, registros, falhas, nao_buscados in iterar_lotes_pbdb(sorted(pendentes)):
+            for taxon, erro in falhas.items():
+                denylist[taxon] = {'falhou_em': agora, 'erro': f"Falhou mesmo quando buscado sozinho: {erro}",
+                                   'falhas': denylist.get(taxon, {}).get('falhas', 0) + 1}
+            # Os não buscados mantêm a entrada antiga (se houver) e continuam expirados
+            ignorados = set(falhas).union(nao_buscados)
+            for taxon, registros_do_taxon in distribuir_registros_por_taxon(chunk, registros).items():
+                if taxon not in ignorados:
+                    denylist.pop(taxon, None)
+                    yield {'taxon': taxon, 'buscado_em': agora, 'registros': registros_do_taxon}
+
+    # Táxons que saíram da lista são descartados apenas depois de expirarem
+    nomes_atuais = set(lista_de_taxons)
+    def entradas_antigas():
+        for entrada in iterar_repositorio_de_taxons():
+            if entrada['taxon'] in nomes_atuais or not expirado(entrada['taxon']):
+                yield entrada
+
+    # Em caso de empate, a entrada nova (prioridade 0) vence a antiga (1)
+    intercaladas = heapq.merge(
+        ((entrada['taxon'], 0, entrada) for entrada in entradas_novas()),
+        ((entrada['taxon'], 1, entrada) for entrada in entradas_antigas()),
+        key=lambda item: item[:2]
+    )
+    try:
+        ultimo_taxon = None
+        with escrita_atomica(TAXON_STORE_FILENAME) as f:
+            for taxon, _, entrada in intercaladas:
+                if taxon == ultimo_taxon:
+                    continue
+                ultimo_taxon = taxon
+                f.write(json.dumps(entrada, ensure_ascii=False, separators=(',', ':')) + '\n')
+    except OSError as e:
+        print(f"AVISO: Falha ao salvar o repositório de táxons. Erro: {e}", flush=True)
+    salvar_denylist(denylist)
+
+
+def iterar_registros_dos_taxons(lista_de_taxons):
+    """
+    Gera os registros brutos de todos os táxons da lista a partir do
+    repositório, um táxon por vez e sem ocorrências repetidas.
+    """
+    nomes = set(lista_de_taxons)
+    ids_vistos = set()
+    for entrada in iterar_repositorio_de_taxons():
+        if entrada['taxon'] not in nomes:
+            continue
+        for rec in entrada['registros']:
+            # Sem 'oid', a cópia de um registro guardado em vários táxons só se reconhece pelo conteúdo
+            oid = rec.get('oid') or json.dumps(rec, sort_keys=True)
+            if oid in ids_vistos:
+                continue
+            ids_vistos.add(oid)
+            yield rec
+
+
+# --- Rotas da Aplicação ---
+
+@app.route('/')
+def home():
+    """
+    Exibe a página da landing page.
+    """
+    return render_template('landing_page.html')
+
+@app.route('/mapa/')
+def mapa_fosseis():
+    return render_template('index.html')
+
+
+# Lista Manual, para taxons não listados nas imagens. 
+LISTA_MANUAL_DE_TAXONS = [
+    'Coelodonta', 'Eoraptor', 'Macrauchenia', 'Titanis', 'Kelenken', 
+    'Devincenzia', 'Phorusrhacos', 'Dunkleosteus', 'Indohyus', 'Pakicetus',
+    'Ambulocetus', 'Maiacetus', 'Dorudon'
+]
+
+
+def hash_do_esquema():
+    """Hash de tudo o que determina o conteúdo do dataset; um cache só vale com o mesmo hash."""
+    esquema = {
+        'formato': DatasetColunar.VERSAO_DO_FORMATO,
+        'limpeza': VERSAO_DA_LIMPEZA,
+        'eras': MAPEAMENTO_DE_ERAS,
+        'limites': LIMITES_DOS_PERIODOS,
+        'campos': CAMPOS_DO_REGISTRO,
+        'lista_manual': sorted(LISTA_MANUAL_DE_TAXONS),
+        'agrupar': AGRUPAR_OCORRENCIAS,
+        'pbdb': PBDB_API_URL,
+        'imagens': obter_url_base_imagens()
+    }
+    texto = json.dumps(esquema, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(texto.encode('utf-8')).hexdigest()[:16]
+
+
+def listar_versoes_do_dataset():
+    """
+    Lista as versões gravadas em CACHE_DIRETORIO, da mais nova para a mais
+    antiga, como (caminho, hash_do_esquema). Os nomes seguem o padrão
+    '<AAAAMMDDTHHMMSSffffff>-<hash>.bin', então a ordem alfabética é a cronológica.
+    """
+    try:
+        nomes = os.listdir(CACHE_DIRETORIO)
+    except OSError:
+        return []
+    versoes = []
+    for nome in sorted(nomes, reverse=True):
+        base, extensao = os.path.splitext(nome)
+        if extensao != '.bin' or base.count('-') != 1:
+            continue
+        versoes.append((os.path.join(CACHE_DIRETORIO, nome), base.split('-')[1]))
+    return versoes
+
+
+def remover_versao_do_dataset(caminho):
+    """Remove o .bin da versão e os formatos serializados gravados ao lado dele."""
+    prefixo = os.path.splitext(os.path.basename(caminho))[0] + '.'
+    nomes = [nome for nome in os.listdir(os.path.dirname(caminho) or '.') if nome.startswith(prefixo)]
+    for nome in sorted(nomes, key=lambda nome: nome.endswith('.bin')): # O .bin por último
+        os.remove(os.path.join(os.path.dirname(caminho), nome))
+
+
+def salvar_versao_do_dataset(dataset):
+    """
+    Grava o dataset como uma nova versão (escrita atômica), junto com os
+    formatos já serializados e comprimidos, e remove as mais antigas,
+    mantendo a atual e mais CACHE_VERSOES_MANTIDAS. Retorna o caminho.
+    """
+    os.makedirs(CACHE_DIRETORIO, exist_ok=True)
+    nome = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{hash_do_esquema()}.bin"
+    caminho = os.path.join(CACHE_DIRETORIO, nome)
+    # Os formatos são gravados antes do .bin: quando os outros processos virem a versão, já estão prontos
+    with cronometrar_etapa('serializacao', ocorrencias=len(dataset)):
+        gravar_respostas_da_versao(dataset, caminho)
+    dataset.salvar(caminho)
+    for caminho_antigo, _ in listar_versoes_do_dataset()[CACHE_VERSOES_MANTIDAS + 1:]:
+        try:
+            remover_versao_do_dataset(caminho_antigo)
+        except OSError as e:
+            # No Windows um arquivo ainda mapeado em memória não pode ser removido
+            print(f"AVISO: Não foi possível remover a versão antiga '{caminho_antigo}'. Erro: {e}", flush=True)
+    return caminho
+
+
+def construir_dados_fosseis():
+    """
+    Executa o pipeline (GitHub + PBDB + limpeza) e grava o resultado no cache.
+    Só os táxons novos ou expirados são buscados no PBDB; os demais vêm do
+    repositório por táxon.
+    """
+    print("CACHE MISS: Atualizando os dados a partir das APIs...", flush=True)
+
+    with cronometrar_etapa('github'):
+        lista_de_imagens = obter_lista_de_taxons_do_github()
+    lista_final_para_api = sorted(list(set(lista_de_imagens + LISTA_MANUAL_DE_TAXONS)))
+    print(f"Total de {len(lista_final_para_api)} táxons únicos para buscar.", flush=True)
+
+    with cronometrar_etapa('pbdb', taxons=len(lista_final_para_api)):
+        atualizar_repositorio_de_taxons(lista_final_para_api)
+    print("Carregamento bruto concluído!", flush=True)
+
+    # Os registros saem do repositório em streaming direto para as colunas
+    with cronometrar_etapa('limpeza'):
+        localizador_de_paises = carregar_localizador_de_paises()
+        dataset = DatasetColunar.a_partir_de_registros(iterar_registros_dos_taxons(lista_final_para_api), lista_de_imagens,
+                                                       localizador_de_paises=localizador_de_paises,
+                                                       agrupar=AGRUPAR_OCORRENCIAS)
+    estatisticas = dataset.estatisticas
+    print(f"Processamento concluído! {estatisticas['ocorrencias']} ocorrências válidas "
+          f"({estatisticas['duplicadas']} duplicadas descartadas, {estatisticas['agrupadas']} agrupadas), "
+          f"{len(dataset)} registros no mapa.", flush=True)
+    registrar_evento('agrupamento', registros=len(dataset), **estatisticas)
+    if not len(dataset):
+        # Ex.: PBDB fora do ar na primeira construção. Melhor continuar servindo a versão anterior
+        raise RuntimeError("Nenhuma ocorrência válida; o dataset vazio não será gravado nem publicado.")
+
+    try:
+        with cronometrar_etapa('gravacao', ocorrencias=len(dataset)):
+            caminho = salvar_versao_do_dataset(dataset)
+        print(f"CACHE WRITE: Novos dados salvos em '{caminho}'.", flush=True)
+        return DatasetColunar.carregar(caminho)
+    except Exception as e:
+        print(f"AVISO: Falha ao salvar os dados no arquivo de cache. Erro: {e}", flush=True)
+
+    return dataset
+
+
+def ler_cache_do_disco():
+    """
+    Lê a versão mais nova do cache, preferindo o esquema atual e pulando as corrompidas.
+    Retorna (dataset, data_de_modificacao, hash_do_esquema) ou None.
+    """
+    esquema = hash_do_esquema()
+    versoes = listar_versoes_do_dataset()
+    versoes.sort(key=lambda versao: versao[1] != esquema) # Ordenação estável: mantém a ordem cronológica
+    for caminho, esquema_da_versao in versoes:
+        try:
+            cache_mod_time = datetime.fromtimestamp(os.path.getmtime(caminho))
+            return DatasetColunar.carregar(caminho), cache_mod_time, esquema_da_versao
+        except Exception as e:
+            print(f"AVISO: Não foi possível ler o arquivo de cache '{caminho}'. Erro: {e}", flush=True)
+    return None
+
+
+def comprimir(corpo, codificacao):
+    """Comprime o corpo na codificação dada ('identity', 'gzip' ou 'br')."""
+    if codificacao == 'gzip':
+        return gzip.compress(corpo, compresslevel=6, mtime=0)
+    if codificacao == 'br':
+        return brotli.compress(corpo, quality=9)
+    return corpo
+
+
+def escolher_codificacao(accept_encodings):
+    for codificacao in ('br', 'gzip'):
+        if codificacao in CODIFICACOES and accept_encodings[codificacao]:
+            return codificacao
+    return 'identity'
+
+
+class RespostaPreSerializada:
+    """
+    Corpo já serializado, pronto para ser enviado sem novo trabalho de parse
+    ou serialização. As versões comprimidas (gzip e, se disponível, brotli)
+    são geradas na primeira requisição que as aceita.
+    """
+
+    def __init__(self, corpo, construido_em, mimetype='application/json'):
+        self.corpo = corpo
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(self.corpo).hexdigest()
+        self.ultima_modificacao = construido_em.astimezone(timezone.utc)
+        self.variantes = {'identity': self.corpo}
+        self.lock = threading.Lock()
+
+    def variante(self, codificacao):
+        with self.lock:
+            if codificacao not in self.variantes:
+                self.variantes[codificacao] = comprimir(self.corpo, codificacao)
+            return self.variantes[codificacao]
+
+    def responder(self):
+        """
+        Monta a resposta HTTP para a requisição atual, com ETag/Last-Modified,
+        negociação de compressão e resposta 304 para requisições condicionais.
+        """
+        codificacao = escolher_codificacao(request.accept_encodings)
+        response = Response(self.variante(codificacao), mimetype=self.mimetype)
+        if codificacao != 'identity':
+            response.headers['Content-Encoding'] = codificacao
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        response.set_etag(f"{self.etag}-{codificacao}")
+        response.last_modified = self.ultima_modificacao
+        return response.make_conditional(request)
+
+
+def serializar_formato_original(dataset):
+    """Gera o JSON no formato original ({'dados_processados': [...]}) a partir das colunas."""
+    linhas = (json.dumps(linha, ensure_ascii=False, separators=(',', ':')) for linha in dataset.iterar_linhas())
+    return ('{"dados_processados":[' + ','.join(linhas) + ']}').encode('utf-8')
+
+
+def serializar_formato_com_indice_de_imagens(dataset):
+    """
+    Mesmo formato de serializar_formato_original, mas 'imagem' é um índice na
+    tabela 'imagens' (lista de URLs), em vez de repetir a URL em cada ocorrência.
+    """
+    linhas = (json.dumps(linha, ensure_ascii=False, separators=(',', ':'))
+              for linha in dataset.iterar_linhas(imagem_como_id=True))
+    imagens = json.dumps(dataset.tabela_de_urls_das_imagens(), ensure_ascii=False, separators=(',', ':'))
+    return ('{"imagens":' + imagens + ',"dados_processados":[' + ','.join(linhas) + ']}').encode('utf-8')
+
+
+def serializar_formato_colunar(dataset):
+    return json.dumps(dataset.para_json_colunar(), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+# formato -> (função que gera o corpo, mimetype)
+FORMATOS_DE_RESPOSTA = {
+    'json': (serializar_formato_original, 'application/json'),
+    'json_indice': (serializar_formato_com_indice_de_imagens, 'application/json'),
+    'colunar': (serializar_formato_colunar, 'application/json'),
+    'binario': (DatasetColunar.serializar, 'application/octet-stream')
+}
+
+
+def caminho_da_variante(caminho_da_versao, formato, codificacao):
+    """
+    Arquivo com o formato já serializado e comprimido, gravado ao lado da versão:
+    '<versão>.<formato>.<codificação>'. O binário sem compressão é o próprio .bin.
+    """
+    if formato == 'binario' and codificacao == 'identity':
+        return caminho_da_versao
+    return f"{os.path.splitext(caminho_da_versao)[0]}.{formato}.{codificacao}"
+
+
+def gravar_variantes(dataset, caminho_da_versao, formato, codificacoes=CODIFICACOES):
+    """Serializa o formato uma vez e grava as codificações que ainda não estão em disco."""
+    faltando = [codificacao for codificacao in codificacoes
+                if not os.path.exists(caminho_da_variante(caminho_da_versao, formato, codificacao))]
+    if not faltando:
+        return
+    gerar, _ = FORMATOS_DE_RESPOSTA[formato]
+    corpo = gerar(dataset)
+    for codificacao in faltando:
+        with escrita_atomica(caminho_da_variante(caminho_da_versao, formato, codificacao), 'wb') as arquivo:
+            arquivo.write(comprimir(corpo, codificacao))
+
+
+def gravar_respostas_da_versao(dataset, caminho_da_versao):
+    """Grava todos os formatos e codificações da versão, para os workers só enviarem os arquivos."""
+    for formato in FORMATOS_DE_RESPOSTA:
+        codificacoes = CODIFICACOES[1:] if formato == 'binario' else CODIFICACOES
+        gravar_variantes(dataset, caminho_da_versao, formato, codificacoes)
+
+
+class RespostaEmDisco:
+    """
+    Um formato do dataset enviado dos arquivos gravados ao lado da versão; os que faltarem
+    são gerados na primeira requisição (ou servidos da memória).
+    """
+
+    def __init__(self, dataset, formato, construido_em, versao):
+        self.dataset = dataset
+        self.formato = formato
+        _, self.mimetype = FORMATOS_DE_RESPOSTA[formato]
+        self.caminho_da_versao = os.path.abspath(dataset.caminho)
+        self.etag = f"{versao}-{formato}"
+        self.construido_em = construido_em
+        self.ultima_modificacao = construido_em.astimezone(timezone.utc)
+        self.em_disco = set()
+        self.em_memoria = None
+        self.lock = threading.Lock()
+
+    def caminho(self, codificacao):
+        return caminho_da_variante(self.caminho_da_versao, self.formato, codificacao)
+
+    def _preparar(self, codificacao):
+        """Garante o arquivo da codificação; retorna False se o formato passou a ser servido da memória."""
+        with self.lock:
+            if self.em_memoria is not None:
+                return False
+            if codificacao in self.em_disco:
+                return True
+            try:
+                gravar_variantes(self.dataset, self.caminho_da_versao, self.formato, (codificacao,))
+                self.em_disco.add(codificacao)
+                return True
+            except OSError as e:
+                print(f"AVISO: Não foi possível gravar o formato '{self.formato}' em disco. Erro: {e}", flush=True)
+                gerar, _ = FORMATOS_DE_RESPOSTA[self.formato]
+                self.em_memoria = RespostaPreSerializada(gerar(self.dataset), self.construido_em, self.mimetype)
+                return False
+
+    def responder(self):
+        codificacao = escolher_codificacao(request.accept_encodings)
+        if not self._preparar(codificacao):
+            return self.em_memoria.responder()
+        response = send_file(self.caminho(codificacao), mimetype=self.mimetype, conditional=True,
+                             etag=f"{self.etag}-{codificacao}", last_modified=self.ultima_modificacao, max_age=None)
+        if codificacao != 'identity':
+            response.headers['Content-Encoding'] = codificacao
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+
+class RespostasSobDemanda(dict):
+    """Dicionário formato -> RespostaPreSerializada que serializa cada formato no primeiro acesso."""
+
+    def __init__(self, dataset, construido_em):
+        super().__init__()
+        self.dataset = dataset
+        self.construido_em = construido_em
+        self.lock = threading.Lock()
+
+    def __missing__(self, formato):
+        gerar, mimetype = FORMATOS_DE_RESPOSTA[formato]
+        with self.lock:
+            if formato not in self:
+                self[formato] = RespostaPreSerializada(gerar(self.dataset), self.construido_em, mimetype)
+            return dict.__getitem__(self, formato)
+
+
+def serializar_respostas(dataset, construido_em, versao):
+    """
+    Respostas de cada formato aceito pela API. Com a versão em disco, os
+    corpos são enviados dos arquivos gravados pelo construtor; sem ela, cada
+    formato é serializado na primeira requisição e mantido na memória.
+    """
+    if dataset.caminho is not None:
+        return {formato: RespostaEmDisco(dataset, formato, construido_em, versao) for formato in FORMATOS_DE_RESPOSTA}
+    return RespostasSobDemanda(dataset, construido_em)
+
+
+class ArvoreDeIntervalos:
+    """
+    Árvore de intervalos centrada sobre as idades [fim, inicio] das linhas, montada sobre
+    os intervalos distintos. Com 'pesos', somar() soma os pesos sem listar as linhas.
+    """
+
+    def __init__(self, inicios, fins, pesos=None):
+        linhas_por_intervalo = {}
+        for i, intervalo in enumerate(zip(inicios, fins)):
+            linhas = linhas_por_intervalo.get(intervalo)
+            if linhas is None:
+                linhas = linhas_por_intervalo[intervalo] = array('I')
+            linhas.append(i)
+        self.inicios = array('d', (inicio for inicio, _ in linhas_por_intervalo))
+        self.fins = array('d', (fim for _, fim in linhas_por_intervalo))
+        self.linhas = list(linhas_por_intervalo.values())
+        if pesos is None:
+            self.pesos = array('Q', (len(linhas) for linhas in self.linhas))
+        else:
+            self.pesos = array('Q', (sum(pesos[i] for i in linhas) for linhas in self.linhas))
+        self.centros = []
+        self.filhos = []
+        self.por_fim = []    # (intervalos, valores de fim) em ordem crescente de fim
+        self.por_inicio = [] # (intervalos, valores de início) em ordem crescente de início
+        # Um intervalo invertido (inicio < fim, dado inconsistente do PBDB) não contém o próprio ponto
+        # médio e impediria a divisão; os poucos que existirem ficam fora da árvore e são conferidos um a um
+        self.invertidos = [k for k in range(len(self.linhas)) if self.inicios[k] < self.fins[k]]
+        invertidos = set(self.invertidos)
+        self.raiz = self._construir([k for k in range(len(self.linhas)) if k not in invertidos])
+
+    def _construir(self, intervalos):
+        if not intervalos:
+            return -1
+        inicios, fins = self.inicios, self.fins
+        meios = sorted((inicios[k] + fins[k]) / 2 for k in intervalos)
+        centro = meios[len(meios) // 2]
+        esquerda, direita, no_centro = [], [], []
+        for k in intervalos:
+            if inicios[k] < centro:
+                esquerda.append(k)
+            elif fins[k] > centro:
+                direita.append(k)
+            else:
+                no_centro.append(k)
+
+        no = len(self.centros)
+        self.centros.append(centro)
+        self.filhos.append(None)
+        ordem = array('I', sorted(no_centro, key=fins.__getitem__))
+        self.por_fim.append((ordem, array('d', (fins[k] for k in ordem))))
+        ordem = array('I', sorted(no_centro, key=inicios.__getitem__))
+        self.por_inicio.append((ordem, array('d', (inicios[k] for k in ordem))))
+        self.filhos[no] = (self._construir(esquerda), self._construir(direita)) # (-1 quando não há filho)
+        return no
+
+    def _expandir(self, intervalos):
+        encontradas = array('I')
+        for k in intervalos:
+            encontradas.extend(self.linhas[k])
+        return sorted(encontradas)
+
+    def sobrepostas(self, idade_maxima=None, idade_minima=None):
+        """
+        Linhas (ordenadas) cujo intervalo tem alguma idade em comum com a janela
+        [idade_minima, idade_maxima]: fim <= idade_maxima e inicio >= idade_minima.
+        Cada nó visitado custa uma busca binária, então o total é O(log n + k).
+        """
+        return self._expandir(self._sobrepostos(idade_maxima, idade_minima))
+
+    def contidas(self, idade_maxima=None, idade_minima=None):
+        """Linhas (ordenadas) com inicio <= idade_maxima e fim >= idade_minima (a regra do slider)."""
+        return self._expandir(self._contidos(idade_maxima, idade_minima))
+
+    def somar(self, regra, idade_maxima=None, idade_minima=None):
+        """Soma dos pesos das linhas de contidas() ('contido') ou de sobrepostas() ('sobreposto')."""
+        buscar = self._contidos if regra == 'contido' else self._sobrepostos
+        return sum(self.pesos[k] for k in buscar(idade_maxima, idade_minima))
+
+    def _sobrepostos(self, idade_maxima, idade_minima):
+        maximo = math.inf if idade_maxima is None else idade_maxima
+        minimo = -math.inf if idade_minima is None else idade_minima
+        encontrados = []
+        pendentes = [self.raiz] if minimo <= maximo else []
+        while pendentes:
+            no = pendentes.pop()
+            if no < 0:
+                continue
+            centro = self.centros[no]
+            esquerda, direita = self.filhos[no]
+            if maximo < centro:
+                ordem, valores = self.por_fim[no]
+                encontrados.extend(ordem[:bisect_right(valores, maximo)])
+                pendentes.append(esquerda)
+            elif minimo > centro:
+                ordem, valores = self.por_inicio[no]
+                encontrados.extend(ordem[bisect_left(valores, minimo):])
+                pendentes.append(direita)
+            else:
+                encontrados.extend(self.por_fim[no][0])
+                pendentes += (esquerda, direita)
+        if minimo <= maximo:
+            encontrados.extend(k for k in self.invertidos if self.fins[k] <= maximo and self.inicios[k] >= minimo)
+        return encontrados
+
+    def _contidos(self, idade_maxima, idade_minima):
+        maximo = math.inf if idade_maxima is None else idade_maxima
+        minimo = -math.inf if idade_minima is None else idade_minima
+        inicios, fins = self.inicios, self.fins
+        encontrados = []
+        pendentes = [self.raiz] if minimo <= maximo else []
+        while pendentes:
+            no = pendentes.pop()
+            if no < 0:
+                continue
+            centro = self.centros[no]
+            esquerda, direita = self.filhos[no]
+            if centro < minimo:
+                pendentes.append(direita)
+            elif centro > maximo:
+                pendentes.append(esquerda)
+            else:
+                ordem, valores = self.por_fim[no]
+                pelo_fim = ordem[bisect_left(valores, minimo):]
+                ordem, valores = self.por_inicio[no]
+                pelo_inicio = ordem[:bisect_right(valores, maximo)]
+                if len(pelo_fim) <= len(pelo_inicio):
+                    encontrados.extend(k for k in pelo_fim if inicios[k] <= maximo)
+                else:
+                    encontrados.extend(k for k in pelo_inicio if fins[k] >= minimo)
+                pendentes += (esquerda, direita)
+        if minimo <= maximo:
+            encontrados.extend(k for k in self.invertidos if inicios[k] <= maximo and fins[k] >= minimo)
+        return encontrados
+
+
+class IndiceDeConsulta:
+    """
+    Índices de uma versão do dataset para /api/dados_fosseis/query: invertidos por coluna
+    categórica, latitude ordenada, árvores de intervalos e trigramas de gênero.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        colunas = dataset.colunas
+
+        self.linhas_por_codigo = {}
+        for nome, valores in dataset.dicionarios.items():
+            listas = [array('I') for _ in valores]
+            for i, codigo in enumerate(colunas[nome]):
+                listas[codigo].append(i)
+            self.linhas_por_codigo[nome] = listas
+
+        self.ordenados = {}
+        for nome in ('lat',):
+            coluna = colunas[nome]
+            ordem = array('I', sorted(range(len(dataset)), key=coluna.__getitem__))
+            self.ordenados[nome] = (ordem, array('d', (coluna[i] for i in ordem)))
+        self.intervalos = ArvoreDeIntervalos(colunas['inicio'], colunas['fim'], colunas['quantidade'])
+        # Para contar ocorrências por idade: nas linhas agrupadas, o intervalo de cada ocorrência, não o envelope
+        if dataset.intervalos_agrupados['linhas']:
+            self.intervalos_das_ocorrencias = ArvoreDeIntervalos(*dataset.intervalos_das_ocorrencias())
+        else:
+            self.intervalos_das_ocorrencias = self.intervalos
+
+        generos = [(nome or '').lower() for nome in dataset.dicionarios['genero']]
+        self.generos_minusculos = generos
+        self.generos_ordenados = sorted((nome, codigo) for codigo, nome in enumerate(generos))
+        self.trigramas = {}
+        for codigo, nome in enumerate(generos):
+            for j in range(len(nome) - 2):
+                self.trigramas.setdefault(nome[j:j + 3], set()).add(codigo)
+
+    def _faixa(self, nome, minimo=None, maximo=None):
+        """Linhas cujo valor da coluna está em [minimo, maximo], via busca binária."""
+        ordem, valores = self.ordenados[nome]
+        inicio = bisect_left(valores, minimo) if minimo is not None else 0
+        fim = bisect_right(valores, maximo) if maximo is not None else len(valores)
+        return ordem[inicio:fim]
+
+    def codigos_de_genero(self, termo, modo='contem'):
+        termo = termo.lower()
+        if modo == 'prefixo':
+            inicio = bisect_left(self.generos_ordenados, (termo,))
+            codigos = set()
+            for nome, codigo in self.generos_ordenados[inicio:]:
+                if not nome.startswith(termo):
+                    break
+                codigos.add(codigo)
+            return codigos
+        if len(termo) < 3:
+            return {codigo for codigo, nome in enumerate(self.generos_minusculos) if termo in nome}
+        candidatos = None
+        for j in range(len(termo) - 2):
+            codigos = self.trigramas.get(termo[j:j + 3], set())
+            candidatos = codigos if candidatos is None else candidatos & codigos
+            if not candidatos:
+                return set()
+        return {codigo for codigo in candidatos if termo in self.generos_minusculos[codigo]}
+
+    def consultar(self, categorias=None, genero=None, modo_genero='contem',
+                  idade_maxima=None, idade_minima=None, bbox=None):
+        """
+        Retorna os ids (ordenados) das linhas que atendem a todos os filtros; bbox é
+        (oeste, sul, leste, norte).
+        """
+        colunas = self.dataset.colunas
+        candidatos = [] # Cada filtro contribui com as linhas que o satisfazem
+        testes = []     # e com um teste para conferir uma linha individual
+
+        for nome, valor in (categorias or {}).items():
+            dicionario = self.dataset.dicionarios[nome]
+            codigos = {codigo for codigo, v in enumerate(dicionario) if v == valor}
+            candidatos.append([i for codigo in codigos for i in self.linhas_por_codigo[nome][codigo]])
+            testes.append(lambda i, c=colunas[nome], codigos=codigos: c[i] in codigos)
+
+        if genero:
+            codigos = self.codigos_de_genero(genero, modo_genero)
+            candidatos.append([i for codigo in codigos for i in self.linhas_por_codigo['genero'][codigo]])
+            testes.append(lambda i, c=colunas['genero'], codigos=codigos: c[i] in codigos)
+
+        if idade_maxima is not None or idade_minima is not None:
+            candidatos.append(self.intervalos.contidas(idade_maxima, idade_minima))
+            testes.append(lambda i, inicio=colunas['inicio'], fim=colunas['fim']:
+                          (idade_maxima is None or inicio[i] <= idade_maxima) and
+                          (idade_minima is None or fim[i] >= idade_minima))
+
+        if bbox is not None:
+            oeste, sul, leste, norte = bbox
+            candidatos.append(self._faixa('lat', sul, norte))
+            testes.append(lambda i, lat=colunas['lat'], lng=colunas['lng']:
+                          sul <= lat[i] <= norte and oeste <= lng[i] <= leste)
+
+        if not candidatos:
+            return list(range(len(self.dataset)))
+        menor = min(candidatos, key=len)
+        return sorted(i for i in menor if all(teste(i) for teste in testes))
+
+
+def tile_para_bbox(z, x, y):
+    """Converte um tile XYZ (Web Mercator) em (oeste, sul, leste, norte)."""
+    n = 2 ** z
+    def latitude(yt):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * yt / n))))
+    return (x / n * 360 - 180, latitude(y + 1), (x + 1) / n * 360 - 180, latitude(y))
+
+
+def intercalar_bits(valor):
+    """Espalha os bits de um inteiro de até 32 bits nas posições pares (código de Morton)."""
+    valor = (valor | (valor << 16)) & 0x0000FFFF0000FFFF
+    valor = (valor | (valor << 8)) & 0x00FF00FF00FF00FF
+    valor = (valor | (valor << 4)) & 0x0F0F0F0F0F0F0F0F
+    valor = (valor | (valor << 2)) & 0x3333333333333333
+    return (valor | (valor << 1)) & 0x5555555555555555
+
+
+class IndiceDeClusters:
+    """
+    Clusters do mapa: as linhas em ordem de Morton das células do zoom máximo, com somas
+    acumuladas, então cada célula de qualquer zoom é um trecho contíguo.
+    """
+
+    def __init__(self, dataset, indice):
+        self.dataset = dataset
+        self.indice = indice
+        self.lock = threading.Lock() # Protege só o cache de tiles
+        self.lock_da_construcao = threading.Lock()
+        self.cache_de_tiles = OrderedDict()
+        self.codigos = None
+
+    def _preparar(self):
+        with self.lock_da_construcao:
+            if self.codigos is not None:
+                return
+            colunas = self.dataset.colunas
+            escala = CLUSTER_CELULAS_POR_TILE * 2 ** CLUSTER_ZOOM_MAXIMO
+            codigos = []
+            for lat, lng in zip(colunas['lat'], colunas['lng']):
+                lat = max(min(lat, 85.0511), -85.0511)
+                seno = math.sin(math.radians(lat))
+                x = (lng + 180) / 360
+                y = 0.5 - math.log((1 + seno) / (1 - seno)) / (4 * math.pi)
+                cx = min(max(int(x * escala), 0), escala - 1)
+                cy = min(max(int(y * escala), 0), escala - 1)
+                codigos.append(intercalar_bits(cx) << 1 | intercalar_bits(cy))
+            ordem = array('I', sorted(range(len(codigos)), key=codigos.__getitem__))
+
+            # Somas acumuladas na ordem de Morton: o trecho [i, j) soma acumulada[j] - acumulada[i]
+            soma_lat, soma_lng, soma_ocorrencias = array('d', [0.0]), array('d', [0.0]), array('Q', [0])
+            lats, lngs, quantidades = colunas['lat'], colunas['lng'], colunas['quantidade']
+            posicoes_por_periodo = [array('I') for _ in self.dataset.dicionarios['periodo']]
+            periodos = colunas['periodo']
+            for posicao, i in enumerate(ordem):
+                soma_lat.append(soma_lat[-1] + lats[i])
+                soma_lng.append(soma_lng[-1] + lngs[i])
+                soma_ocorrencias.append(soma_ocorrencias[-1] + quantidades[i])
+                posicoes_por_periodo[periodos[i]].append(posicao)
+
+            self.ordem = ordem
+            self.soma_lat, self.soma_lng, self.soma_ocorrencias = soma_lat, soma_lng, soma_ocorrencias
+            self.posicoes_por_periodo = [(periodo, posicoes) for periodo, posicoes in enumerate(posicoes_por_periodo)
+                                         if posicoes]
+            self.codigos = array('Q', (codigos[i] for i in ordem))
+
+    def _trecho(self, z, cx, cy):
+        """Posições [inicio, fim) da ordem de Morton ocupadas pela célula (cx, cy) do zoom z."""
+        deslocamento = 2 * (CLUSTER_ZOOM_MAXIMO - z)
+        prefixo = intercalar_bits(cx) << 1 | intercalar_bits(cy)
+        inicio = bisect_left(self.codigos, prefixo << deslocamento)
+        return inicio, bisect_left(self.codigos, (prefixo + 1) << deslocamento, inicio)
+
+    def _clusters_do_tile(self, z, x, y):
+        if z > CLUSTER_ZOOM_MAXIMO:
+            # Zoom alto: devolve os pontos individuais do tile
+            oeste, sul, leste, norte = tile_para_bbox(z, x, y)
+            periodos = self.dataset.dicionarios['periodo']
+            c = self.dataset.colunas
+            return [
+                {'lat': c['lat'][i], 'lng': c['lng'][i], 'total': 1, 'ocorrencias': c['quantidade'][i],
+                 'id': c['id'][i], 'periodo': periodos[c['periodo'][i]]}
+                for i in self.indice.consultar(bbox=(oeste, sul, leste, norte))
+            ]
+        self._preparar()
+        periodos = self.dataset.dicionarios['periodo']
+        clusters = []
+        base_x, base_y = x * CLUSTER_CELULAS_POR_TILE, y * CLUSTER_CELULAS_POR_TILE
+        for cx in range(base_x, base_x + CLUSTER_CELULAS_POR_TILE):
+            for cy in range(base_y, base_y + CLUSTER_CELULAS_POR_TILE):
+                inicio, fim = self._trecho(z, cx, cy)
+                total = fim - inicio
+                if not total:
+                    continue
+                # Período mais frequente na célula (no empate, o de menor código)
+                _, periodo = max((bisect_left(posicoes, fim) - bisect_left(posicoes, inicio), -periodo)
+                                 for periodo, posicoes in self.posicoes_por_periodo)
+                cluster = {
+                    'lat': (self.soma_lat[fim] - self.soma_lat[inicio]) / total,
+                    'lng': (self.soma_lng[fim] - self.soma_lng[inicio]) / total,
+                    'total': total, 'ocorrencias': self.soma_ocorrencias[fim] - self.soma_ocorrencias[inicio],
+                    'periodo': periodos[-periodo]
+                }
+                if total == 1:
+                    cluster['id'] = self.dataset.colunas['id'][self.ordem[inicio]]
+                clusters.append(cluster)
+        return clusters
+
+    def tile(self, z, x, y, construido_em):
+        """Retorna a resposta pré-serializada do tile, usando o cache LRU."""
+        chave = (z, x, y)
+        with self.lock:
+            if chave in self.cache_de_tiles:
+                self.cache_de_tiles.move_to_end(chave)
+                return self.cache_de_tiles[chave]
+        corpo = json.dumps({'z': z, 'x': x, 'y': y, 'clusters': self._clusters_do_tile(z, x, y)},
+                           separators=(',', ':')).encode('utf-8')
+        resposta = RespostaPreSerializada(corpo, construido_em)
+        with self.lock:
+            self.cache_de_tiles[chave] = resposta
+            if len(self.cache_de_tiles) > CLUSTER_TILES_EM_CACHE:
+                self.cache_de_tiles.popitem(last=False)
+        return resposta
+
+
+def montar_facetas(dataset, indice, incluir_ids=False):
+    """
+    Resumo usado pelos controles do mapa: quantidade de ocorrências por
+    período, família, país e formação, e a árvore família -> gêneros. Com
+    incluir_ids=True, traz também os ids das ocorrências de cada gênero.
+    """
+    quantidades = dataset.colunas['quantidade']
+    contagens = {}
+    for nome in ('periodo', 'familia', 'pais', 'formacao'):
+        contagens[nome] = {
+            valor: sum(quantidades[i] for i in linhas)
+            for valor, linhas in zip(dataset.dicionarios[nome], indice.linhas_por_codigo[nome])
+            if valor is not None and linhas
+        }
+
+    generos_por_familia = {}
+    for familia, genero in set(zip(dataset.colunas['familia'], dataset.colunas['genero'])):
+        nome_da_familia = dataset.dicionarios['familia'][familia]
+        if nome_da_familia and nome_da_familia != 'Não definido':
+            generos_por_familia.setdefault(nome_da_familia, []).append(dataset.dicionarios['genero'][genero])
+
+    facetas = {
+        'total': sum(quantidades),
+        'registros': len(dataset),
+        'contagens': contagens,
+        'familias': {familia: sorted(generos) for familia, generos in sorted(generos_por_familia.items())}
+    }
+    if incluir_ids:
+        ids = dataset.colunas['id']
+        facetas['ids_por_genero'] = {
+            genero: [ids[i] for i in linhas]
+            for genero, linhas in zip(dataset.dicionarios['genero'], indice.linhas_por_codigo['genero'])
+            if linhas
+        }
+    return facetas
+
+
+def contar_ocorrencias_por_idade(inicios, fins, quantidades):
+    """
+    Quantidade de ocorrências em cada faixa de 1 M.A. ([k, k + 1)), contando
+    cada ocorrência em todas as faixas que o seu intervalo de idades toca. As
+    idades acima de HISTOGRAMA_IDADE_MAXIMA caem na última faixa.
+    """
+    faixas = HISTOGRAMA_IDADE_MAXIMA
+    diferencas = [0] * (faixas + 1)
+    for inicio, fim, quantidade in zip(inicios, fins, quantidades):
+        menor, maior = min(inicio, fim), max(inicio, fim) # O PBDB às vezes traz as idades invertidas
+        diferencas[min(faixas - 1, max(0, int(menor)))] += quantidade
+        diferencas[min(faixas - 1, max(0, int(maior))) + 1] -= quantidade
+    contagens = []
+    acumulado = 0
+    for diferenca in diferencas[:faixas]:
+        acumulado += diferenca
+        contagens.append(acumulado)
+    return contagens
+
+
+def montar_histograma_de_idades(dataset):
+    """
+    Histograma de idades servido em /api/idades/histograma: o contado na
+    construção ou, nas versões gravadas sem ele (ou com outro número de
+    faixas), recontado a partir dos intervalos das ocorrências.
+    """
+    contagens = dataset.histograma_de_idades
+    if contagens is None or len(contagens) != HISTOGRAMA_IDADE_MAXIMA:
+        contagens = contar_ocorrencias_por_idade(*dataset.intervalos_das_ocorrencias())
+    return {'largura': 1, 'idade_maxima': HISTOGRAMA_IDADE_MAXIMA, 'contagens': contagens}
+
+
+def calcular_delta(antigo, novo):
+    """
+    Retorna (linhas_adicionadas, ids_removidos) de 'antigo' para 'novo', pelo id estável;
+    uma ocorrência alterada aparece nas duas listas.
+    """
+    linha_por_id = {identificador: j for j, identificador in enumerate(antigo.colunas['id'])}
+    adicionadas = []
+    mantidos = set()
+    for i, identificador in enumerate(novo.colunas['id']):
+        j = linha_por_id.get(identificador)
+        if j is not None:
+            linha = novo.linha(i)
+            if linha == antigo.linha(j):
+                mantidos.add(identificador)
+                continue
+            adicionadas.append(linha)
+        else:
+            adicionadas.append(novo.linha(i))
+    removidos = [identificador for identificador in linha_por_id if identificador not in mantidos]
+    return adicionadas, removidos
+
+
+class VersaoDoDataset:
+    """
+    Uma versão publicada do dataset junto com tudo o que é derivado dela
+    (respostas pré-serializadas e índices). É trocada de uma só vez.
+    """
+
+    def __init__(self, dataset, construido_em, esquema=None):
+        self.dataset = dataset
+        self.construido_em = construido_em
+        self.esquema = esquema or hash_do_esquema()
+        # Identificador da versão: o nome do arquivo no repositório de versões
+        self.identificador = os.path.splitext(os.path.basename(dataset.caminho))[0] if dataset.caminho else None
+        self.etag = self.identificador or construido_em.strftime('%Y%m%dT%H%M%S%f')
+        self.respostas = serializar_respostas(dataset, construido_em, self.etag)
+        self.indice = IndiceDeConsulta(dataset)
+        self.clusters = IndiceDeClusters(dataset, self.indice)
+        quantidades = dataset.colunas['quantidade']
+        self.contagem_por_pais = {
+            pais: sum(quantidades[i] for i in linhas)
+            for pais, linhas in zip(dataset.dicionarios['pais'], self.indice.linhas_por_codigo['pais'])
+            if pais is not None
+        }
+        self.deltas = OrderedDict() # versão de origem -> RespostaPreSerializada
+        self.lock_dos_deltas = threading.Lock()
+        self.facetas = RespostaPreSerializada(
+            json.dumps(montar_facetas(dataset, self.indice), ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+            construido_em
+        )
+        self._facetas_com_ids = None
+        self.histograma_de_idades = RespostaPreSerializada(
+            json.dumps(montar_histograma_de_idades(dataset), separators=(',', ':')).encode('utf-8'), construido_em
+        )
+        self.lock_das_facetas = threading.Lock()
+
+    def facetas_com_ids(self):
+        """As facetas com os ids por gênero, montadas só na primeira vez em que são pedidas."""
+        with self.lock_das_facetas:
+            if self._facetas_com_ids is None:
+                facetas = montar_facetas(self.dataset, self.indice, incluir_ids=True)
+                self._facetas_com_ids = RespostaPreSerializada(
+                    json.dumps(facetas, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), self.construido_em
+                )
+            return self._facetas_com_ids
+
+    def delta(self, desde):
+        """
+        Resposta pré-serializada com as ocorrências adicionadas e removidas desde
+        a versão 'desde'. Retorna None se essa versão não estiver mais em disco.
+        """
+        with self.lock_dos_deltas:
+            if desde in self.deltas:
+                self.deltas.move_to_end(desde)
+                return self.deltas[desde]
+            if desde == self.identificador:
+                adicionadas, removidos = [], []
+            else:
+                caminho = next((caminho for caminho, _ in listar_versoes_do_dataset()
+                                if os.path.splitext(os.path.basename(caminho))[0] == desde), None)
+                if caminho is None:
+                    return None
+                try:
+                    antigo = DatasetColunar.carregar(caminho)
+                except (OSError, ValueError) as e:
+                    print(f"AVISO: Não foi possível ler a versão '{desde}'. Erro: {e}", flush=True)
+                    return None
+                adicionadas, removidos = calcular_delta(antigo, self.dataset)
+            corpo = json.dumps({'versao': self.identificador, 'desde': desde,
+                                'adicionados': adicionadas, 'removidos': removidos},
+                               ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            resposta = self.deltas[desde] = RespostaPreSerializada(corpo, self.construido_em)
+            while len(self.deltas) > CACHE_VERSOES_MANTIDAS + 1:
+                self.deltas.popitem(last=False)
+            return resposta
+
+
+class AgendadorDeAtualizacao:
+    """
+    Mantém a última versão válida em memória e a reconstrói numa única thread de fundo,
+    servindo a antiga enquanto isso. Entre processos, só quem obtém a trava de arquivo
+    constrói; os demais carregam a versão gravada.
+    """
+
+    def __init__(self, funcao_de_construcao, caminho_da_trava=CACHE_LOCK_FILENAME):
+        self.funcao_de_construcao = funcao_de_construcao
+        self.trava_entre_processos = TravaDeArquivo(caminho_da_trava)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.versao = None
+        self.ultima_duracao_segundos = None
+        self.ultimo_erro = None
+        self.proxima_verificacao = 0.0
+        self.aquecimento = None
+
+    def _versao_em_disco_mais_nova(self):
+        """
+        Retorna (dataset, data_de_modificacao, esquema) da versão mais nova em
+        disco se ela for válida (esquema atual e dentro do prazo) e diferente
+        da que está publicada; senão None.
+        """
+        cache = ler_cache_do_disco()
+        if cache is None:
+            return None
+        dataset, construido_em, esquema = cache
+        valida = esquema == hash_do_esquema() and datetime.now() - construido_em < timedelta(hours=CACHE_MAX_AGE_HOURS)
+        publicada = self.versao.dataset.caminho if self.versao is not None else None
+        if not valida or dataset.caminho == publicada:
+            return None
+        return cache
+
+    def _executar(self):
+        inicio = time.monotonic()
+        try:
+            with self.trava_entre_processos:
+                # Outro processo pode ter gravado uma versão enquanto esperávamos a trava
+                cache = self._versao_em_disco_mais_nova()
+                if cache is not None:
+                    print(f"CACHE INFO: Usando a versão gravada por outro processo em '{cache[0].caminho}'.", flush=True)
+                    self._publicar(*cache)
+                else:
+                    with cronometrar_etapa('construcao'):
+                        dados = self.funcao_de_construcao()
+                        self._publicar(dados, datetime.now())
+            with self.lock:
+                self.ultimo_erro = None
+        except Exception as e:
+            print(f"ERRO: Falha na reconstrução dos dados. Erro: {e}", flush=True)
+            with self.lock:
+                self.ultimo_erro = str(e)
+        finally:
+            with self.lock:
+                self.ultima_duracao_segundos = round(time.monotonic() - inicio, 3)
+            metricas.definir('paleomap_ultima_construcao_segundos', self.ultima_duracao_segundos)
+
+    def _publicar(self, dados, construido_em, esquema=None):
+        """Serializa e indexa os dados fora do lock e troca a versão servida de uma vez."""
+        with cronometrar_etapa('publicacao', ocorrencias=len(dados)):
+            versao = VersaoDoDataset(dados, construido_em, esquema)
+        with self.lock:
+            self.versao = versao
+
+    def iniciar_atualizacao(self):
+        """
+        Dispara a reconstrução em segundo plano, a menos que uma já esteja em
+        andamento. Retorna a thread responsável pela reconstrução.
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                print("CACHE INFO: Iniciando atualização dos dados em segundo plano.", flush=True)
+                self.thread = threading.Thread(target=self._executar, name='atualizacao-cache', daemon=True)
+                self.thread.start()
+            return self.thread
+
+    def esta_expirado(self):
+        if self.versao is None:
+            return True
+        is_age_valid = datetime.now() - self.versao.construido_em < timedelta(hours=CACHE_MAX_AGE_HOURS)
+        is_schema_unchanged = self.versao.esquema == hash_do_esquema()
+        return not (is_age_valid and is_schema_unchanged)
+
+    def ha_versao_nova_em_disco(self):
+        """
+        Verifica (no máximo a cada CACHE_VERIFICACAO_SEGUNDOS) se outro processo
+        gravou uma versão mais nova que a publicada. Só lista a pasta, sem abrir arquivos.
+        """
+        agora = time.monotonic()
+        if agora < self.proxima_verificacao or self.versao is None:
+            return False
+        self.proxima_verificacao = agora + CACHE_VERIFICACAO_SEGUNDOS
+        esquema = hash_do_esquema()
+        publicada = self.versao.dataset.caminho
+        for caminho, esquema_da_versao in listar_versoes_do_dataset():
+            if esquema_da_versao == esquema:
+                return publicada is None or os.path.basename(caminho) > os.path.basename(publicada)
+        return False
+
+    def _carregar_do_disco(self):
+        with self.lock:
+            cache = ler_cache_do_disco() if self.versao is None else None
+        if cache is not None:
+            self._publicar(*cache)
+
+    def aquecer(self):
+        """
+        Carrega em segundo plano a versão gravada em disco, se houver, para que
+        a requisição dos dados já a encontre pronta. Não reconstrói nada; só
+        a primeira chamada tem efeito.
+        """
+        def carregar():
+            inicio = time.monotonic()
+            self._carregar_do_disco()
+            if self.versao is not None:
+                print(f"CACHE INFO: Versão '{self.versao.dataset.caminho}' carregada em segundo plano "
+                      f"em {time.monotonic() - inicio:.1f}s.", flush=True)
+        with self.lock:
+            if self.aquecimento is not None:
+                return
+            self.aquecimento = threading.Thread(target=carregar, name='aquecimento-cache', daemon=True)
+            self.aquecimento.start()
+
+    def obter_versao(self):
+        """
+        Retorna a versão atual do dataset. Só bloqueia quando ainda não existe
+        nenhum conjunto de dados (nem em memória, nem em disco).
+        """
+        if self.versao is None and self.aquecimento is not None:
+            self.aquecimento.join()
+        if self.versao is None:
+            self._carregar_do_disco()
+
+        if self.versao is None:
+            metricas.incrementar('paleomap_cache_total', resultado='miss')
+            self.iniciar_atualizacao().join()
+        elif self.esta_expirado():
+            metricas.incrementar('paleomap_cache_total', resultado='stale')
+            self.iniciar_atualizacao()
+        else:
+            metricas.incrementar('paleomap_cache_total', resultado='hit')
+            if self.ha_versao_nova_em_disco():
+                self.iniciar_atualizacao()
+        return self.versao
+
+    def status(self):
+        with self.lock:
+            construido_em = self.versao.construido_em if self.versao else None
+            return {
+                'versao': self.versao.identificador if self.versao else None,
+                'estatisticas': self.versao.dataset.estatisticas if self.versao else None,
+                'atualizacao_em_andamento': self.thread is not None and self.thread.is_alive(),
+                'construido_em': construido_em.isoformat() if construido_em else None,
+                'ultima_duracao_segundos': self.ultima_duracao_segundos,
+                'ultimo_erro': self.ultimo_erro
+            }
+
+
+agendador = AgendadorDeAtualizacao(construir_dados_fosseis)
+
+
+@app.before_request
+def aquecer_cache():
+    # Não é feito na importação: 'flask paleomap build', o benchmark.py e os
+    # processos de limpeza também importam este módulo, mas não servem requisições
+    if CACHE_AQUECER_NA_INICIALIZACAO and agendador.aquecimento is None:
+        agendador.aquecer()
+
+
+@app.route('/api/dados_fosseis/')
+def api_dados_fosseis():
+    """
+    Serve o dataset pré-serializado. Parâmetros: formato (json, colunar, binario ou
+    ndjson), imagens=indice, limite/cursor (paginação) e since=<versão> (só as diferenças).
+    """
+    print("API interna chamada: /api/dados_fosseis/", flush=True)
+
+    desde = request.args.get('since')
+    if desde:
+        versao = agendador.obter_versao()
+        if versao is None:
+            return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+        resposta = versao.delta(desde) if versao.identificador else None
+        if resposta is None:
+            return jsonify({'erro': f"A versão '{desde}' não está mais disponível.", 'versao': versao.identificador}), 410
+        return marcar_versao(resposta.responder(), versao)
+
+    formato = request.args.get('formato', 'json')
+    if formato not in ('json', 'colunar', 'binario', 'ndjson'):
+        return jsonify({'erro': f"Formato desconhecido: '{formato}'."}), 400
+    if formato == 'ndjson':
+        versao = agendador.obter_versao()
+        if versao is None:
+            return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+        return marcar_versao(responder_ndjson(versao), versao)
+    if 'limite' in request.args or 'cursor' in request.args:
+        if formato != 'json':
+            return jsonify({'erro': 'A paginação só está disponível no formato json.'}), 400
+        versao = agendador.obter_versao()
+        if versao is None:
+            return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+        return responder_pagina(versao)
+    imagens = request.args.get('imagens', 'url')
+    if imagens not in ('url', 'indice'):
+        return jsonify({'erro': f"Modo de imagens desconhecido: '{imagens}'."}), 400
+    if formato == 'json' and imagens == 'indice':
+        formato = 'json_indice'
+    versao = agendador.obter_versao()
+    if versao is None:
+        return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+    return marcar_versao(versao.respostas[formato].responder(), versao)
+
+
+def responder_ndjson(versao):
+    """
+    Envia as ocorrências como NDJSON em streaming, NDJSON_LINHAS_POR_BLOCO por
+    vez, lendo direto das colunas. Com gzip, cada bloco é comprimido e
+    descarregado (Z_SYNC_FLUSH) na hora, para o cliente poder processá-lo já.
+    """
+    comprimir = bool(request.accept_encodings['gzip'])
+    dataset = versao.dataset
+
+    def gerar():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if comprimir else None # 31 = formato gzip
+        total = len(dataset)
+        for inicio in range(0, total, NDJSON_LINHAS_POR_BLOCO):
+            linhas = (json.dumps(dataset.linha(i), ensure_ascii=False, separators=(',', ':'))
+                      for i in range(inicio, min(inicio + NDJSON_LINHAS_POR_BLOCO, total)))
+            dados = ('\n'.join(linhas) + '\n').encode('utf-8')
+            yield compressor.compress(dados) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else dados
+        if compressor:
+            yield compressor.flush()
+
+    response = Response(stream_with_context(gerar()), mimetype='application/x-ndjson')
+    if comprimir:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{versao.etag}-ndjson{'-gzip' if comprimir else ''}")
+    response.last_modified = versao.construido_em.astimezone(timezone.utc)
+    return response.make_conditional(request)
+
+
+def responder_pagina(versao):
+    """Uma página do formato json, a partir do cursor (versão:posição) recebido."""
+    try:
+        limite = ler_parametro_inteiro('limite', PAGINACAO_LIMITE_PADRAO)
+        if not 1 <= limite <= PAGINACAO_LIMITE_MAXIMO:
+            raise ValueError(f"limite deve estar entre 1 e {PAGINACAO_LIMITE_MAXIMO}")
+        posicao = 0
+        cursor = request.args.get('cursor')
+        if cursor:
+            versao_do_cursor, _, posicao = cursor.rpartition(':')
+            posicao = int(posicao)
+            if posicao < 0:
+                raise ValueError('cursor inválido')
+            if versao_do_cursor != (versao.identificador or ''):
+                return jsonify({'erro': 'O dataset mudou desde o início da paginação.',
+                                'versao': versao.identificador}), 410
+    except ValueError as e:
+        return jsonify({'erro': f"Parâmetro inválido: {e}"}), 400
+
+    total = len(versao.dataset)
+    fim = min(posicao + limite, total)
+    return marcar_versao(jsonify({
+        'total': total,
+        'dados_processados': [versao.dataset.linha(i) for i in range(posicao, fim)],
+        'proximo_cursor': f"{versao.identificador or ''}:{fim}" if fim < total else None
+    }), versao)
+
+
+def marcar_versao(response, versao):
+    if versao.identificador:
+        response.headers['X-Versao-Do-Dataset'] = versao.identificador
+    return response
+
+
+@app.route('/imagens/<path:nome>')
+def servir_imagem(nome):
+    """Serve as imagens do espelho local (IMAGENS_ESPELHO_LOCAL), quando configurado."""
+    if not IMAGENS_ESPELHO_LOCAL:
+        abort(404)
+    return send_from_directory(IMAGENS_ESPELHO_LOCAL, nome, max_age=24 * 3600)
+
+
+def ler_parametro_numerico(nome):
+    valor = request.args.get(nome)
+    return float(valor) if valor not in (None, '') else None
+
+
+def ler_parametro_inteiro(nome, padrao):
+    valor = request.args.get(nome)
+    if valor in (None, ''):
+        return padrao
+    try:
+        return int(valor)
+    except ValueError:
+        raise ValueError(f"{nome} deve ser um número inteiro") from None
+
+
+@app.route('/api/dados_fosseis/query')
+def api_consultar_dados_fosseis():
+    """
+    Filtra as ocorrências pelos índices da versão atual (periodo, familia, pais, genero,
+    inicio/fim, bbox) e retorna uma página (limite, deslocamento) e o total.
+    """
+    versao = agendador.obter_versao()
+    if versao is None:
+        return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+
+    categorias = {}
+    for nome in ('periodo', 'familia', 'pais'):
+        valor = request.args.get(nome)
+        if valor:
+            if nome not in versao.dataset.dicionarios:
+                return jsonify({'erro': f"Filtro '{nome}' não disponível nesta versão dos dados."}), 400
+            categorias[nome] = valor
+
+    modo_genero = request.args.get('genero_modo', 'contem')
+    if modo_genero not in ('contem', 'prefixo'):
+        return jsonify({'erro': f"genero_modo inválido: '{modo_genero}'."}), 400
+
+    try:
+        idade_maxima = ler_parametro_numerico('inicio')
+        idade_minima = ler_parametro_numerico('fim')
+        bbox = request.args.get('bbox')
+        if bbox:
+            bbox = tuple(float(v) for v in bbox.split(','))
+            if len(bbox) != 4:
+                raise ValueError('bbox deve ter 4 valores')
+        limite = ler_parametro_inteiro('limite', PAGINACAO_LIMITE_PADRAO)
+        if not 1 <= limite <= PAGINACAO_LIMITE_MAXIMO:
+            raise ValueError(f"limite deve estar entre 1 e {PAGINACAO_LIMITE_MAXIMO}")
+        deslocamento = ler_parametro_inteiro('deslocamento', 0)
+        if deslocamento < 0:
+            raise ValueError('deslocamento não pode ser negativo')
+    except ValueError as e:
+        return jsonify({'erro': f"Parâmetro inválido: {e}"}), 400
+    if idade_maxima is not None and idade_minima is not None and idade_maxima < idade_minima:
+        idade_maxima, idade_minima = idade_minima, idade_maxima # O slider pode mandar os extremos invertidos
+
+    ids = versao.indice.consultar(
+        categorias, request.args.get('genero', '').strip(), modo_genero,
+        idade_maxima, idade_minima, bbox or None
+    )
+    pagina = ids[deslocamento:deslocamento + limite]
+    return jsonify({
+        'total': len(ids),
+        'dados_processados': [versao.dataset.linha(i) for i in pagina]
+    })
+
+
+@app.route('/api/paises')
+def api_paises():
+    """
+    Lista os países com ocorrências e a quantidade de ocorrências em cada um,
+    calculadas na construção do dataset.
+    """
+    versao = agendador.obter_versao()
+    if versao is None:
+        return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+    return jsonify({'paises': [
+        {'id': pais, 'total': total}
+        for pais, total in sorted(versao.contagem_por_pais.items())
+    ]})
+
+
+@app.route('/api/facets')
+def api_facetas():
+    """
+    Resumo das facetas da versão atual (contagens por período, família, país e
+    formação e a árvore família -> gêneros), montado uma vez por versão.
+    Com ids=1, inclui os ids das ocorrências de cada gênero.
+    """
+    versao = agendador.obter_versao()
+    if versao is None:
+        return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+    resposta = versao.facetas_com_ids() if request.args.get('ids') in ('1', 'true') else versao.facetas
+    return marcar_versao(resposta.responder(), versao)
+
+
+@app.route('/api/idades')
+def api_idades():
+    """
+    Ids das linhas cuja idade cai na janela do slider (regra 'contido' ou 'sobreposto') e
+    o total de ocorrências nela, cada ocorrência agrupada pelo próprio intervalo.
+    """
+    versao = agendador.obter_versao()
+    if versao is None:
+        return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+    regra = request.args.get('regra', 'contido')
+    if regra not in ('contido', 'sobreposto'):
+        return jsonify({'erro': f"regra inválida: '{regra}'."}), 400
+    try:
+        idade_maxima = ler_parametro_numerico('inicio')
+        idade_minima = ler_parametro_numerico('fim')
+    except ValueError as e:
+        return jsonify({'erro': f"Parâmetro inválido: {e}"}), 400
+    if idade_maxima is not None and idade_minima is not None and idade_maxima < idade_minima:
+        idade_maxima, idade_minima = idade_minima, idade_maxima # O slider pode mandar os extremos invertidos
+
+    intervalos = versao.indice.intervalos
+    linhas = (intervalos.contidas if regra == 'contido' else intervalos.sobrepostas)(idade_maxima, idade_minima)
+    ids = versao.dataset.colunas['id']
+    response = jsonify({
+        'total': versao.indice.intervalos_das_ocorrencias.somar(regra, idade_maxima, idade_minima),
+        'registros': len(linhas),
+        'ids': [ids[i] for i in linhas]
+    })
+    return marcar_versao(response, versao)
+
+
+@app.route('/api/idades/histograma')
+def api_histograma_de_idades():
+    """
+    Quantidade de ocorrências por faixa de 1 M.A., calculada uma vez por versão,
+    para o slider mostrar a densidade sem percorrer os registros.
+    """
+    versao = agendador.obter_versao()
+    if versao is None:
+        return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+    return marcar_versao(versao.histograma_de_idades.responder(), versao)
+
+
+@app.route('/api/tiles/<int:z>/<int:x>/<int:y>')
+def api_tile_de_clusters(z, x, y):
+    """Clusters pré-agregados do tile XYZ; acima de CLUSTER_ZOOM_MAXIMO, os pontos individuais."""
+    if z < 0 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({'erro': 'Tile fora dos limites.'}), 400
+    versao = agendador.obter_versao()
+    if versao is None:
+        return jsonify({'erro': 'Os dados ainda não puderam ser construídos.'}), 503
+    return versao.clusters.tile(z, x, y, versao.construido_em).responder()
+
+
+@app.route('/api/dados_fosseis/status')
+def api_status_dados_fosseis():
+    """
+    Informa o estado da atualização do cache e a duração da última reconstrução.
+    """
+    return jsonify(agendador.status())
+
+
+@app.before_request
+def iniciar_cronometro_da_requisicao():
+    g.inicio_da_requisicao = time.perf_counter()
+
+
+@app.after_request
+def registrar_latencia_da_requisicao(response):
+    inicio = g.pop('inicio_da_requisicao', None)
+    if inicio is not None:
+        rota = request.url_rule.rule if request.url_rule is not None else 'desconhecida'
+        metricas.observar('paleomap_requisicao_segundos', time.perf_counter() - inicio, rota=rota, status=response.status_code)
+    return response
+
+
+@app.route('/metrics')
+def api_metricas():
+    """Métricas do pipeline e das requisições no formato texto do Prometheus."""
+    versao = agendador.versao
+    if versao is not None:
+        metricas.definir('paleomap_dataset_ocorrencias', len(versao.dataset))
+        metricas.definir('paleomap_dataset_construido_em_segundos', round(versao.construido_em.timestamp(), 3))
+    return Response(metricas.texto_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+# --- Linha de Comando ---
+
+paleomap_cli = AppGroup('paleomap', help='Manutenção do dataset de fósseis.')
+app.cli.add_command(paleomap_cli)
+
+
+@paleomap_cli.command('build')
+@click.option('--diretorio', default=None, help=f"Pasta onde a versão é gravada (padrão: '{CACHE_DIRETORIO}').")
+@click.option('--forcar', is_flag=True, help='Busca de novo no PBDB todos os táxons, mesmo os que ainda não expiraram.')
+def comando_build(diretorio, forcar):
+    """
+    Constrói e grava uma nova versão do dataset fora do servidor web, sob a mesma trava
+    dos workers.
+
+    Exemplo: flask --app app paleomap build
+    """
+    global CACHE_DIRETORIO, TAXON_MAX_AGE_HOURS
+    if diretorio:
+        CACHE_DIRETORIO = diretorio
+    if forcar:
+        TAXON_MAX_AGE_HOURS = 0
+
+    inicio = time.monotonic()
+    click.echo(f"Construindo o dataset (esquema {hash_do_esquema()})...")
+    with TravaDeArquivo(CACHE_LOCK_FILENAME):
+        dataset = construir_dados_fosseis()
+    if dataset.caminho is None:
+        raise click.ClickException("O dataset foi construído, mas não pôde ser gravado em disco.")
+    click.echo(f"Dataset gravado em '{dataset.caminho}': {len(dataset)} ocorrências, "
+               f"{os.path.getsize(dataset.caminho) / 1024 / 1024:.1f} MB, em {time.monotonic() - inicio:.1f}s.")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,405 @@
+"""
+Benchmark de ponta a ponta do app.py contra o servidor_fake.py, sem acesso à
+rede. Mede:
+
+  - limpeza: mapear_e_limpar_dados e DatasetColunar.a_partir_de_registros
+    com 10 mil, 100 mil e 1 milhão de registros;
+  - escalonamento da limpeza colunar com 1, 2, 4, ... processos;
+  - classificação dos períodos: classificar_periodos (com numpy, se houver)
+    contra classificar_periodo e a busca só pelo nome, registro a registro;
+  - construção fria (GitHub + PBDB + limpeza + gravação) e incremental e,
+    com --falhas ou --taxons-com-erro, uma reconstrução completa com o
+    servidor fake injetando essas falhas;
+  - publicação (índices de uma versão lida do disco);
+  - latência de requisições com o cache quente e vazão com clientes concorrentes;
+  - tamanho dos payloads em cada formato e compressão;
+  - pico de memória (RSS) de cada etapa e dos processos filhos dela.
+
+O ru_maxrss só cresce ao longo da vida do processo, então a limpeza e a
+construção rodam cada medição num processo novo (ver executar_isolado), e o
+pico dos processos de limpeza paralela é medido à parte (RUSAGE_CHILDREN).
+A publicação e as requisições rodam no processo principal, que também
+hospeda o servidor fake.
+
+Tudo roda numa pasta temporária, então os caches reais não são tocados.
+
+Uso:
+    python benchmark.py
+    python benchmark.py --tamanhos 10000,100000 --taxons 500 --clientes 16 --json resultado.json
+    python benchmark.py --processos 1,2,4,8 --registros-paralelos 2000000
+    python benchmark.py --registros-classificacao 1000000
+    python benchmark.py --falhas 0.2 --taxons-com-erro Genero00007,Genero00042
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+import servidor_fake
+
+try:
+    import resource # Pico de memória (Linux/macOS)
+except ImportError:
+    resource = None
+
+PASTA_DO_APP = os.path.dirname(os.path.abspath(__file__))
+
+
+def pico_de_memoria_mb(filhos=False):
+    """
+    Pico de RSS deste processo ou, com filhos=True, do maior processo filho já
+    encerrado (ex.: os do pool de limpeza paralela).
+    """
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_CHILDREN if filhos else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss é em KB no Linux e em bytes no macOS
+    return round(pico / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def cronometrar(funcao, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcao(*args, **kwargs)
+    return resultado, time.perf_counter() - inicio
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def configurar_app(app, url_do_servidor):
+    """Aponta o app.py para o servidor fake e libera o limite de taxa do PBDB."""
+    app.PBDB_API_URL = f"{url_do_servidor}/data1.2/occs/list.json"
+    app.GITHUB_API_URL = url_do_servidor
+    app.PAISES_GEOJSON_URL = f"{url_do_servidor}/paises.geo.json"
+    app.PBDB_REQUISICOES_POR_SEGUNDO = 1000.0
+    app.PBDB_RAJADA_MAXIMA = 1000
+
+
+def _executar_etapa(url_do_servidor, nome_da_funcao, args):
+    import app
+    configurar_app(app, url_do_servidor)
+    return globals()[nome_da_funcao](app, *args)
+
+
+def executar_isolado(url_do_servidor, funcao, *args):
+    """
+    Roda funcao(app, *args) num processo novo e retorna o resultado, para que
+    o pico de memória medido dentro dela seja só o dessa etapa. O processo
+    herda a pasta atual (a temporária) e o sys.path deste.
+    """
+    contexto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=contexto) as executor:
+        return executor.submit(_executar_etapa, url_do_servidor, funcao.__name__, args).result()
+
+
+def picos_de_memoria():
+    return {'pico_rss_mb': pico_de_memoria_mb(), 'pico_rss_filhos_mb': pico_de_memoria_mb(filhos=True)}
+
+
+def registros_sinteticos(app, semente):
+    imagens = servidor_fake.nomes_das_imagens(2000)
+    conjunto = [app.reduzir_registro(rec)
+                for taxon in imagens for rec in servidor_fake.gerar_registros(taxon, 25, semente)]
+    return imagens, conjunto
+
+
+def medir_limpeza(app, tamanho, semente):
+    """
+    Os registros saem de um conjunto fixo de registros sintéticos repetidos em
+    ciclo, para que a geração não domine o tempo medido nem a memória.
+    """
+    imagens, conjunto = registros_sinteticos(app, semente)
+    localizador = app.carregar_localizador_de_paises()
+    registros = lambda: itertools.islice(itertools.cycle(conjunto), tamanho)
+    dados, segundos_lista = cronometrar(app.mapear_e_limpar_dados, registros(), imagens)
+    validos = len(dados)
+    del dados
+    # Num só processo, para comparar com mapear_e_limpar_dados (ver medir_limpeza_paralela)
+    _, segundos_colunar = cronometrar(app.DatasetColunar.a_partir_de_registros, registros(), imagens, processos=1)
+    _, segundos_com_paises = cronometrar(app.DatasetColunar.a_partir_de_registros, registros(), imagens,
+                                         localizador_de_paises=localizador, processos=1)
+    print(f"  {tamanho:>9} registros: mapear_e_limpar_dados {segundos_lista:.2f}s, "
+          f"colunar {segundos_colunar:.2f}s, colunar+países {segundos_com_paises:.2f}s, "
+          f"pico {pico_de_memoria_mb()} MB", flush=True)
+    return {
+        'registros': tamanho,
+        'validos': validos,
+        'mapear_e_limpar_dados_s': round(segundos_lista, 3),
+        'colunar_s': round(segundos_colunar, 3),
+        'colunar_com_paises_s': round(segundos_com_paises, 3),
+        'registros_por_segundo': round(tamanho / segundos_lista),
+        **picos_de_memoria()
+    }
+
+
+def medir_limpeza_paralela(app, tamanho, processos, semente):
+    """
+    Tempo de DatasetColunar.a_partir_de_registros (com países) com 'processos'
+    processos. A assinatura (sha1 do dataset serializado) permite conferir que
+    o resultado é o mesmo com qualquer quantidade de processos.
+    """
+    imagens, conjunto = registros_sinteticos(app, semente)
+    localizador = app.carregar_localizador_de_paises()
+    registros = itertools.islice(itertools.cycle(conjunto), tamanho)
+    dataset, segundos = cronometrar(app.DatasetColunar.a_partir_de_registros, registros, imagens,
+                                    localizador_de_paises=localizador, processos=processos)
+    return {
+        'processos': processos,
+        'registros': tamanho,
+        'segundos': round(segundos, 3),
+        'assinatura': hashlib.sha1(dataset.serializar()).hexdigest(),
+        **picos_de_memoria()
+    }
+
+
+def comparar_limpeza_paralela(resultados):
+    """Aceleração de cada medição em relação à primeira e se o dataset é idêntico ao dela."""
+    referencia = resultados[0]
+    for resultado in resultados:
+        resultado['aceleracao'] = round(referencia['segundos'] / resultado['segundos'], 2)
+        resultado['identico'] = resultado['assinatura'] == referencia['assinatura']
+        print(f"  {resultado['processos']:>3} processos: {resultado['segundos']:.2f}s ({resultado['aceleracao']:.2f}x), "
+              f"pico {resultado['pico_rss_mb']} MB + {resultado['pico_rss_filhos_mb']} MB por processo de limpeza"
+              f"{'' if resultado['identico'] else ' RESULTADO DIFERENTE'}", flush=True)
+    return resultados
+
+
+def medir_classificacao(app, tamanho, semente):
+    """
+    Classificação dos períodos de 'tamanho' registros: a vetorizada (numpy, se
+    instalado), a mesma registro a registro e a antiga, só pelo nome do intervalo.
+    """
+    _, conjunto = registros_sinteticos(app, semente)
+    registros = list(itertools.islice(itertools.cycle(conjunto), tamanho))
+    inicios = [float(rec['eag']) for rec in registros]
+    fins = [float(rec['lag']) for rec in registros]
+    eras = [rec.get('oei') or rec.get('oli') or rec.get('pnm') for rec in registros]
+    del registros
+
+    por_nome = app.get_periodo_principal.__wrapped__ # Sem a memória, como era a busca antiga
+    vetorizada, segundos_vetorizada = cronometrar(app.classificar_periodos, inicios, fins, eras)
+    por_registro, segundos_por_registro = cronometrar(
+        lambda: [app.classificar_periodo(inicio, fim, era) for inicio, fim, era in zip(inicios, fins, eras)])
+    so_pelo_nome, segundos_por_nome = cronometrar(lambda: [por_nome(era) for era in eras])
+    resultado = {
+        'registros': tamanho,
+        'numpy': app.np is not None,
+        'classificar_periodos_s': round(segundos_vetorizada, 3),
+        'classificar_periodo_s': round(segundos_por_registro, 3),
+        'por_nome_s': round(segundos_por_nome, 3),
+        'identico': vetorizada == por_registro,
+        'outro': vetorizada.count('outro'),
+        'outro_por_nome': so_pelo_nome.count('outro')
+    }
+    print(f"  {tamanho} registros: classificar_periodos {segundos_vetorizada:.2f}s "
+          f"({'numpy' if resultado['numpy'] else 'sem numpy'}), classificar_periodo {segundos_por_registro:.2f}s, "
+          f"só pelo nome {segundos_por_nome:.2f}s; 'outro': {resultado['outro']} "
+          f"(só pelo nome: {resultado['outro_por_nome']})"
+          f"{'' if resultado['identico'] else ' RESULTADO DIFERENTE'}", flush=True)
+    return resultado
+
+
+def construir(app, buscar_todos=False):
+    """
+    Uma construção completa do dataset. Com buscar_todos=True, todos os táxons
+    são buscados de novo no PBDB (como se o repositório por táxon tivesse
+    expirado). Uma construção que falha é registrada, não interrompe o benchmark.
+    """
+    if buscar_todos:
+        app.TAXON_MAX_AGE_HOURS = 0
+    erro = None
+    inicio = time.perf_counter()
+    try:
+        ocorrencias = len(app.construir_dados_fosseis())
+    except Exception as e:
+        ocorrencias, erro = None, str(e)
+    return {
+        'segundos': round(time.perf_counter() - inicio, 3),
+        'ocorrencias': ocorrencias,
+        'erro': erro,
+        'taxons_na_denylist': len(app.carregar_denylist()),
+        **picos_de_memoria()
+    }
+
+
+def medir_construcao(app, servidor, probabilidade_de_falha=0.0, taxons_com_erro=()):
+    """
+    Construção fria e incremental e, se houver falhas a injetar, uma
+    reconstrução completa com elas; cada uma num processo novo. Depois,
+    a publicação da versão gravada, no processo principal.
+    """
+    etapas = [('fria', False), ('incremental', False)]
+    if probabilidade_de_falha or taxons_com_erro:
+        etapas.append(('com_falhas', True))
+    resultados = {}
+    for nome, buscar_todos in etapas:
+        if nome == 'com_falhas':
+            servidor.configuracao.probabilidade_de_falha = probabilidade_de_falha
+            servidor.configuracao.taxons_com_erro = set(taxons_com_erro)
+        quantidade_antes = len(servidor.requisicoes)
+        resultado = executar_isolado(servidor.url, construir, buscar_todos)
+        resultado['requisicoes'] = len(servidor.requisicoes) - quantidade_antes
+        resultados[nome] = resultado
+        descricao = (f"  {nome}: {resultado['segundos']:.2f}s ({resultado['requisicoes']} requisições), "
+                     f"{resultado['ocorrencias']} ocorrências, pico {resultado['pico_rss_mb']} MB")
+        if nome == 'com_falhas':
+            descricao += f", {resultado['taxons_na_denylist']} táxons na denylist"
+        if resultado['erro']:
+            descricao += f" ERRO: {resultado['erro']}"
+        print(descricao, flush=True)
+    servidor.configuracao.probabilidade_de_falha = 0.0
+    servidor.configuracao.taxons_com_erro = set()
+
+    cache = app.ler_cache_do_disco()
+    if cache is None:
+        erros = '; '.join(f"{nome}: {resultado['erro']}" for nome, resultado in resultados.items() if resultado['erro'])
+        raise SystemExit(f"Nenhuma construção gravou uma versão válida do dataset ({erros or 'sem erro registrado'}).")
+    dataset, construido_em, esquema = cache
+    versao, segundos = cronometrar(app.VersaoDoDataset, dataset, construido_em, esquema)
+    resultados['publicacao'] = {'segundos': round(segundos, 3), 'ocorrencias': len(dataset),
+                                'pico_rss_mb': pico_de_memoria_mb()}
+    print(f"  publicação {segundos:.2f}s", flush=True)
+    return versao, resultados
+
+
+def medir_payloads(app, versao):
+    """Tamanho de cada formato/codificação, lido dos arquivos gravados ao lado da versão."""
+    tamanhos = {}
+    for formato, resposta in versao.respostas.items():
+        tamanhos[formato] = {codificacao: os.path.getsize(resposta.caminho(codificacao))
+                             for codificacao in app.CODIFICACOES}
+    for formato, variantes in tamanhos.items():
+        descricao = ', '.join(f"{codificacao} {tamanho / 1024:.0f} KB" for codificacao, tamanho in variantes.items())
+        print(f"  {formato}: {descricao}", flush=True)
+    return tamanhos
+
+
+def medir_requisicoes(url, requisicoes, clientes):
+    """Latência sequencial com o cache quente e vazão com clientes concorrentes."""
+    cabecalhos = {'Accept-Encoding': 'gzip'}
+    sessao = requests.Session()
+    sessao.get(url, headers=cabecalhos).raise_for_status() # Garante a versão publicada
+    latencias = []
+    for _ in range(requisicoes):
+        inicio = time.perf_counter()
+        sessao.get(url, headers=cabecalhos).raise_for_status()
+        latencias.append(time.perf_counter() - inicio)
+
+    def cliente(quantidade):
+        sessao_do_cliente = requests.Session()
+        for _ in range(quantidade):
+            sessao_do_cliente.get(url, headers=cabecalhos).raise_for_status()
+
+    por_cliente = max(1, requisicoes // clientes)
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clientes) as executor:
+        list(executor.map(cliente, [por_cliente] * clientes))
+    segundos = time.perf_counter() - inicio
+
+    resultado = {
+        'latencia_p50_ms': round(statistics.median(latencias) * 1000, 2),
+        'latencia_p95_ms': round(percentil(latencias, 95) * 1000, 2),
+        'latencia_p99_ms': round(percentil(latencias, 99) * 1000, 2),
+        'clientes': clientes,
+        'requisicoes_por_segundo': round(por_cliente * clientes / segundos, 1),
+        'pico_rss_mb': pico_de_memoria_mb()
+    }
+    print(f"  p50 {resultado['latencia_p50_ms']} ms, p95 {resultado['latencia_p95_ms']} ms, "
+          f"{resultado['requisicoes_por_segundo']} req/s com {clientes} clientes", flush=True)
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark do pipeline de dados do mapa.')
+    parser.add_argument('--tamanhos', default='10000,100000,1000000', help='Quantidades de registros para a limpeza.')
+    parser.add_argument('--processos', default=','.join(str(2 ** k) for k in range(4) if 2 ** k <= (os.cpu_count() or 1)),
+                        help='Quantidades de processos comparadas na limpeza paralela.')
+    parser.add_argument('--registros-paralelos', type=int, default=1000000,
+                        help='Registros usados na comparação da limpeza paralela.')
+    parser.add_argument('--registros-classificacao', type=int, default=1000000,
+                        help='Registros usados na comparação da classificação dos períodos.')
+    parser.add_argument('--taxons', type=int, default=300, help='Imagens no repositório fake (construção).')
+    parser.add_argument('--registros-por-taxon', type=int, default=100)
+    parser.add_argument('--latencia', type=float, default=0.0, help='Latência simulada do servidor fake (s).')
+    parser.add_argument('--falhas', type=float, default=0.0,
+                        help='Probabilidade (0 a 1) de uma requisição ao PBDB falhar na reconstrução com falhas.')
+    parser.add_argument('--taxons-com-erro', default='',
+                        help='Nomes separados por vírgula que fazem o lote falhar na reconstrução com falhas.')
+    parser.add_argument('--requisicoes', type=int, default=200)
+    parser.add_argument('--clientes', type=int, default=8)
+    parser.add_argument('--json', dest='arquivo_json', default=None, help='Grava os resultados neste arquivo.')
+    args = parser.parse_args()
+
+    configuracao = servidor_fake.ConfiguracaoDoServidor(
+        taxons=args.taxons, registros_por_taxon=args.registros_por_taxon, latencia=args.latencia)
+    servidor = servidor_fake.iniciar_servidor(configuracao=configuracao)
+
+    # Os caches do app são relativos à pasta atual: roda tudo numa pasta temporária
+    pasta = tempfile.mkdtemp(prefix='paleo_benchmark_')
+    pasta_original = os.getcwd()
+    os.chdir(pasta)
+    sys.path.insert(0, PASTA_DO_APP)
+    try:
+        import app
+        configurar_app(app, servidor.url)
+        resultados = {'configuracao': vars(args)}
+
+        print("Limpeza:", flush=True)
+        tamanhos = [int(tamanho) for tamanho in args.tamanhos.split(',') if tamanho]
+        resultados['limpeza'] = [executar_isolado(servidor.url, medir_limpeza, tamanho, configuracao.semente)
+                                 for tamanho in tamanhos]
+
+        print("Limpeza paralela:", flush=True)
+        lista_de_processos = [int(processos) for processos in args.processos.split(',') if processos]
+        resultados['limpeza_paralela'] = comparar_limpeza_paralela([
+            executar_isolado(servidor.url, medir_limpeza_paralela, args.registros_paralelos, processos,
+                             configuracao.semente)
+            for processos in lista_de_processos
+        ])
+
+        print("Classificação dos períodos:", flush=True)
+        resultados['classificacao'] = medir_classificacao(app, args.registros_classificacao, configuracao.semente)
+
+        print("Construção:", flush=True)
+        taxons_com_erro = [nome for nome in args.taxons_com_erro.split(',') if nome]
+        versao, resultados['construcao'] = medir_construcao(app, servidor, args.falhas, taxons_com_erro)
+
+        print("Payloads:", flush=True)
+        resultados['payloads'] = medir_payloads(app, versao)
+        del versao
+
+        print("Requisições:", flush=True)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR) # Sem uma linha de log por requisição
+        servidor_web = make_server('127.0.0.1', 0, app.app, threaded=True)
+        threading.Thread(target=servidor_web.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{servidor_web.server_port}/api/dados_fosseis/"
+        resultados['requisicoes'] = medir_requisicoes(url, args.requisicoes, args.clientes)
+        servidor_web.shutdown()
+    finally:
+        os.chdir(pasta_original)
+        shutil.rmtree(pasta, ignore_errors=True)
+        servidor.shutdown()
+
+    if args.arquivo_json:
+        with open(args.arquivo_json, 'w', encoding='utf-8') as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=4)
+        print(f"Resultados gravados em '{args.arquivo_json}'.", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+Servidor local que imita as partes do PBDB e do GitHub usadas pelo app.py,
+para medir e testar o pipeline sem acessar paleobiodb.org nem api.github.com.
+
+Responde a:
+    GET .../occs/list.json?base_name=A,B,...              (PBDB)
+    GET /repos/<dono>/<repo>/branches/<branch>            (GitHub, com ETag/304)
+    GET /repos/<dono>/<repo>/git/trees/<sha>?recursive=1  (GitHub)
+    GET /paises.geo.json                                  (GeoJSON com "países" retangulares)
+
+Os registros são sintéticos e determinísticos: o mesmo táxon gera sempre os
+mesmos registros. Tamanho, latência e falhas são configuráveis.
+
+Uso:
+    python servidor_fake.py --porta 8765 --taxons 500 --registros-por-taxon 200
+e, no app.py:
+    PBDB_API_URL = "http://127.0.0.1:8765/data1.2/occs/list.json"
+    GITHUB_API_URL = "http://127.0.0.1:8765"
+    PAISES_GEOJSON_URL = "http://127.0.0.1:8765/paises.geo.json"
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Nomes de intervalos reais do PBDB, incluindo alguns que o mapeamento não conhece
+INTERVALOS = (
+    ('Maastrichtian', 72.1, 66.0), ('Campanian', 83.6, 72.1), ('Albian', 113.0, 100.5),
+    ('Late Jurassic', 163.5, 145.0), ('Toarcian', 182.7, 174.1), ('Late Triassic', 237.0, 201.4),
+    ('Guadalupian', 273.01, 259.51), ('Pennsylvanian', 323.2, 298.9), ('Givetian', 387.7, 382.7),
+    ('Wenlock', 433.4, 427.4), ('Darriwilian', 467.3, 458.4), ('Cambrian Stage 3', 521.0, 514.0),
+    ('Ypresian', 56.0, 47.8), ('Chattian', 27.82, 23.03), ('Messinian', 7.246, 5.333),
+    ('Late Pleistocene', 0.129, 0.0117), ('Holocene', 0.0117, 0.0), ('Lujanian', 0.8, 0.011)
+)
+FAMILIAS = ('Tyrannosauridae', 'Elephantidae', 'Rhinocerotidae', 'Phorusrhacidae', 'Dinichthyidae',
+            'Basilosauridae', 'Macraucheniidae', 'NO_FAMILY_SPECIFIED', None)
+FORMACOES = ('Hell Creek', 'Morrison', 'Santa Maria', 'Yixian', 'Ischigualasto', 'Lujan', None)
+
+
+class ConfiguracaoDoServidor:
+    def __init__(self, taxons=200, registros_por_taxon=50, latencia=0.0, bytes_por_segundo=None,
+                 probabilidade_de_falha=0.0, taxons_com_erro=(), semente=0):
+        self.taxons = taxons # Quantidade de imagens no repositório fake
+        self.registros_por_taxon = registros_por_taxon
+        self.latencia = latencia # Segundos antes de cada resposta
+        self.bytes_por_segundo = bytes_por_segundo # Limita a velocidade de envio (None = sem limite)
+        self.probabilidade_de_falha = probabilidade_de_falha # Chance de uma requisição ao PBDB falhar com 500 (transitório)
+        self.taxons_com_erro = set(taxons_com_erro) # Lotes que contêm estes nomes sempre falham (400)
+        self.semente = semente
+
+
+def nomes_das_imagens(quantidade):
+    """Nomes das imagens do repositório fake: gêneros e alguns pares gênero_espécie."""
+    nomes = []
+    for i in range(quantidade):
+        genero = f"Genero{i:05d}"
+        nomes.append(f"{genero}_especie{i % 7}" if i % 5 == 0 else genero)
+    return nomes
+
+
+def gerar_registros(taxon, quantidade, semente=0):
+    """Gera os registros (no vocabulário compacto do PBDB) de um táxon."""
+    aleatorio = random.Random(f"{semente}:{taxon}")
+    genero, _, especie = taxon.partition('_')
+    longitude_base = aleatorio.uniform(-170, 170)
+    latitude_base = aleatorio.uniform(-60, 70)
+    registros = []
+    for k in range(quantidade):
+        intervalo, inicio, fim = aleatorio.choice(INTERVALOS)
+        especie_do_registro = especie or aleatorio.choice(('', 'rex', 'primigenius', 'sp.'))
+        registro = {
+            'oid': f"occ:{int(hashlib.sha1(f'{taxon}:{k}'.encode()).hexdigest()[:10], 16)}",
+            'cid': f"col:{aleatorio.randrange(10 ** 6)}",
+            'idn': f"{genero} {especie_do_registro}".strip(),
+            'tna': f"{genero} {especie_do_registro}".strip() if aleatorio.random() < 0.5 else genero,
+            'rnk': 3 if especie_do_registro else 5,
+            'oei': intervalo if aleatorio.random() < 0.9 else None,
+            'eag': inicio, 'lag': fim,
+            'lng': f"{longitude_base + aleatorio.gauss(0, 3):.5f}",
+            'lat': f"{max(-89.9, min(89.9, latitude_base + aleatorio.gauss(0, 2))):.5f}",
+            'gnn': genero,
+            'fml': aleatorio.choice(FAMILIAS),
+            'odl': 'Chordata',
+            'sfm': aleatorio.choice(FORMACOES),
+        }
+        if especie_do_registro:
+            registro['spn'] = especie_do_registro
+            registro['idt'] = f"{genero} {especie_do_registro}"
+        if aleatorio.random() < 0.02:
+            del registro['lat'] # Alguns registros inválidos, como no PBDB real
+        registros.append({chave: valor for chave, valor in registro.items() if valor is not None})
+    return registros
+
+
+class ManipuladorFake(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        configuracao = self.server.configuracao
+        url = urllib.parse.urlparse(self.path)
+        parametros = urllib.parse.parse_qs(url.query)
+        partes = url.path.strip('/').split('/')
+        with self.server.lock:
+            self.server.requisicoes.append(url.path)
+        if configuracao.latencia:
+            time.sleep(configuracao.latencia)
+
+        if url.path.endswith('occs/list.json'):
+            self.responder_pbdb(parametros.get('base_name', [''])[0].split(','))
+        elif url.path == '/paises.geo.json':
+            self.responder_paises()
+        elif len(partes) == 5 and partes[0] == 'repos' and partes[3] == 'branches':
+            self.responder_branch()
+        elif len(partes) == 6 and partes[0] == 'repos' and partes[3:5] == ['git', 'trees']:
+            self.responder_arvore()
+        else:
+            self.enviar_json({'message': 'Not Found'}, 404)
+
+    def responder_pbdb(self, taxons):
+        configuracao = self.server.configuracao
+        if configuracao.taxons_com_erro.intersection(taxons):
+            # Como o PBDB com um nome que ele não aceita: erro 400, em todas as tentativas
+            return self.enviar_json({'errors': ['Erro simulado para um táxon problemático.']}, 400)
+        if configuracao.probabilidade_de_falha and random.random() < configuracao.probabilidade_de_falha:
+            return self.enviar_json({'errors': ['Falha simulada.']}, 500)
+        registros = []
+        for taxon in taxons:
+            if taxon:
+                registros.extend(gerar_registros(taxon, configuracao.registros_por_taxon, configuracao.semente))
+        self.enviar_json({'elapsed_time': 0.1, 'records_found': len(registros), 'records': registros})
+
+    def sha_da_arvore(self):
+        configuracao = self.server.configuracao
+        return hashlib.sha1(f"{configuracao.taxons}:{configuracao.semente}".encode()).hexdigest()
+
+    def responder_branch(self):
+        sha = self.sha_da_arvore()
+        etag = f'"{sha[:16]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.enviar_json({'name': 'main', 'commit': {'commit': {'tree': {'sha': sha}}}}, cabecalhos={'ETag': etag})
+
+    def responder_arvore(self):
+        arvore = [{'path': 'static', 'type': 'tree'}, {'path': 'static/imagens', 'type': 'tree'}]
+        arvore += [{'path': f"static/imagens/{nome}.jpg", 'type': 'blob'}
+                   for nome in nomes_das_imagens(self.server.configuracao.taxons)]
+        self.enviar_json({'sha': self.sha_da_arvore(), 'tree': arvore, 'truncated': False})
+
+    def responder_paises(self):
+        """Uma grade de 'países' de 30° x 30°, suficiente para exercitar o LocalizadorDePaises."""
+        paises = []
+        for oeste in range(-180, 180, 30):
+            for sul in range(-90, 90, 30):
+                codigo = f"P{(oeste + 180) // 30:02d}{(sul + 90) // 30}"
+                anel = [[oeste, sul], [oeste + 30, sul], [oeste + 30, sul + 30], [oeste, sul + 30], [oeste, sul]]
+                paises.append({'type': 'Feature', 'id': codigo, 'properties': {'name': f"País {codigo}"},
+                               'geometry': {'type': 'Polygon', 'coordinates': [anel]}})
+        self.enviar_json({'type': 'FeatureCollection', 'features': paises})
+
+    def enviar_json(self, dados, status=200, cabecalhos=None):
+        corpo = json.dumps(dados).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corpo)))
+        for nome, valor in (cabecalhos or {}).items():
+            self.send_header(nome, valor)
+        self.end_headers()
+        bytes_por_segundo = self.server.configuracao.bytes_por_segundo
+        if not bytes_por_segundo:
+            self.wfile.write(corpo)
+            return
+        bloco = max(1, int(bytes_por_segundo / 10))
+        for inicio in range(0, len(corpo), bloco):
+            self.wfile.write(corpo[inicio:inicio + bloco])
+            time.sleep(0.1)
+
+
+def iniciar_servidor(porta=0, configuracao=None):
+    """
+    Inicia o servidor numa thread de fundo e o retorna. Com porta=0 uma porta
+    livre é escolhida; a URL base fica em servidor.url.
+    """
+    servidor = ThreadingHTTPServer(('127.0.0.1', porta), ManipuladorFake)
+    servidor.daemon_threads = True
+    servidor.configuracao = configuracao or ConfiguracaoDoServidor()
+    servidor.requisicoes = []
+    servidor.lock = threading.Lock()
+    servidor.url = f"http://127.0.0.1:{servidor.server_port}"
+    threading.Thread(target=servidor.serve_forever, name='servidor-fake', daemon=True).start()
+    return servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor fake do PBDB e do GitHub.')
+    parser.add_argument('--porta', type=int, default=8765)
+    parser.add_argument('--taxons', type=int, default=200, help='Quantidade de imagens no repositório fake.')
+    parser.add_argument('--registros-por-taxon', type=int, default=50)
+    parser.add_argument('--latencia', type=float, default=0.0, help='Segundos de espera antes de cada resposta.')
+    parser.add_argument('--bytes-por-segundo', type=int, default=None, help='Limita a velocidade de envio.')
+    parser.add_argument('--falhas', type=float, default=0.0, help='Probabilidade (0 a 1) de uma requisição ao PBDB falhar.')
+    parser.add_argument('--taxons-com-erro', default='', help='Nomes separados por vírgula que sempre fazem o lote falhar.')
+    args = parser.parse_args()
+
+    configuracao = ConfiguracaoDoServidor(
+        taxons=args.taxons, registros_por_taxon=args.registros_por_taxon, latencia=args.latencia,
+        bytes_por_segundo=args.bytes_por_segundo, probabilidade_de_falha=args.falhas,
+        taxons_com_erro=[nome for nome in args.taxons_com_erro.split(',') if nome]
+    )
+    servidor = iniciar_servidor(args.porta, configuracao)
+    print(f"Servidor fake em {servidor.url}", flush=True)
+    print(f"  PBDB_API_URL = \"{servidor.url}/data1.2/occs/list.json\"", flush=True)
+    print(f"  GITHUB_API_URL = \"{servidor.url}\"", flush=True)
+    print(f"  PAISES_GEOJSON_URL = \"{servidor.url}/paises.geo.json\"", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
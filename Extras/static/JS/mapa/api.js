@@ -1,9 +1,131 @@
 // api.js - Funções de comunicação com o backend
 
-export async function fetchData() {
-    const response = await fetch('/api/dados_fosseis/');
+const NOME_DO_BANCO = 'paleomap';
+const NOME_DO_STORE = 'dataset';
+
+/** Abre o IndexedDB local; resolve null se o navegador não o suportar. */
+function abrirBanco() {
+    return new Promise(resolve => {
+        if (!('indexedDB' in window)) return resolve(null);
+        const pedido = indexedDB.open(NOME_DO_BANCO, 1);
+        pedido.onupgradeneeded = () => pedido.result.createObjectStore(NOME_DO_STORE);
+        pedido.onsuccess = () => resolve(pedido.result);
+        pedido.onerror = () => resolve(null);
+    });
+}
+
+function lerDoBanco(banco) {
+    return new Promise(resolve => {
+        if (!banco) return resolve(null);
+        const pedido = banco.transaction(NOME_DO_STORE, 'readonly').objectStore(NOME_DO_STORE).get('atual');
+        pedido.onsuccess = () => resolve(pedido.result || null);
+        pedido.onerror = () => resolve(null);
+    });
+}
+
+function gravarNoBanco(banco, registro) {
+    return new Promise(resolve => {
+        if (!banco || !registro.versao) return resolve();
+        const transacao = banco.transaction(NOME_DO_STORE, 'readwrite');
+        transacao.objectStore(NOME_DO_STORE).put(registro, 'atual');
+        transacao.oncomplete = () => resolve();
+        transacao.onerror = () => resolve(); // Sem cache local, a próxima visita baixa tudo de novo
+    });
+}
+
+async function fetchDadosCompletos() {
+    // As URLs das imagens chegam uma única vez, numa tabela; cada ocorrência traz só o índice.
+    const response = await fetch('/api/dados_fosseis/?imagens=indice');
+    if (!response.ok) {
+        throw new Error(`Erro ao comunicar com o servidor: ${response.statusText}`);
+    }
+    const dados = await response.json();
+    const imagens = dados.imagens || [];
+    dados.dados_processados.forEach(ponto => {
+        if (typeof ponto.imagem === 'number') ponto.imagem = ponto.imagem >= 0 ? imagens[ponto.imagem] : '';
+    });
+    return { versao: response.headers.get('X-Versao-Do-Dataset'), dados: dados.dados_processados };
+}
+
+/**
+ * Aplica as diferenças desde a versão guardada localmente. Retorna null se o
+ * servidor não tiver mais essa versão (o dataset completo deve ser baixado).
+ */
+async function fetchDelta(local) {
+    const response = await fetch(`/api/dados_fosseis/?since=${encodeURIComponent(local.versao)}`);
+    if (response.status === 410) return null;
     if (!response.ok) {
         throw new Error(`Erro ao comunicar com o servidor: ${response.statusText}`);
     }
+    const delta = await response.json();
+    if (delta.adicionados.length === 0 && delta.removidos.length === 0) {
+        return { versao: delta.versao, dados: local.dados, inalterado: true };
+    }
+    const removidos = new Set(delta.removidos);
+    const dados = local.dados.filter(ponto => !removidos.has(ponto.id)).concat(delta.adicionados);
+    return { versao: delta.versao, dados };
+}
+
+/**
+ * Busca as ocorrências. O dataset fica guardado no IndexedDB junto com a sua
+ * versão; nas visitas seguintes só as ocorrências adicionadas e removidas
+ * desde então são baixadas.
+ * @returns {Promise<Object>} { dados_processados }
+ */
+export async function fetchData() {
+    const banco = await abrirBanco();
+    const local = await lerDoBanco(banco);
+    let resultado = null;
+    if (local && local.versao) {
+        try {
+            resultado = await fetchDelta(local);
+        } catch (erro) {
+            console.warn('Falha ao buscar as diferenças; baixando o dataset completo.', erro);
+        }
+    }
+    if (!resultado) resultado = await fetchDadosCompletos();
+    if (!resultado.inalterado) await gravarNoBanco(banco, { versao: resultado.versao, dados: resultado.dados });
+    return { dados_processados: resultado.dados };
+}
+
+/**
+ * Busca o resumo das facetas calculado no servidor uma vez por versão do dataset.
+ * @returns {Promise<Object>} { total, registros, contagens: { periodo, familia, pais, formacao }, familias }
+ */
+export async function fetchFacets() {
+    const response = await fetch('/api/facets');
+    if (!response.ok) {
+        throw new Error(`Erro ao buscar as facetas: ${response.statusText}`);
+    }
+    return await response.json();
+}
+
+/**
+ * Busca o histograma de idades (ocorrências por faixa de 1 M.A.), usado para
+ * mostrar a densidade de ocorrências sobre o slider.
+ * @returns {Promise<Object>} { largura, idade_maxima, contagens }
+ */
+export async function fetchHistogramaDeIdades() {
+    const response = await fetch('/api/idades/histograma');
+    if (!response.ok) {
+        throw new Error(`Erro ao buscar o histograma de idades: ${response.statusText}`);
+    }
+    return await response.json();
+}
+
+/**
+ * Consulta as ocorrências filtradas no servidor, sem baixar o dataset inteiro.
+ * @param {Object} filtros - periodo, familia, pais, genero, genero_modo, inicio, fim, bbox, limite, deslocamento.
+ * @returns {Promise<Object>} { total, dados_processados }
+ */
+export async function queryData(filtros = {}) {
+    const params = new URLSearchParams();
+    Object.entries(filtros).forEach(([chave, valor]) => {
+        if (valor !== null && valor !== undefined && valor !== '') params.set(chave, valor);
+    });
+    const response = await fetch(`/api/dados_fosseis/query?${params}`);
+    if (!response.ok) {
+        throw new Error(`Erro ao consultar o servidor: ${response.statusText}`);
+    }
     return await response.json();
-}
\ No newline at end of file
+}
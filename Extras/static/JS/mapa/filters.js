@@ -9,6 +9,7 @@ const buscaInput = document.getElementById('busca');
 const familiaSelect = document.getElementById('familia');
 const slider = document.getElementById('slider');
 const label = document.getElementById('label-range');
+const densidadeSlider = document.getElementById('densidade-slider');
 const container = document.getElementById('resultados');
 const exibirSelecionados = document.getElementById('exibirSelecionados');
 const limparSelecionados = document.getElementById('limparSelecionados');
@@ -33,6 +34,10 @@ let userInteractingWithSlider = false;
 
 let familiaMap = new Map();
 
+// O backend já envia o código do país de cada ocorrência (campo 'pais');
+// o teste de ponto-no-polígono com turf fica só como alternativa.
+let hasServerCountries = false;
+
 let visibleFamiliesCache = [];
 let visibleCountriesCache = [];
 
@@ -41,6 +46,29 @@ let visibleCountriesCache = [];
 let drawMarkersCallback = null;
 let mapInstance = null;
 
+/**
+ * Desenha a densidade de ocorrências sobre o slider a partir do histograma de
+ * 1 M.A. do servidor, somando as faixas em barras de 5 M.A. O slider vai de
+ * 450 (esquerda) a 0 (direita).
+ */
+function desenharDensidadeDoSlider(histograma) {
+    const idadeMaxima = 450;
+    const porBarra = 5;
+    const barras = [];
+    for (let inicio = idadeMaxima - porBarra; inicio >= 0; inicio -= porBarra) {
+        barras.push(histograma.contagens.slice(inicio, inicio + porBarra).reduce((a, b) => a + b, 0));
+    }
+    const maior = Math.max(...barras, 1);
+    densidadeSlider.innerHTML = '';
+    barras.forEach((total, i) => {
+        const barra = document.createElement('span');
+        barra.style.height = `${(total / maior) * 100}%`;
+        const inicio = idadeMaxima - i * porBarra;
+        barra.title = `${inicio} - ${inicio - porBarra} M.A.: ${total} ocorrências`;
+        densidadeSlider.appendChild(barra);
+    });
+}
+
 /**
  * Inicializa a lógica de filtros e botões.
  * Recebe as funções de callback para evitar dependência circular.
@@ -48,25 +76,36 @@ let mapInstance = null;
  * @param {Object} geoJson - O objeto GeoJSON dos países.
  * @param {L.Map} map - A instância do mapa.
  * @param {Function} drawMarkersFn - A função para desenhar marcadores no mapa.
+ * @param {Object|null} facets - Resumo de /api/facets; quando presente, a árvore de famílias e
+ *     os países vêm dele em vez de serem calculados a partir de todos os pontos.
+ * @param {Object|null} histograma - Resultado de /api/idades/histograma, desenhado sobre o slider.
  */
-export function initializeFilters(data, geoJson, map, drawMarkersFn) {
+export function initializeFilters(data, geoJson, map, drawMarkersFn, facets = null, histograma = null) {
     allData = data;
     allGeoJson = geoJson;
     mapInstance = map;
     drawMarkersCallback = drawMarkersFn; // Salva a função de callback
 
-    allData.forEach(ponto => {
-        if (ponto.familia && ponto.familia !== 'Não definido') {
-            if (!familiaMap.has(ponto.familia)) {
-                familiaMap.set(ponto.familia, new Set());
+    if (histograma) {
+        desenharDensidadeDoSlider(histograma);
+    }
+
+    if (facets) {
+        Object.entries(facets.familias).forEach(([familia, generos]) => familiaMap.set(familia, new Set(generos)));
+    } else {
+        allData.forEach(ponto => {
+            if (ponto.familia && ponto.familia !== 'Não definido') {
+                if (!familiaMap.has(ponto.familia)) {
+                    familiaMap.set(ponto.familia, new Set());
+                }
+                familiaMap.get(ponto.familia).add(ponto.genero);
             }
-            familiaMap.get(ponto.familia).add(ponto.genero);
-        }
-    });
+        });
+    }
 
-    const countriesWithFossils = allGeoJson.features.filter(feature => {
-        return allData.some(ponto => turf.booleanPointInPolygon(turf.point([ponto.lng, ponto.lat]), feature.geometry));
-    });
+    hasServerCountries = allData.some(ponto => ponto.pais);
+    const countryIds = facets && hasServerCountries ? new Set(Object.keys(facets.contagens.pais)) : getCountryIds(allData);
+    const countriesWithFossils = allGeoJson.features.filter(feature => countryIds.has(feature.id));
     countriesWithFossils.sort((a, b) => a.properties.name.localeCompare(b.properties.name));
     countriesWithFossils.forEach(feature => {
         const option = document.createElement('option');
@@ -140,7 +179,7 @@ document.querySelectorAll('.legenda-item').forEach(item =>
     paisSelect.addEventListener('change', () => {
         filtersState.pais = paisSelect.value;
         const pointsForCalc = (filtersState.pais === 'ATA') ? allData.filter(p => p.lat <= -60.0) :
-                             (filtersState.pais !== 'todos') ? allData.filter(p => turf.booleanPointInPolygon(turf.point([p.lng, p.lat]), allGeoJson.features.find(f => f.id === filtersState.pais).geometry)) :
+                             (filtersState.pais !== 'todos') ? allData.filter(p => isPointInCountry(p, allGeoJson.features.find(f => f.id === filtersState.pais))) :
                              allData;
         
         if (pointsForCalc.length > 0 && filtersState.pais !== 'todos') {
@@ -219,9 +258,7 @@ export function applyGlobalFilters() {
         } else {
             const countryFeature = allGeoJson.features.find(f => f.id === filtersState.pais);
             if (countryFeature) {
-                filteredPoints = filteredPoints.filter(p =>
-                    turf.booleanPointInPolygon(turf.point([p.lng, p.lat]), countryFeature.geometry)
-                );
+                filteredPoints = filteredPoints.filter(p => isPointInCountry(p, countryFeature));
                 context = `em ${countryFeature.properties.name}`;
             }
         }
@@ -244,17 +281,42 @@ export function applyGlobalFilters() {
      }
 }
 
+/**
+ * Verifica se um ponto está dentro de um país.
+ * Usa o código calculado no servidor e só recorre ao turf se ele não existir.
+ * @param {Object} point - O ponto.
+ * @param {Object} feature - A feature GeoJSON do país.
+ * @returns {boolean}
+ */
+function isPointInCountry(point, feature) {
+    if (hasServerCountries) return point.pais === feature.id;
+    return turf.booleanPointInPolygon(turf.point([point.lng, point.lat]), feature.geometry);
+}
+
+/**
+ * Retorna o conjunto de códigos de país que têm pelo menos um dos pontos.
+ * @param {Array<Object>} points - Os pontos.
+ * @returns {Set<string>}
+ */
+function getCountryIds(points) {
+    if (hasServerCountries) return new Set(points.map(p => p.pais).filter(Boolean));
+    return new Set(allGeoJson.features
+        .filter(feature => points.some(p => isPointInCountry(p, feature)))
+        .map(feature => feature.id));
+}
+
 function updateInfoPanel(points, context) {
     if (!infoPainel) return;
     if (points.length === 0) { infoPainel.innerHTML = `<p>Nenhum fóssil encontrado para o filtro atual.</p>`; return; }
     
-    const totalOccurrences = points.length;
+    // Cada ponto pode representar várias ocorrências agrupadas no servidor (campo 'quantidade')
+    const totalOccurrences = points.reduce((total, point) => total + (point.quantidade || 1), 0);
     let html = `<p>Mostrando <strong>${totalOccurrences}</strong> ocorrência(s) ${context}.</p>`;
     const speciesCount = {};
     points.forEach(point => {
         const fullName = `${point.genero} ${point.especie || ''}`.trim();
         if (point.genero !== 'Não identificado') {
-            speciesCount[fullName] = (speciesCount[fullName] || 0) + 1;
+            speciesCount[fullName] = (speciesCount[fullName] || 0) + (point.quantidade || 1);
         }
     });
     const sortedSpecies = Object.entries(speciesCount).sort((a, b) => b[1] - a[1]);
@@ -295,13 +357,7 @@ function updateFilterControls(visiblePoints) {
 
     // 🔹 Países
     if (!currentCountryValue || currentCountryValue === 'todos') {
-        visibleCountriesCache = new Set();
-        allGeoJson.features.forEach(feature => {
-            const hasFossils = visiblePoints.some(p =>
-                turf.booleanPointInPolygon(turf.point([p.lng, p.lat]), feature.geometry)
-            );
-            if (hasFossils) visibleCountriesCache.add(feature.id);
-        });
+        visibleCountriesCache = getCountryIds(visiblePoints);
     }
 
     paisSelect.innerHTML = '<option value="todos">Todos os países</option>';
@@ -420,9 +476,7 @@ function updateSliderWithPriority() {
         } else {
             const countryFeature = allGeoJson.features.find(f => f.id === filtersState.pais);
             if (countryFeature) {
-                filteredPoints = filteredPoints.filter(p =>
-                    turf.booleanPointInPolygon(turf.point([p.lng, p.lat]), countryFeature.geometry)
-                );
+                filteredPoints = filteredPoints.filter(p => isPointInCountry(p, countryFeature));
             }
         }
     }
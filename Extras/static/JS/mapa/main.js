@@ -1,6 +1,6 @@
 // main.js - O orquestrador principal da aplicação
 
-import { fetchData } from './api.js';
+import { fetchData, fetchFacets, fetchHistogramaDeIdades } from './api.js';
 import { initializeMap, drawMarkers, setFamiliaDataAndCallback } from './map.js';
 import { 
     initializeFilters, 
@@ -22,7 +22,13 @@ let allGeoJson = null;
 
     try {
         // 1. Buscar dados do backend
-        const apiResult = await fetchData();
+        // As facetas e o histograma de idades são opcionais: sem eles, os filtros são
+        // montados a partir dos dados e o slider fica sem a densidade
+        const [apiResult, facets, histograma] = await Promise.all([
+            fetchData(),
+            fetchFacets().catch(() => null),
+            fetchHistogramaDeIdades().catch(() => null)
+        ]);
         allData = apiResult.dados_processados;
 
         if (!allData || allData.length === 0) {
@@ -50,7 +56,7 @@ let allGeoJson = null;
         
         // Inicializa os filtros, passando o mapa e a função de desenhar marcadores
         // O filters.js precisa da função drawMarkers para atualizar o mapa
-        initializeFilters(allData, allGeoJson, map, drawMarkers);
+        initializeFilters(allData, allGeoJson, map, drawMarkers, facets, histograma);
 
         // Inicializa as interações da UI
         // A lógica de toggle é responsabilidade do filters.js, mas o botão está na UI
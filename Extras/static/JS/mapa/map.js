@@ -152,6 +152,8 @@ function getMarkerStyle(period) {
 function createPopup(point) {
     const familyHtml = (point.familia) ? `<b>Família:</b> ${point.familia}<br>` : '';
     const displayPeriod = point.periodo.charAt(0).toUpperCase() + point.periodo.slice(1);
+    // Registros agrupados no servidor: várias ocorrências do mesmo táxon no mesmo local
+    const quantityHtml = (point.quantidade > 1) ? `<b>Ocorrências:</b> ${point.quantidade}<br>` : '';
     
     let familyMembersHtml = '';
     if (point.familia && point.familia !== 'Não definido' && familiaMap.has(point.familia)) {
@@ -172,7 +174,7 @@ function createPopup(point) {
             <b>Formação:</b> ${point.formacao}<br>
             <b>Período:</b> ${displayPeriod}<br>
             <b>Início:</b> ${point.inicio} M.A. – <b>Fim:</b> ${point.fim} M.A.<br>
-            <div class="popup-content-inner">
+            ${quantityHtml}            <div class="popup-content-inner">
                 <img class="popup-imagem" src="${point.imagem}" alt="${point.genero}" style="width:200px; border-radius:6px; margin-top: 5px; cursor: zoom-in;" onerror="this.style.display='none';">
                  <div class="artist-info"><b>Artista: </b>Paleohistoric on DeviantArt</div>
                 ${familyMembersHtml} 
@@ -0,0 +1,52 @@
+"""
+Fixtures dos testes: o app.py com os caches numa pasta temporária, apontado
+para um servidor_fake.py local (PBDB, GitHub e GeoJSON de países).
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as paleomap
+import servidor_fake
+
+
+@pytest.fixture(scope='session')
+def servidor_da_sessao():
+    servidor = servidor_fake.iniciar_servidor()
+    yield servidor
+    servidor.shutdown()
+
+
+@pytest.fixture
+def servidor(servidor_da_sessao):
+    """O servidor fake com a configuração padrão dos testes, sem falhas e sem requisições registradas."""
+    servidor_da_sessao.configuracao = servidor_fake.ConfiguracaoDoServidor(taxons=40, registros_por_taxon=5)
+    servidor_da_sessao.requisicoes.clear()
+    return servidor_da_sessao
+
+
+@pytest.fixture
+def app(servidor, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(paleomap, 'PBDB_API_URL', f"{servidor.url}/data1.2/occs/list.json")
+    monkeypatch.setattr(paleomap, 'GITHUB_API_URL', servidor.url)
+    monkeypatch.setattr(paleomap, 'PAISES_GEOJSON_URL', f"{servidor.url}/paises.geo.json")
+    monkeypatch.setattr(paleomap, 'PBDB_REQUISICOES_POR_SEGUNDO', 1000.0)
+    monkeypatch.setattr(paleomap, 'PBDB_RAJADA_MAXIMA', 1000)
+    monkeypatch.setattr(paleomap, 'LISTA_MANUAL_DE_TAXONS', [])
+    monkeypatch.setattr(paleomap.time, 'sleep', lambda segundos: None) # Sem esperar entre as tentativas
+    return paleomap
+
+
+@pytest.fixture
+def cliente(app, monkeypatch):
+    """Cliente do Flask com um agendador novo: o dataset é construído na primeira requisição."""
+    monkeypatch.setattr(app, 'agendador', app.AgendadorDeAtualizacao(app.construir_dados_fosseis))
+    return app.app.test_client()
+
+
+def requisicoes_ao_pbdb(servidor):
+    return [caminho for caminho in servidor.requisicoes if caminho.endswith('occs/list.json')]
@@ -0,0 +1,182 @@
+import gzip
+import json
+import math
+
+import pytest
+
+
+def todas_as_linhas(app):
+    dataset = app.agendador.obter_versao().dataset
+    return list(dataset.iterar_linhas())
+
+
+def test_consulta_igual_a_filtrar_as_linhas(app, cliente):
+    linhas = todas_as_linhas(app)
+    periodo, maxima, minima = linhas[0]['periodo'], linhas[0]['inicio'], linhas[0]['fim']
+    esperadas = [linha['id'] for linha in linhas
+                 if linha['periodo'] == periodo and linha['inicio'] <= maxima and linha['fim'] >= minima]
+    assert esperadas
+    resposta = cliente.get('/api/dados_fosseis/query', query_string={
+        'periodo': periodo, 'inicio': maxima, 'fim': minima, 'limite': 1000
+    })
+    assert resposta.status_code == 200
+    assert resposta.json['total'] == len(esperadas)
+    assert [linha['id'] for linha in resposta.json['dados_processados']] == esperadas
+
+    # O slider pode mandar os extremos invertidos
+    invertida = cliente.get('/api/dados_fosseis/query', query_string={
+        'periodo': periodo, 'inicio': minima, 'fim': maxima, 'limite': 1000
+    })
+    assert invertida.json == resposta.json
+
+
+def test_consulta_por_genero_e_bbox(app, cliente):
+    linhas = todas_as_linhas(app)
+    genero = linhas[0]['genero']
+    esperadas = [linha['id'] for linha in linhas
+                 if genero[:5].lower() in (linha['genero'] or '').lower() and -90 <= linha['lat'] <= 0]
+    assert esperadas
+    resposta = cliente.get('/api/dados_fosseis/query', query_string={
+        'genero': genero[:5], 'bbox': '-180,-90,180,0', 'limite': 1000
+    })
+    assert [linha['id'] for linha in resposta.json['dados_processados']] == esperadas
+
+
+def test_consulta_pagina_com_limite_e_deslocamento(app, cliente):
+    ids = [linha['id'] for linha in todas_as_linhas(app)]
+    resposta = cliente.get('/api/dados_fosseis/query?limite=7&deslocamento=10')
+    assert resposta.json['total'] == len(ids)
+    assert [linha['id'] for linha in resposta.json['dados_processados']] == ids[10:17]
+
+
+@pytest.mark.parametrize('parametros', [
+    'limite=abc', 'limite=1.5', 'deslocamento=abc', 'limite=0', 'deslocamento=-1',
+    'inicio=abc', 'bbox=1,2,3', 'genero_modo=regex'
+])
+def test_consulta_rejeita_parametros_invalidos(cliente, parametros):
+    resposta = cliente.get(f'/api/dados_fosseis/query?{parametros}')
+    assert resposta.status_code == 400
+    assert 'erro' in resposta.json
+
+
+def test_paginacao_por_cursor_reproduz_o_dataset(app, cliente):
+    completo = cliente.get('/api/dados_fosseis/').get_json()
+    paginas, cursor = [], None
+    while True:
+        resposta = cliente.get('/api/dados_fosseis/', query_string={'limite': 30, **({'cursor': cursor} if cursor else {})})
+        assert resposta.status_code == 200
+        assert resposta.json['total'] == len(completo['dados_processados'])
+        paginas.extend(resposta.json['dados_processados'])
+        cursor = resposta.json['proximo_cursor']
+        if cursor is None:
+            break
+    assert paginas == completo['dados_processados']
+
+
+def test_cursor_de_outra_versao_responde_410(app, cliente):
+    resposta = cliente.get('/api/dados_fosseis/?cursor=20000101T000000000000-0000000000000000:30')
+    assert resposta.status_code == 410
+    assert resposta.json['versao'] == app.agendador.versao.identificador
+
+
+@pytest.mark.parametrize('parametros', ['limite=abc', 'limite=0', 'cursor=abc', 'cursor=x:-1', 'limite=5&formato=colunar'])
+def test_paginacao_rejeita_parametros_invalidos(cliente, parametros):
+    assert cliente.get(f'/api/dados_fosseis/?{parametros}').status_code == 400
+
+
+@pytest.mark.parametrize('comprimido', [False, True])
+def test_ndjson_igual_ao_json(cliente, comprimido):
+    completo = cliente.get('/api/dados_fosseis/').get_json()
+    resposta = cliente.get('/api/dados_fosseis/?formato=ndjson', headers={'Accept-Encoding': 'gzip' if comprimido else 'identity'})
+    corpo = resposta.get_data()
+    if comprimido:
+        assert resposta.headers['Content-Encoding'] == 'gzip'
+        corpo = gzip.decompress(corpo)
+    linhas = [json.loads(linha) for linha in corpo.decode('utf-8').splitlines()]
+    assert linhas == completo['dados_processados']
+
+
+def celula_por_forca_bruta(lat, lng, z, celulas_por_tile):
+    escala = celulas_por_tile * 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    y = 0.5 - math.log((1 + math.sin(math.radians(lat))) / (1 - math.sin(math.radians(lat)))) / (4 * math.pi)
+    return int((lng + 180) / 360 * escala), int(y * escala)
+
+
+@pytest.mark.parametrize('z', [0, 1, 3])
+def test_tiles_agregam_todas_as_linhas(app, cliente, z):
+    linhas = todas_as_linhas(app)
+    esperadas = {}
+    for linha in linhas:
+        celula = celula_por_forca_bruta(linha['lat'], linha['lng'], z, app.CLUSTER_CELULAS_POR_TILE)
+        esperadas.setdefault(celula, []).append(linha)
+
+    encontradas = {}
+    for x in range(2 ** z):
+        for y in range(2 ** z):
+            resposta = cliente.get(f'/api/tiles/{z}/{x}/{y}')
+            assert resposta.status_code == 200
+            for cluster in resposta.json['clusters']:
+                celula = celula_por_forca_bruta(cluster['lat'], cluster['lng'], z, app.CLUSTER_CELULAS_POR_TILE)
+                assert (celula[0] // app.CLUSTER_CELULAS_POR_TILE, celula[1] // app.CLUSTER_CELULAS_POR_TILE) == (x, y)
+                encontradas[celula] = cluster
+
+    assert set(encontradas) == set(esperadas)
+    for celula, cluster in encontradas.items():
+        grupo = esperadas[celula]
+        assert cluster['total'] == len(grupo)
+        assert cluster['ocorrencias'] == sum(linha['quantidade'] for linha in grupo)
+        assert cluster['lat'] == pytest.approx(sum(linha['lat'] for linha in grupo) / len(grupo))
+        if len(grupo) == 1:
+            assert cluster['id'] == grupo[0]['id']
+
+
+def test_tile_acima_do_zoom_maximo_traz_os_pontos(app, cliente):
+    linha = todas_as_linhas(app)[0]
+    z = app.CLUSTER_ZOOM_MAXIMO + 1
+    cx, cy = celula_por_forca_bruta(linha['lat'], linha['lng'], z, app.CLUSTER_CELULAS_POR_TILE)
+    x, y = cx // app.CLUSTER_CELULAS_POR_TILE, cy // app.CLUSTER_CELULAS_POR_TILE
+    clusters = cliente.get(f'/api/tiles/{z}/{x}/{y}').json['clusters']
+    assert linha['id'] in [cluster['id'] for cluster in clusters]
+    assert all(cluster['total'] == 1 for cluster in clusters)
+
+
+@pytest.mark.parametrize('tile', ['1/2/0', '1/0/2', '0/1/1'])
+def test_tile_fora_dos_limites(cliente, tile):
+    assert cliente.get(f'/api/tiles/{tile}').status_code == 400
+
+
+def test_facetas_iguais_a_contar_as_linhas(app, cliente):
+    linhas = todas_as_linhas(app)
+    resposta = cliente.get('/api/facets')
+    assert resposta.status_code == 200
+    facetas = resposta.json
+    assert facetas['total'] == sum(linha['quantidade'] for linha in linhas)
+    assert facetas['registros'] == len(linhas)
+    for nome in ('periodo', 'familia', 'pais', 'formacao'):
+        esperadas = {}
+        for linha in linhas:
+            if linha[nome] is not None:
+                esperadas[linha[nome]] = esperadas.get(linha[nome], 0) + linha['quantidade']
+        assert facetas['contagens'][nome] == esperadas
+
+    familias = {}
+    for linha in linhas:
+        if linha['familia'] != 'Não definido':
+            familias.setdefault(linha['familia'], set()).add(linha['genero'])
+    assert facetas['familias'] == {familia: sorted(generos) for familia, generos in familias.items()}
+    assert 'ids_por_genero' not in facetas
+
+    ids_por_genero = {}
+    for linha in linhas:
+        ids_por_genero.setdefault(linha['genero'], []).append(linha['id'])
+    com_ids = cliente.get('/api/facets?ids=1').json
+    assert com_ids['ids_por_genero'] == ids_por_genero
+    assert {chave: valor for chave, valor in com_ids.items() if chave != 'ids_por_genero'} == facetas
+
+
+def test_facetas_respondem_304_com_o_mesmo_etag(cliente):
+    resposta = cliente.get('/api/facets')
+    condicional = cliente.get('/api/facets', headers={'If-None-Match': resposta.headers['ETag']})
+    assert condicional.status_code == 304
+    assert condicional.get_data() == b''
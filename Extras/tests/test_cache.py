@@ -0,0 +1,139 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import servidor_fake
+
+
+def montar_dataset(app, taxons=5):
+    imagens = servidor_fake.nomes_das_imagens(taxons)
+    registros = [app.reduzir_registro(rec) for taxon in imagens for rec in servidor_fake.gerar_registros(taxon, 5)]
+    return app.DatasetColunar.a_partir_de_registros(iter(registros), imagens, processos=1)
+
+
+def test_escrita_atomica(app, tmp_path):
+    destino = tmp_path / 'arquivo.json'
+    destino.write_text('antigo', encoding='utf-8')
+    with pytest.raises(RuntimeError):
+        with app.escrita_atomica(str(destino)) as f:
+            f.write('pela metade')
+            raise RuntimeError('falhou no meio')
+    assert destino.read_text(encoding='utf-8') == 'antigo'
+    assert os.listdir(tmp_path) == ['arquivo.json'] # O temporário foi removido
+
+    with app.escrita_atomica(str(destino)) as f:
+        f.write('novo')
+    assert destino.read_text(encoding='utf-8') == 'novo'
+    assert os.listdir(tmp_path) == ['arquivo.json']
+    if os.name == 'posix':
+        assert os.stat(destino).st_mode & 0o777 == 0o666 & ~app.MASCARA_DE_PERMISSOES
+
+
+def test_versoes_antigas_sao_removidas_com_os_formatos(app):
+    caminhos = []
+    for _ in range(app.CACHE_VERSOES_MANTIDAS + 3):
+        caminhos.append(app.salvar_versao_do_dataset(montar_dataset(app)))
+        time.sleep(0.001) # Nomes com o horário em microssegundos
+    mantidos = [caminho for caminho, _ in app.listar_versoes_do_dataset()]
+    assert mantidos == caminhos[::-1][:app.CACHE_VERSOES_MANTIDAS + 1]
+
+    bases = {os.path.splitext(os.path.basename(caminho))[0] for caminho in mantidos}
+    arquivos = os.listdir(app.CACHE_DIRETORIO)
+    assert {nome.split('.')[0] for nome in arquivos} == bases # Nenhum formato de versão removida sobrou
+    assert all(not nome.endswith('.tmp') for nome in arquivos)
+
+
+def test_ler_cache_pula_versao_corrompida_e_prefere_o_esquema_atual(app):
+    valida = app.salvar_versao_do_dataset(montar_dataset(app))
+    time.sleep(0.001)
+    corrompida = app.salvar_versao_do_dataset(montar_dataset(app, taxons=6))
+    with open(corrompida, 'r+b') as f:
+        f.write(b'XXXXXXXX') # Estraga o MAGIC
+    dataset, _, esquema = app.ler_cache_do_disco()
+    assert dataset.caminho == valida and esquema == app.hash_do_esquema()
+
+    # Uma versão mais nova, mas de outro esquema, só é usada se não houver outra
+    outro_esquema = os.path.join(app.CACHE_DIRETORIO, '29991231T000000000000-0000000000000000.bin')
+    montar_dataset(app).salvar(outro_esquema)
+    assert app.ler_cache_do_disco()[0].caminho == valida
+    os.remove(valida)
+    dataset, _, esquema = app.ler_cache_do_disco()
+    assert (dataset.caminho, esquema) == (outro_esquema, '0000000000000000')
+
+
+def test_trava_de_arquivo_entre_processos(app, tmp_path):
+    caminho = str(tmp_path / 'trava.lock')
+    codigo = (
+        "import sys; sys.path.insert(0, sys.argv[1]); import app; print('pronto', flush=True)\n"
+        "with app.TravaDeArquivo(sys.argv[2]):\n"
+        "    print('travou', flush=True)\n"
+    )
+    pasta_do_app = os.path.dirname(os.path.abspath(app.__file__))
+    with app.TravaDeArquivo(caminho):
+        processo = subprocess.Popen([sys.executable, '-c', codigo, pasta_do_app, caminho],
+                                    stdout=subprocess.PIPE, text=True, cwd=str(tmp_path))
+        try:
+            assert processo.stdout.readline().strip() == 'pronto'
+            time.sleep(0.5)
+            assert processo.poll() is None # Esperando a trava
+        except BaseException:
+            processo.kill()
+            raise
+    saida, _ = processo.communicate(timeout=30)
+    assert saida.strip() == 'travou' and processo.returncode == 0
+
+
+def test_build_offline_e_inicio_a_quente(app, servidor, monkeypatch):
+    monkeypatch.setattr(app, 'TAXON_MAX_AGE_HOURS', app.TAXON_MAX_AGE_HOURS) # O comando pode alterá-lo
+    resultado = app.app.test_cli_runner().invoke(args=['paleomap', 'build'])
+    assert resultado.exit_code == 0, resultado.output
+    [(caminho, _)] = app.listar_versoes_do_dataset()
+
+    # Um worker novo: nada é carregado antes da primeira requisição, que usa a versão gravada
+    agendador = app.AgendadorDeAtualizacao(app.construir_dados_fosseis)
+    monkeypatch.setattr(app, 'agendador', agendador)
+    servidor.requisicoes.clear()
+    assert agendador.aquecimento is None
+    assert app.app.test_client().get('/api/dados_fosseis/').status_code == 200
+    assert agendador.aquecimento is not None
+    assert agendador.versao.dataset.caminho == caminho
+    assert agendador.thread is None # Nenhuma reconstrução
+    assert servidor.requisicoes == []
+
+
+def test_versao_expirada_e_servida_durante_uma_unica_reconstrucao(app):
+    liberar = threading.Event()
+    chamadas = []
+    def construir_devagar():
+        chamadas.append(1)
+        liberar.wait(10)
+        return montar_dataset(app, taxons=6)
+    agendador = app.AgendadorDeAtualizacao(construir_devagar)
+    antigo = montar_dataset(app)
+    agendador._publicar(antigo, datetime.now() - timedelta(hours=app.CACHE_MAX_AGE_HOURS + 1))
+
+    assert agendador.obter_versao().dataset is antigo
+    assert agendador.obter_versao().dataset is antigo
+    liberar.set()
+    agendador.thread.join(10)
+    assert len(chamadas) == 1
+    assert len(agendador.obter_versao().dataset) == len(montar_dataset(app, taxons=6))
+    assert not agendador.esta_expirado()
+
+
+def test_falha_na_reconstrucao_mantem_a_versao_antiga(app):
+    def falhar():
+        raise RuntimeError('PBDB fora do ar')
+    agendador = app.AgendadorDeAtualizacao(falhar)
+    antigo = montar_dataset(app)
+    agendador._publicar(antigo, datetime.now() - timedelta(hours=app.CACHE_MAX_AGE_HOURS + 1))
+
+    assert agendador.obter_versao().dataset is antigo
+    agendador.thread.join(10)
+    assert agendador.status()['ultimo_erro'] == 'PBDB fora do ar'
+    assert agendador.versao.dataset is antigo
@@ -0,0 +1,39 @@
+import servidor_fake
+
+
+def requisicoes_ao_github(servidor):
+    return [caminho.split('/')[-2] for caminho in servidor.requisicoes if caminho.startswith('/repos/')]
+
+
+def test_lista_do_github_revalidada_por_etag(app, servidor, monkeypatch):
+    nomes = sorted(servidor_fake.nomes_das_imagens(servidor.configuracao.taxons))
+    assert sorted(app.obter_lista_de_taxons_do_github()) == nomes
+    assert requisicoes_ao_github(servidor) == ['branches', 'trees']
+
+    # Dentro do intervalo de revalidação, nem consulta o GitHub
+    servidor.requisicoes.clear()
+    assert sorted(app.obter_lista_de_taxons_do_github()) == nomes
+    assert requisicoes_ao_github(servidor) == []
+
+    # Depois dele, a branch inalterada responde 304 e a árvore não é baixada
+    monkeypatch.setattr(app, 'GITHUB_REVALIDACAO_MINUTOS', 0)
+    assert sorted(app.obter_lista_de_taxons_do_github()) == nomes
+    assert requisicoes_ao_github(servidor) == ['branches']
+
+    # Uma árvore nova é baixada de novo
+    servidor.requisicoes.clear()
+    servidor.configuracao.taxons = 45
+    assert sorted(app.obter_lista_de_taxons_do_github()) == sorted(servidor_fake.nomes_das_imagens(45))
+    assert requisicoes_ao_github(servidor) == ['branches', 'trees']
+
+
+def test_lista_do_github_usa_a_ultima_conhecida_se_ele_falhar(app, servidor, monkeypatch):
+    nomes = app.obter_lista_de_taxons_do_github()
+    monkeypatch.setattr(app, 'GITHUB_REVALIDACAO_MINUTOS', 0)
+    monkeypatch.setattr(app, 'GITHUB_API_URL', f"{servidor.url}/fora-do-ar") # Responde 404
+    assert app.obter_lista_de_taxons_do_github() == nomes
+
+
+def test_lista_do_github_vazia_sem_cache_e_sem_github(app, servidor, monkeypatch):
+    monkeypatch.setattr(app, 'GITHUB_API_URL', f"{servidor.url}/fora-do-ar")
+    assert app.obter_lista_de_taxons_do_github() == []
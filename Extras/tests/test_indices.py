@@ -0,0 +1,163 @@
+import random
+
+import pytest
+
+import servidor_fake
+
+
+def linhas_por_forca_bruta(inicios, fins, regra, idade_maxima, idade_minima):
+    maximo = float('inf') if idade_maxima is None else idade_maxima
+    minimo = float('-inf') if idade_minima is None else idade_minima
+    if minimo > maximo:
+        return []
+    if regra == 'contido':
+        return [i for i in range(len(inicios)) if inicios[i] <= maximo and fins[i] >= minimo]
+    return [i for i in range(len(inicios)) if fins[i] <= maximo and inicios[i] >= minimo]
+
+
+@pytest.mark.parametrize('semente', range(5))
+def test_arvore_de_intervalos_igual_a_forca_bruta(app, semente):
+    aleatorio = random.Random(semente)
+    limites = [aleatorio.uniform(0, 540) for _ in range(40)] # Poucos limites: muitos intervalos repetidos
+    inicios, fins = [], []
+    for _ in range(2000):
+        a, b = aleatorio.choice(limites), aleatorio.choice(limites)
+        # Alguns intervalos invertidos (inicio < fim), como um registro inconsistente do PBDB
+        inicio, fim = (max(a, b), min(a, b)) if aleatorio.random() < 0.95 else (min(a, b), max(a, b))
+        inicios.append(inicio)
+        fins.append(fim)
+    pesos = [aleatorio.randint(1, 5) for _ in inicios]
+    arvore = app.ArvoreDeIntervalos(inicios, fins, pesos)
+
+    janelas = [(None, None), (None, 100.0), (300.0, None), (200.0, 250.0), (10.0, 20.0)]
+    janelas += [tuple(sorted((aleatorio.uniform(-10, 550), aleatorio.uniform(-10, 550)), reverse=True))
+                for _ in range(50)]
+    for idade_maxima, idade_minima in janelas:
+        for regra, buscar in (('contido', arvore.contidas), ('sobreposto', arvore.sobrepostas)):
+            esperadas = linhas_por_forca_bruta(inicios, fins, regra, idade_maxima, idade_minima)
+            assert buscar(idade_maxima, idade_minima) == esperadas
+            assert arvore.somar(regra, idade_maxima, idade_minima) == sum(pesos[i] for i in esperadas)
+
+
+def test_arvore_de_intervalos_janela_invertida_e_vazia(app):
+    arvore = app.ArvoreDeIntervalos([10.0, 5.0], [8.0, 1.0])
+    assert arvore.contidas(1.0, 9.0) == []
+    assert app.ArvoreDeIntervalos([], []).sobrepostas(10.0, 0.0) == []
+
+
+def montar_dataset(app, registros, imagens):
+    return app.DatasetColunar.a_partir_de_registros(iter(registros), imagens, processos=1)
+
+
+def test_calcular_delta(app):
+    imagens = servidor_fake.nomes_das_imagens(10)
+    registros = [app.reduzir_registro(rec) for taxon in imagens for rec in servidor_fake.gerar_registros(taxon, 5)]
+    antigo = montar_dataset(app, registros, imagens)
+
+    removido, alterado = registros[3], dict(registros[10], lat='12.5')
+    adicionado = dict(registros[0], oid='occ:999999999999')
+    novos = [rec for rec in registros if rec is not removido and rec['oid'] != alterado['oid']]
+    novo = montar_dataset(app, novos + [alterado, adicionado], imagens)
+
+    adicionadas, removidos = app.calcular_delta(antigo, novo)
+    ids_antigos = list(antigo.colunas['id'])
+    id_removido = ids_antigos[[rec['oid'] for rec in registros].index(removido['oid'])]
+    id_alterado = ids_antigos[[rec['oid'] for rec in registros].index(alterado['oid'])]
+    assert sorted(removidos) == sorted([id_removido, id_alterado])
+    assert sorted(linha['id'] for linha in adicionadas) == sorted([id_alterado, 999999999999])
+
+    # Aplicar o delta à versão antiga reproduz a nova
+    por_id = {linha['id']: linha for linha in antigo.iterar_linhas()}
+    for identificador in removidos:
+        del por_id[identificador]
+    por_id.update((linha['id'], linha) for linha in adicionadas)
+    assert por_id == {linha['id']: linha for linha in novo.iterar_linhas()}
+
+
+def test_calcular_delta_sem_mudancas(app):
+    imagens = servidor_fake.nomes_das_imagens(5)
+    registros = [app.reduzir_registro(rec) for taxon in imagens for rec in servidor_fake.gerar_registros(taxon, 5)]
+    dataset = montar_dataset(app, registros, imagens)
+    assert app.calcular_delta(dataset, montar_dataset(app, registros, imagens)) == ([], [])
+
+
+def test_histograma_de_idades_com_intervalo_invertido(app):
+    assert app.contar_ocorrencias_por_idade([10.0], [20.0], [1]) == app.contar_ocorrencias_por_idade([20.0], [10.0], [1])
+
+    imagens = servidor_fake.nomes_das_imagens(1)
+    registro = dict(app.reduzir_registro(servidor_fake.gerar_registros(imagens[0], 1)[0]), eag=10.0, lag=20.0)
+    contagens = app.montar_histograma_de_idades(montar_dataset(app, [registro], imagens))['contagens']
+    assert min(contagens) == 0
+    assert [k for k, contagem in enumerate(contagens) if contagem] == list(range(10, 21))
+
+
+def test_localizador_de_paises(app):
+    quadrado = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+    buraco = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+    geojson = {'type': 'FeatureCollection', 'features': [
+        {'id': 'AAA', 'properties': {'name': 'A'}, 'geometry': {'type': 'Polygon', 'coordinates': [quadrado, buraco]}},
+        {'id': 'BBB', 'properties': {'name': 'B'}, 'geometry': {'type': 'MultiPolygon', 'coordinates': [
+            [[[20, 20], [22, 20], [21, 23], [20, 20]]],
+            [[[-30, -5], [-25, -5], [-25, 0], [-30, 0], [-30, -5]]]
+        ]}},
+        {'id': 'CCC', 'properties': {'name': 'C'}, 'geometry': {'type': 'Point', 'coordinates': [1, 1]}}
+    ]}
+    localizador = app.LocalizadorDePaises(geojson, tamanho_da_celula=3.0)
+    assert localizador.pais_do_ponto(1.0, 1.0) == 'AAA'
+    assert localizador.pais_do_ponto(5.0, 5.0) is None # No buraco
+    assert localizador.pais_do_ponto(21.0, 21.0) == 'BBB'
+    assert localizador.pais_do_ponto(21.9, 22.5) is None # Na caixa do triângulo, fora dele
+    assert localizador.pais_do_ponto(-27.0, -2.0) == 'BBB'
+    assert localizador.pais_do_ponto(100.0, 50.0) is None
+    assert set(localizador.nomes) == {'AAA', 'BBB'}
+
+
+def test_paises_atribuidos_na_construcao(app, cliente):
+    """O servidor fake divide o mundo em 'países' de 30° x 30° chamados P<coluna><linha>."""
+    linhas = list(app.agendador.obter_versao().dataset.iterar_linhas())
+    for linha in linhas:
+        assert linha['pais'] == f"P{int((linha['lng'] + 180) // 30):02d}{int((linha['lat'] + 90) // 30)}"
+    totais = {}
+    for linha in linhas:
+        totais[linha['pais']] = totais.get(linha['pais'], 0) + linha['quantidade']
+    assert cliente.get('/api/paises').json['paises'] == [{'id': pais, 'total': total} for pais, total in sorted(totais.items())]
+
+
+def test_agrupar_ocorrencias(app):
+    imagens = servidor_fake.nomes_das_imagens(1)
+    base = dict(app.reduzir_registro(servidor_fake.gerar_registros(imagens[0], 1)[0]),
+                oid='occ:100', lat='10.0', lng='20.0', eag=72.1, lag=66.0, oei='Maastrichtian')
+    registros = [
+        base,
+        dict(base, oid='occ:101'),
+        dict(base, oid='occ:102', eag=83.6, lag=72.1, oei='Campanian'), # Outra idade, mesmo período
+        dict(base, oid='occ:103', lat='11.0'),                          # Outro local
+        dict(base)                                                      # Mesmo id: descartada
+    ]
+    dataset = app.DatasetColunar.a_partir_de_registros(iter(registros), imagens, agrupar=True, processos=1)
+    linhas = list(dataset.iterar_linhas())
+    assert [(linha['id'], linha['quantidade'], linha['inicio'], linha['fim']) for linha in linhas] == [
+        (100, 3, 83.6, 66.0), (103, 1, 72.1, 66.0)
+    ]
+    assert dataset.intervalos_agrupados == {'linhas': [0, 0], 'inicios': [72.1, 83.6], 'fins': [66.0, 72.1],
+                                            'quantidades': [2, 1]}
+    # A densidade por idade conta cada ocorrência pelo próprio intervalo, não pelo envelope do grupo
+    contagens = app.montar_histograma_de_idades(dataset)['contagens']
+    assert (contagens[70], contagens[80]) == (3, 1)
+
+
+def test_agrupamento_preserva_a_quantidade_de_ocorrencias(app):
+    imagens = servidor_fake.nomes_das_imagens(30)
+    registros = [app.reduzir_registro(rec) for taxon in imagens for rec in servidor_fake.gerar_registros(taxon, 20)]
+    registros += [dict(rec, oid=f"{rec['oid']}0") for rec in registros[::3]] # Mesmo táxon, mesmo local
+    separado = app.DatasetColunar.a_partir_de_registros(iter(registros), imagens, agrupar=False, processos=1)
+    agrupado = app.DatasetColunar.a_partir_de_registros(iter(registros), imagens, agrupar=True, processos=1)
+    assert len(agrupado) < len(separado)
+    assert sum(agrupado.colunas['quantidade']) == len(separado)
+    assert app.montar_histograma_de_idades(agrupado) == app.montar_histograma_de_idades(separado)
+
+
+def test_agrupamento_muda_o_esquema(app, monkeypatch):
+    esquema = app.hash_do_esquema()
+    monkeypatch.setattr(app, 'AGRUPAR_OCORRENCIAS', not app.AGRUPAR_OCORRENCIAS)
+    assert app.hash_do_esquema() != esquema
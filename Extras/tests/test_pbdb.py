@@ -0,0 +1,113 @@
+import json
+import random
+
+import pytest
+
+import servidor_fake
+from conftest import requisicoes_ao_pbdb
+
+
+def dividir_em_partes(texto, semente):
+    aleatorio = random.Random(semente)
+    posicao = 0
+    while posicao < len(texto):
+        tamanho = aleatorio.randint(1, 40)
+        yield texto[posicao:posicao + tamanho]
+        posicao += tamanho
+
+
+@pytest.mark.parametrize('semente', range(5))
+def test_iterar_registros_json_em_pedacos(app, semente):
+    registros = servidor_fake.gerar_registros('Genero00001', 20, semente)
+    registros[0]['nota'] = 'chaves {"records": [1, 2]} e aspas \\" dentro de texto'
+    texto = json.dumps({'elapsed_time': 0.1, 'records_found': len(registros), 'records': registros})
+    assert list(app.iterar_registros_json(dividir_em_partes(texto, semente))) == registros
+
+
+def test_iterar_registros_json_sem_registros(app):
+    assert list(app.iterar_registros_json(['{"records_found": 0, ', '"records": []}'])) == []
+
+
+def test_bisseccao_isola_o_taxon_culpado(app, servidor):
+    nomes = servidor_fake.nomes_das_imagens(16)
+    servidor.configuracao.taxons_com_erro = {nomes[5]}
+    with app.criar_sessao_http(1) as sessao:
+        limitador = app.LimitadorDeTaxa(1000.0, 1000)
+        registros, falhas, nao_buscados, _, _ = app.buscar_lote_pbdb(1, nomes, sessao, limitador)
+    assert list(falhas) == [nomes[5]]
+    assert nao_buscados == []
+    assert len(registros) == 15 * servidor.configuracao.registros_por_taxon
+    # O lote inteiro, duas metades por nível (log2(16) = 4) e o culpado de novo sozinho: bem menos que 16
+    assert len(requisicoes_ao_pbdb(servidor)) <= 1 + 2 * 4 + 1
+
+
+def test_pbdb_fora_do_ar_nao_divide_o_lote(app, servidor):
+    nomes = servidor_fake.nomes_das_imagens(16)
+    servidor.configuracao.probabilidade_de_falha = 1.0
+    with app.criar_sessao_http(1) as sessao:
+        limitador = app.LimitadorDeTaxa(1000.0, 1000)
+        registros, falhas, nao_buscados, _, _ = app.buscar_lote_pbdb(1, nomes, sessao, limitador)
+    assert (registros, falhas, nao_buscados) == ([], {}, nomes)
+    assert len(requisicoes_ao_pbdb(servidor)) == app.PBDB_MAX_TENTATIVAS
+
+
+def test_denylist_so_bloqueia_depois_de_falhas_seguidas(app, servidor, monkeypatch):
+    monkeypatch.setattr(app, 'TAXON_MAX_AGE_HOURS', 0) # Toda construção busca todos os táxons de novo
+    nomes = servidor_fake.nomes_das_imagens(20)
+    culpado = nomes[7]
+    servidor.configuracao.taxons_com_erro = {culpado}
+
+    for falhas in range(1, app.TAXON_FALHAS_PARA_BLOQUEIO + 1):
+        app.atualizar_repositorio_de_taxons(nomes)
+        assert app.carregar_denylist()[culpado]['falhas'] == falhas
+
+    servidor.requisicoes.clear()
+    app.atualizar_repositorio_de_taxons(nomes)
+    assert not any(culpado in caminho for caminho in requisicoes_ao_pbdb(servidor))
+    buscados = {entrada['taxon'] for entrada in app.iterar_repositorio_de_taxons()}
+    assert buscados == set(nomes) - {culpado}
+
+
+def test_pbdb_fora_do_ar_nao_bloqueia_nem_publica(app, servidor):
+    servidor.configuracao.probabilidade_de_falha = 1.0
+    with pytest.raises(RuntimeError):
+        app.construir_dados_fosseis()
+    assert app.carregar_denylist() == {}
+    assert app.listar_versoes_do_dataset() == []
+
+    servidor.configuracao.probabilidade_de_falha = 0.0
+    dataset = app.construir_dados_fosseis()
+    assert len(dataset) and app.listar_versoes_do_dataset()
+
+
+def test_registros_de_sinonimos_nao_se_perdem(app, servidor, monkeypatch):
+    nomes = servidor_fake.nomes_das_imagens(6)
+    sinonimo = nomes[3]
+    gerar_registros = servidor_fake.gerar_registros
+    def gerar_com_sinonimo(taxon, quantidade, semente=0):
+        registros = gerar_registros(taxon, quantidade, semente)
+        if taxon == sinonimo: # O PBDB respondeu com o nome aceito, que não está no lote
+            for registro in registros:
+                registro.update(tna='Outronome', gnn='Outronome', idn='Outronome')
+                registro.pop('spn', None)
+        return registros
+    monkeypatch.setattr(servidor_fake, 'gerar_registros', gerar_com_sinonimo)
+
+    def ids_do_sinonimo(lista):
+        return sorted(rec['oid'] for rec in app.iterar_registros_dos_taxons(lista) if rec['gnn'] == 'Outronome')
+    app.atualizar_repositorio_de_taxons(nomes)
+    esperados = sorted(rec['oid'] for rec in gerar_com_sinonimo(sinonimo, servidor.configuracao.registros_por_taxon))
+    assert ids_do_sinonimo(nomes) == esperados
+    # A imagem do primeiro táxon do lote foi removida
+    assert ids_do_sinonimo(nomes[1:]) == esperados
+
+    # O primeiro táxon do lote expira e é buscado de novo sozinho
+    with open(app.TAXON_STORE_FILENAME, encoding='utf-8') as f:
+        entradas = [json.loads(linha) for linha in f]
+    entradas[0]['buscado_em'] = 0
+    with open(app.TAXON_STORE_FILENAME, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(entrada) + '\n' for entrada in entradas)
+    servidor.requisicoes.clear()
+    app.atualizar_repositorio_de_taxons(nomes)
+    assert len(requisicoes_ao_pbdb(servidor)) == 1
+    assert ids_do_sinonimo(nomes) == esperados